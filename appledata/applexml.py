@@ -24,6 +24,7 @@ import calendar
 import datetime
 import unicodedata
 import sys
+import urllib
 from xml import sax
 import sqlite3
 
@@ -67,6 +68,9 @@ class AppleXMLHandler(sax.handler.ContentHandler):
         self.parse_stack = []
         self.top_node = None
         self._parsingdata = False
+        # Every image has the same set of keys, so we keep a single copy of
+        # each key string.
+        self._keys = {}
    
     def add_object(self, xml_object):
         '''Adds an object to the current container, which can be a list or a
@@ -122,7 +126,7 @@ class AppleXMLHandler(sax.handler.ContentHandler):
     def endElement(self, name): #IGNORE:C0103
         '''callback for the end of a parsed XML element'''
         if name == "key":
-            self.key = self.chars
+            self.key = self._keys.setdefault(self.chars, self.chars)
         elif name == 'string':
             self.add_object(
                 unicodedata.normalize("NFC", su.unicode_string(self.chars)))
@@ -146,14 +150,35 @@ class AppleXMLHandler(sax.handler.ContentHandler):
         '''Returns the root of the parsed data tree'''
         return self.top_node[0]
 
+# Size of the chunks fed to the XML parser when reading an Apple XML file.
+_READ_CHUNK_SIZE = 1024 * 1024
+
 def read_applexml(filename, sql_filename):
     '''Reads the named file, and parses it as an Apple XML file. Returns the
     top node. Replaces bad characters in the input file. Sometimes AlbumData.xml
-    contains 0x00 characters!'''
-    f = open(filename, buffering=16384)
-    data = f.read().replace('\000', '')
-    f.close()
-    return read_applexml_string(data, sql_filename)
+    contains 0x00 characters!
+
+    The file is fed to an incremental parser in fixed size chunks, so only the
+    parsed tree, not the raw file content, is kept in memory.'''
+    handler = AppleXMLHandler()
+    parser = sax.make_parser()
+    parser.setContentHandler(handler)
+    f = open(filename, 'rb')
+    try:
+        while True:
+            chunk = f.read(_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            # 0x00 is never part of a multi-byte UTF-8 sequence, so it is safe
+            # to strip it from each chunk separately.
+            parser.feed(chunk.replace('\000', ''))
+        parser.close()
+    finally:
+        f.close()
+    album_xml = handler.gettopnode()
+    if sql_filename:
+        _read_sql_keywords(album_xml, sql_filename)
+    return album_xml
 
 def read_applexml_string(data, sql_filename):
     '''Parses the data as Apple XML format. Returns the top node.'''
@@ -163,28 +188,66 @@ def read_applexml_string(data, sql_filename):
     #parser.setEntityResolver(AppleXMLResolver())
     sax.parseString(data, handler)
     album_xml = handler.gettopnode()
-    
     if sql_filename:
-        # keywords are no longer available in XML
-        # quick hack to pull them out of the sqlite database instead
-        conn = sqlite3.connect(sql_filename)
-        c = conn.cursor()
-        photos = album_xml['Master Image List']
-        for key in photos:
-            photo = photos[key]
-        
-            if 'Keywords' not in photo:
-                photo['Keywords'] = []
-        
-            c.execute('select keywordId from RKKeywordForVersion where versionId is ?', (key,))
-            for keyword in c.fetchall():
-                if keyword:
-                    photo['Keywords'].append(keyword[0])
-    
-        album_xml['List of Keywords'] = {}
-        c.execute('select modelId, name from RKKeyword')
-        for keyword in c.fetchall():
-            album_xml['List of Keywords'][keyword[0]] = keyword[1]
-    
+        _read_sql_keywords(album_xml, sql_filename)
     return album_xml
 
+# Page cache (in KiB, as a negative number) and memory map size (in bytes) used
+# for reading the iPhoto database.
+_SQL_CACHE_SIZE = -64 * 1024
+_SQL_MMAP_SIZE = 256 * 1024 * 1024
+
+def open_library_db(sql_filename):
+    '''Opens the iPhoto database for reading. Returns an sqlite3 connection.
+
+    The database is opened read-only and immutable where the sqlite3 module
+    supports URI file names, with a larger page cache and memory mapped I/O.'''
+    try:
+        conn = sqlite3.connect('file:%s?mode=ro&immutable=1' % (
+            urllib.quote(su.fsenc(su.unicode_string(sql_filename)))), uri=True)
+    except TypeError:
+        # Older sqlite3 modules don't support URI file names.
+        conn = sqlite3.connect(sql_filename)
+    conn.execute('pragma query_only = 1')
+    conn.execute('pragma cache_size = %d' % (_SQL_CACHE_SIZE))
+    conn.execute('pragma mmap_size = %d' % (_SQL_MMAP_SIZE))
+    return conn
+
+def _read_sql_keywords(album_xml, sql_filename):
+    '''Adds the keywords from the iPhoto database file to the parsed XML data.'''
+    conn = open_library_db(sql_filename)
+    try:
+        add_sql_keywords(album_xml, conn)
+    finally:
+        conn.close()
+
+def add_sql_keywords(album_xml, conn):
+    '''Adds the keywords of all images from the iPhoto database to the parsed
+    XML data.
+
+    Args:
+      album_xml: parsed XML data, with a Master Image List.
+      conn: connection to the iPhoto database (see open_library_db()).
+    '''
+    # keywords are no longer available in XML
+    # quick hack to pull them out of the sqlite database instead
+    photos = album_xml['Master Image List']
+    for photo in photos.itervalues():
+        if 'Keywords' not in photo:
+            photo['Keywords'] = []
+
+    # One pass over the whole table instead of one query per image. The image keys
+    # in the XML data are strings, the versionIds integers.
+    photo = None
+    last_version_id = None
+    for (version_id, keyword_id) in conn.execute(
+        'select versionId, keywordId from RKKeywordForVersion'):
+        if version_id != last_version_id:
+            last_version_id = version_id
+            photo = photos.get(unicode(version_id))
+        if photo is not None and keyword_id is not None:
+            photo['Keywords'].append(keyword_id)
+
+    album_xml['List of Keywords'] = {}
+    for (model_id, name) in conn.execute('select modelId, name from RKKeyword'):
+        album_xml['List of Keywords'][model_id] = name
@@ -0,0 +1,103 @@
+"""Benchmark for reading keywords from the iPhoto database in applexml.py.
+
+Builds a synthetic Library.apdb and compares the old query-per-image lookup
+with the single pass over RKKeywordForVersion used by read_applexml.
+
+Usage: python -m appledata.applexml_benchmark [number of keyword rows]
+"""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import appledata.applexml as applexml
+
+_KEYWORDS_PER_IMAGE = 5
+_KEYWORD_COUNT = 200
+
+def make_library_db(sql_filename, keyword_rows):
+    """Creates a Library.apdb with keyword tables and returns a matching
+    Master Image List."""
+    conn = sqlite3.connect(sql_filename)
+    conn.execute('create table RKKeyword (modelId integer primary key, name varchar)')
+    conn.execute('create table RKKeywordForVersion (modelId integer primary key, '
+                 'versionId integer, keywordId integer)')
+    conn.execute('create index RKKeywordForVersion_versionId_index '
+                 'on RKKeywordForVersion (versionId)')
+    conn.executemany('insert into RKKeyword values (?, ?)',
+                     ((i, u'Keyword %d' % i) for i in xrange(_KEYWORD_COUNT)))
+    conn.executemany('insert into RKKeywordForVersion (versionId, keywordId) values (?, ?)',
+                     ((i // _KEYWORDS_PER_IMAGE, i % _KEYWORD_COUNT)
+                      for i in xrange(keyword_rows)))
+    conn.commit()
+    conn.close()
+    return dict((unicode(i), {}) for i in xrange(keyword_rows // _KEYWORDS_PER_IMAGE))
+
+def read_keywords_per_image(album_xml, sql_filename):
+    """The previous implementation: one query per image."""
+    conn = sqlite3.connect(sql_filename)
+    c = conn.cursor()
+    photos = album_xml['Master Image List']
+    for key in photos:
+        photo = photos[key]
+        if 'Keywords' not in photo:
+            photo['Keywords'] = []
+        c.execute('select keywordId from RKKeywordForVersion where versionId is ?', (key,))
+        for keyword in c.fetchall():
+            if keyword:
+                photo['Keywords'].append(keyword[0])
+    album_xml['List of Keywords'] = {}
+    c.execute('select modelId, name from RKKeyword')
+    for keyword in c.fetchall():
+        album_xml['List of Keywords'][keyword[0]] = keyword[1]
+    conn.close()
+
+def read_keywords_single_pass(album_xml, sql_filename):
+    """The current implementation: one pass over RKKeywordForVersion."""
+    conn = applexml.open_library_db(sql_filename)
+    applexml.add_sql_keywords(album_xml, conn)
+    conn.close()
+
+def _time(function, album_xml, sql_filename):
+    start = time.time()
+    function(album_xml, sql_filename)
+    return time.time() - start
+
+def main():
+    keyword_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        sql_filename = os.path.join(tmp_dir, 'Library.apdb')
+        photos = make_library_db(sql_filename, keyword_rows)
+        print '%d images, %d keyword rows' % (len(photos), keyword_rows)
+
+        old_xml = {'Master Image List': dict((k, {}) for k in photos)}
+        old_time = _time(read_keywords_per_image, old_xml, sql_filename)
+        print 'query per image: %6.2fs' % (old_time)
+
+        new_xml = {'Master Image List': dict((k, {}) for k in photos)}
+        new_time = _time(read_keywords_single_pass, new_xml, sql_filename)
+        print 'single pass:     %6.2fs (%.1fx)' % (new_time, old_time / new_time)
+
+        if old_xml != new_xml:
+            print 'ERROR: results differ.'
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
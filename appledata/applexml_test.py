@@ -0,0 +1,74 @@
+"""This module tests appledata/applexml.py."""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import appledata.applexml as applexml
+
+_PLIST = '''<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0">
+<dict>
+\t<key>Application Version</key>
+\t<string>9.5.1</string>
+\t<key>Master Image List</key>
+\t<dict>
+\t\t<key>12</key>
+\t\t<dict>
+\t\t\t<key>Caption</key>
+\t\t\t<string>Caf\xc3\xa9\x00 du Monde</string>
+\t\t\t<key>Rating</key>
+\t\t\t<integer>4</integer>
+\t\t\t<key>Hidden</key>
+\t\t\t<false/>
+\t\t</dict>
+\t</dict>
+\t<key>List of Albums</key>
+\t<array>
+\t\t<dict>
+\t\t\t<key>AlbumName</key>
+\t\t\t<string>Photos</string>
+\t\t</dict>
+\t</array>
+</dict>
+</plist>
+'''
+
+class AppleXMLTest(unittest.TestCase):
+    """Unit tests for applexml.py code."""
+
+    def test_read_applexml(self):
+        """Tests that chunked reading gives the same result as parsing a string."""
+        expected = applexml.read_applexml_string(_PLIST.replace('\000', ''), None)
+        tmpfd, tmp = tempfile.mkstemp(suffix='.xml')
+        os.write(tmpfd, _PLIST)
+        os.close(tmpfd)
+        old_chunk_size = applexml._READ_CHUNK_SIZE
+        try:
+            # Tiny chunks, so that elements and multi-byte characters get split.
+            applexml._READ_CHUNK_SIZE = 7
+            album_xml = applexml.read_applexml(tmp, None)
+        finally:
+            applexml._READ_CHUNK_SIZE = old_chunk_size
+            os.remove(tmp)
+        self.assertEquals(expected, album_xml)
+        photo = album_xml['Master Image List']['12']
+        self.assertEquals(u'Caf\xe9 du Monde', photo['Caption'])
+        self.assertEquals('4', photo['Rating'])
+        self.assertEquals(False, photo['Hidden'])
+        self.assertEquals(u'Photos', album_xml['List of Albums'][0]['AlbumName'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -45,18 +45,31 @@ None - should not really happen
 #               fix a bug in copying of originals
 #
 
+import array
 import datetime
+import hashlib
+import marshal
 import os
 import re
 import sys
+import tempfile
 
 import appledata.applexml as applexml
+import appledata.iphotodb as iphotodb
 import tilutil.imageutils as imageutils
 import tilutil.systemutils as su
 
 # List of extensions for image formats that are considered JPEG.
 _JPG_EXTENSIONS = ('jpg', 'jpeg')
 
+# Default folder for snapshots of the parsed library data.
+SNAPSHOT_FOLDER = u"~/Library/Caches/Phoshare"
+
+# Bump up the version number every time the layout of the snapshot data changes.
+# The marshal format depends on the Python version, so that is part of the
+# header as well.
+_SNAPSHOT_HEADER = "phoshare_snapshot_1 python_%d.%d\n" % sys.version_info[:2]
+
 
 # Convert Aperture numeric album types to iPhoto album type names.
 _APERTURE_ALBUM_TYPES = {
@@ -83,6 +96,17 @@ _APERTURE_ALBUM_TYPES = {
     'Recovered Photos': 'Special',
 }
 
+# Shared copies of strings that repeat across many images and albums.
+_INTERNED_STRINGS = {}
+
+def _intern_string(value):
+    """Returns a shared copy of value, so that equal keyword, face name or
+    album type strings are only stored once. Works for unicode strings, unlike
+    intern()."""
+    if value is None:
+        return None
+    return _INTERNED_STRINGS.setdefault(value, value)
+
 def parse_face_rectangle(string_data):
     """Parse a rectangle specification into an array of coordinate data.
 
@@ -109,6 +133,72 @@ def _get_aperture_master_path(preview_path):
     return folder.replace('/Previews/', '/Masters/', 1)
 
 
+class _LazyImageTable(object):
+    """Map of image ids to IPhotoImage objects, which creates each IPhotoImage
+    from the Master Image List on first access.
+
+    Iterating over the keys or testing for a key does not create any images,
+    while values() and itervalues() create all of them. Once an image is
+    created, its raw entry in the Master Image List is dropped (the key stays,
+    with a None value), so the data are not held in memory twice.
+    """
+
+    def __init__(self, image_data, keyword_map, face_map, aperture_data, on_create):
+        self._image_data = image_data if image_data else {}
+        self._keyword_map = keyword_map
+        self._face_map = face_map
+        self._aperture_data = aperture_data
+        self._on_create = on_create
+        self._images = {}
+
+    def get(self, key, default=None):
+        """Returns the image for key, or default if there is no such image."""
+        image = self._images.get(key)
+        if image is not None:
+            return image
+        data = self._image_data.get(key)
+        if data is None:
+            return default
+        image = IPhotoImage(key, data, self._keyword_map, self._face_map,
+                            self._aperture_data)
+        self._images[key] = image
+        self._image_data[key] = None
+        self._on_create(image)
+        return image
+
+    def __getitem__(self, key):
+        image = self.get(key)
+        if image is None:
+            raise KeyError(key)
+        return image
+
+    def __contains__(self, key):
+        return key in self._image_data
+
+    def has_key(self, key):
+        """Tests if there is an image for key."""
+        return key in self._image_data
+
+    def __len__(self):
+        return len(self._image_data)
+
+    def __iter__(self):
+        return iter(self._image_data)
+
+    def keys(self):
+        """Returns the list of all image ids."""
+        return self._image_data.keys()
+
+    def itervalues(self):
+        """Iterates over all images, creating any that don't exist yet."""
+        for key in self._image_data:
+            yield self.get(key)
+
+    def values(self):
+        """Returns the list of all images, creating any that don't exist yet."""
+        return list(self.itervalues())
+
+
 class IPhotoData(object):
     """top level iPhoto data node."""
 
@@ -123,7 +213,11 @@ class IPhotoData(object):
         self.face_albums = None
 
         # Master map of keywords
-        self.keywords = self.data.get("List of Keywords")
+        self.keywords = {}
+        keyword_list = self.data.get("List of Keywords")
+        if keyword_list:
+            for keyword_key, keyword in keyword_list.items():
+                self.keywords[keyword_key] = _intern_string(keyword)
 
         self.face_names = {}  # Master map of faces
         face_list = self.data.get("List of Faces")
@@ -131,17 +225,16 @@ class IPhotoData(object):
             for face_entry in face_list.values():
                 face_key = face_entry.get("key")
                 face_name = face_entry.get("name")
-                self.face_names[face_key] = face_name
+                self.face_names[face_key] = _intern_string(face_name)
                 # Other keys in face_entry: image, key image face index,
                 # PhotoCount, Order
 
-        self.images_by_id = {}
-        image_data = self.data.get("Master Image List")
-        if image_data:
-            for key in image_data:
-                image = IPhotoImage(key, image_data.get(key), self.keywords,
-                                    self.face_names, aperture_data)
-                self.images_by_id[key] = image
+        # Images are only created when an album or event that contains them
+        # is used.
+        self._rolls = {}
+        self.images_by_id = _LazyImageTable(self.data.get("Master Image List"),
+                                            self.keywords, self.face_names,
+                                            aperture_data, self._image_created)
 
         album_data = self.data2.get("List of Albums")
 
@@ -151,7 +244,6 @@ class IPhotoData(object):
                                 self.root_album, aperture_data)
             self.albums[album.albumid] = album
 
-        self._rolls = {}
 	if not self.aperture:
             roll_data = self.data2.get("List of Rolls")
             if roll_data:
@@ -169,6 +261,13 @@ class IPhotoData(object):
         self.images_by_base_name = None
         self.images_by_file_name = None
 
+    def _image_created(self, image):
+        """Called by images_by_id for every new image."""
+        roll = self._rolls.get(image.roll)
+        if roll:
+            # Loading the images of the event assigns event names and indexes.
+            roll.images
+
     def _build_image_name_list(self):
         self.images_by_base_name = {}
         self.images_by_file_name = {}
@@ -368,9 +467,15 @@ _CAPTION_PATTERN = re.compile(
 class IPhotoImage(object):
     """Describes an image in the iPhoto database."""
 
+    # Large libraries have hundreds of thousands of images, so we keep only
+    # the extracted fields, and no per-instance __dict__.
+    __slots__ = ('id', '_caption', 'comment', 'date', 'mod_date', 'image_path', 'rating',
+                 'gps', 'keywords', 'originalpath', 'roll', 'albums', 'faces',
+                 'face_rectangles', 'event_name', 'event_index', 'event_index0',
+                 '_is_movie', '_thumbpath', '_rotation_is_only_edit')
+
     def __init__(self, key, data, keyword_map, face_map, aperture_data):
         self.id = key
-        self.data = data
         self._caption = su.nn_string(data.get("Caption")).strip()
         self.comment = su.nn_string(data.get("Comment")).strip()
         version = None
@@ -443,7 +548,10 @@ class IPhotoImage(object):
                 su.pout(u"%s: full size preview not up to date." % (self.caption))
         else:
             self.originalpath = data.get("OriginalPath")
-        self.roll = data.get("Roll") 
+        self.roll = data.get("Roll")
+        self._is_movie = data.get("MediaType") == "Movie"
+        self._thumbpath = data.get("ThumbPath")
+        self._rotation_is_only_edit = data.get("RotationIsOnlyEdit")
 
         self.albums = []  # list of albums that this image belongs to
         self.faces = []
@@ -466,7 +574,7 @@ class IPhotoImage(object):
                     # Convert to using center of area, relative to upper left corner of image
                     rectangle[0] += rectangle[2] / 2.0
                     rectangle[1] = max(0.0, 1.0 - rectangle[1] - rectangle[3] / 2.0)
-                    self.face_rectangles.append(rectangle)
+                    self.face_rectangles.append(array.array('d', rectangle))
                 # Other keys in face_entry: face index
 
                 # Now sort the faces left to right.
@@ -503,7 +611,7 @@ class IPhotoImage(object):
 
     def ismovie(self):
         """Tests if this image is a movie."""
-        return self.data.get("MediaType") == "Movie"
+        return self._is_movie
 
     def addalbum(self, album):
         """Adds an album to the list of albums for this image."""
@@ -522,11 +630,11 @@ class IPhotoImage(object):
         return "Hidden" in self.keywords
 
     def _getthumbpath(self):
-        return self.data.get("ThumbPath")
+        return self._thumbpath
     thumbpath = property(_getthumbpath, doc="Path to thumbnail image")
 
     def _getrotationisonlyedit(self):
-        return self.data.get("RotationIsOnlyEdit")
+        return self._rotation_is_only_edit
     rotation_is_only_edit = property(_getrotationisonlyedit,
                                      doc="Rotation is only edit.")
 
@@ -566,6 +674,9 @@ class IPhotoImage(object):
 class IPhotoContainer(object):
     """Base class for IPhotoAlbum and IPhotoRoll."""
 
+    __slots__ = ('name', '_date', 'uuid', 'comment', 'albumtype', 'albumid', 'albums',
+                 'master', '_images', '_image_table', '_ratings', '_verbose', '_keylist')
+
     def __init__(self, name, albumtype, data, images, ratings, aperture_data=None, verbose=False):
         self.name = name
         self._date = None
@@ -613,34 +724,54 @@ class IPhotoContainer(object):
                 albumtype = name
             else:
                 print 'Unknown album type %s for %s.' % (albumtype, name)
-        self.albumtype = albumtype
-        self.data = data
+        self.albumtype = _intern_string(albumtype)
 
         self.albumid = -1
-        self.images = []
         self.albums = []
         self.master = False
-        hidden = 0
+        # The images are looked up on first use of self.images.
+        self._images = None
+        self._image_table = images
+        self._ratings = ratings
+        self._verbose = verbose
+        self._keylist = []
         if not self.isfolder() and data and (
             data.has_key("KeyList") or data.has_key("KeyListString")):
-            keylist = data.get("KeyList") if data.has_key("KeyList") else data.get(
+            self._keylist = data.get("KeyList") if data.has_key("KeyList") else data.get(
                 "KeyListString").split(",")
-            for key in keylist:
-                if not key:
+
+    def _getimages(self):
+        if self._images is None:
+            self._load_images()
+        return self._images
+
+    def _setimages(self, images):
+        self._images = images
+    images = property(_getimages, _setimages, doc="List of images in this container.")
+
+    def _load_images(self):
+        """Looks up the images in the key list of this container."""
+        # Set this first - looking up images can bring us back here for events.
+        self._images = []
+        hidden = 0
+        for key in self._keylist:
+            if not key:
+                continue
+            image = self._image_table.get(key)
+            if image:
+                if self._ratings and not image.rating in self._ratings:
                     continue
-                image = images.get(key)
-                if image:
-                    if ratings and not image.rating in ratings:
-                        continue
-                    self.images.append(image)
-                else:
-                    hidden += 1
-                    if verbose:
-                        su.pout(u"%s: image with id %s does not exist - could be hidden." % (name,
-                                                                                             key))
-        
+                self._images.append(image)
+            else:
+                hidden += 1
+                if self._verbose:
+                    su.pout(u"%s: image with id %s does not exist - could be hidden." % (
+                        self.name, key))
+
         if hidden:
-            su.pout(u"%s: %d images not exported (probably hidden)." % (name, hidden))
+            su.pout(u"%s: %d images not exported (probably hidden)." % (self.name, hidden))
+        # The key list is not needed any more.
+        self._keylist = ()
 
         self._assign_names()
 
@@ -657,6 +788,9 @@ class IPhotoContainer(object):
             i += 1
 
     def merge(self, other_roll):
+        if self._images is None and other_roll._images is None:
+            self._keylist = self._keylist + other_roll._keylist
+            return
         for image in other_roll.images:
             self.images.append(image)
         self._assign_names()
@@ -730,6 +864,8 @@ class IPhotoContainer(object):
 class IPhotoRoll(IPhotoContainer):
     """Describes an iPhoto Roll or Event."""
 
+    __slots__ = ()
+
     def __init__(self, data, images, ratings, aperture_data):
         IPhotoContainer.__init__(self,
                                  data.get("RollName")
@@ -746,6 +882,8 @@ class IPhotoRoll(IPhotoContainer):
 class IPhotoAlbum(IPhotoContainer):
     """Describes an iPhoto Album."""
 
+    __slots__ = ('parent',)
+
     def __init__(self, data, images, ratings, album_map, root_album, aperture_data):
         IPhotoContainer.__init__(self, data.get("AlbumName"),
                                  data.get("Album Type") if data.has_key("Album Type") else "Regular",
@@ -828,34 +966,125 @@ def get_album_sqlfile(library_dir):
                        "library location.") % (library_dir)
 
 
-def get_iphoto_data(album_xml_file, album_sql_file, ratings=None, verbose=False, aperture=False):
-    """reads the iPhoto database and converts it into an iPhotoData object."""
-    library_dir = os.path.dirname(album_xml_file)
-    is_aperture = aperture or album_xml_file.endswith('ApertureData.xml')
-    if verbose:
-        print "Reading %s database from %s..." % (
-            'Aperture' if is_aperture else 'iPhoto', album_xml_file)
-    album_xml = applexml.read_applexml(album_xml_file, album_sql_file)
-    
-    album_xml2 = None
+def _get_file_signature(file_path):
+    """Returns a tuple that changes whenever the file is replaced or modified."""
+    try:
+        file_stat = os.stat(file_path)
+        return (file_path, file_stat.st_size, file_stat.st_mtime, file_stat.st_ino)
+    except OSError:
+        return (file_path, None, None, None)
+
+def _get_snapshot_path(snapshot_folder, album_xml_file):
+    """Returns the path of the snapshot file for a library."""
+    name = hashlib.sha1(su.fsenc(album_xml_file)).hexdigest()
+    return os.path.join(su.expand_home_folder(snapshot_folder), name + ".snapshot")
+
+def _load_snapshot(snapshot_path, signature):
+    """Loads the parsed library data from a snapshot file.
+
+    Returns: (album_xml, album_xml2), or None if there is no current snapshot.
+    """
+    if not os.path.exists(snapshot_path):
+        return None
+    snapshot_file = None
+    try:
+        snapshot_file = open(snapshot_path, "rb")
+        if snapshot_file.readline() != _SNAPSHOT_HEADER:
+            return None
+        (snapshot_signature, album_xml, album_xml2) = marshal.load(snapshot_file)
+    except (IOError, EOFError, ValueError, TypeError) as ex:
+        su.perr(u"Could not read library snapshot %s: %s." % (snapshot_path, unicode(ex)))
+        return None
+    finally:
+        if snapshot_file:
+            snapshot_file.close()
+    if snapshot_signature != signature:
+        return None
+    return (album_xml, album_xml2)
+
+def _save_snapshot(snapshot_path, signature, album_xml, album_xml2):
+    """Saves the parsed library data into a snapshot file. The file is replaced
+    atomically, so readers never see a partial snapshot."""
+    snapshot_folder = os.path.dirname(snapshot_path)
+    try:
+        if not os.path.exists(snapshot_folder):
+            os.makedirs(snapshot_folder)
+        tmpfd, tmp = tempfile.mkstemp(dir=snapshot_folder)
+        snapshot_file = os.fdopen(tmpfd, "wb")
+        try:
+            snapshot_file.write(_SNAPSHOT_HEADER)
+            marshal.dump((signature, album_xml, album_xml2), snapshot_file)
+        finally:
+            snapshot_file.close()
+        os.rename(tmp, snapshot_path)
+    except (IOError, OSError, ValueError) as ex:
+        su.perr(u"Could not save library snapshot %s: %s." % (snapshot_path, unicode(ex)))
+
+def get_iphoto_data(album_xml_file, album_sql_file, ratings=None, verbose=False, aperture=False,
+                    snapshot_folder=None, use_sqlite=False):
+    """reads the iPhoto database and converts it into an iPhotoData object.
+
+    If snapshot_folder is set, the parsed data are saved in a snapshot file in
+    that folder, and loaded from there on the next call unless any of the
+    library files changed.
+
+    If use_sqlite is set, all data are read from the iPhoto database
+    (album_sql_file) instead of AlbumData.xml, and album_xml_file may be None.
+    """
+    if album_xml_file:
+        library_dir = os.path.dirname(album_xml_file)
+    else:
+        # album_sql_file is <library>/Database/apdb/Library.apdb.
+        library_dir = os.path.dirname(os.path.dirname(os.path.dirname(album_sql_file)))
+    is_aperture = aperture or bool(album_xml_file and
+                                   album_xml_file.endswith('ApertureData.xml'))
+    if use_sqlite and (is_aperture or not album_sql_file):
+        raise ValueError, "Reading the library database requires an iPhoto 9 library"
+    # Recent iPhoto versions write event and album data into
+    # iLifeShared/AlbumData2.xml.
+    album_xml_file2 = None
+    if not is_aperture and not use_sqlite:
+        album_xml_file2 = os.path.join(os.path.split(album_xml_file)[0],
+                                       "iLifeShared", "AlbumData2.xml")
+        if not os.path.exists(album_xml_file2):
+            album_xml_file2 = None
+
+    snapshot = None
+    if snapshot_folder:
+        snapshot_path = _get_snapshot_path(snapshot_folder, album_xml_file or album_sql_file)
+        signature = (use_sqlite,) + tuple(
+            _get_file_signature(f) for f in (album_xml_file, album_xml_file2, album_sql_file) if f)
+        snapshot = _load_snapshot(snapshot_path, signature)
+        if snapshot and verbose:
+            su.pout("Using library snapshot %s..." % (snapshot_path))
+
+    if snapshot:
+        (album_xml, album_xml2) = snapshot
+    else:
+        album_xml2 = None
+        if use_sqlite:
+            if verbose:
+                su.pout("Reading iPhoto database from %s..." % (album_sql_file))
+            album_xml = iphotodb.read_library_db(album_sql_file, library_dir)
+        else:
+            if verbose:
+                print "Reading %s database from %s..." % (
+                    'Aperture' if is_aperture else 'iPhoto', album_xml_file)
+            album_xml = applexml.read_applexml(album_xml_file, album_sql_file)
+            if album_xml_file2:
+                if verbose:
+                    su.pout("Reading event and album data from %s..." % (album_xml_file2))
+                album_xml2 = applexml.read_applexml(album_xml_file2, None)
+        if snapshot_folder:
+            _save_snapshot(snapshot_path, signature, album_xml, album_xml2)
+
+    aperture_data = None
     if is_aperture:
         try:
             import appledata.aperturedata as aperturedata
             aperture_data = aperturedata.get_aperture_data(library_dir, verbose)
         except ImportError:
             aperture_data = None
-    else:
-        aperture_data = None
-        # Recent iPhoto versions write event and album data into
-        # iLifeShared/AlbumData2.xml.
-        album_xml_file2 = os.path.join(os.path.split(album_xml_file)[0],
-                                       "iLifeShared", "AlbumData2.xml")
-        if os.path.exists(album_xml_file2):
-            if verbose:
-                su.pout("Reading event and album data from %s..." % (album_xml_file2))
-            album_xml2 = applexml.read_applexml(album_xml_file2, None)
-    
-    application_version = album_xml.get("Application Version")
 
     data = IPhotoData(album_xml, album_xml2, ratings, is_aperture, aperture_data)
     if is_aperture:
@@ -0,0 +1,162 @@
+"""Benchmark for the memory used by the iPhoto data model in iphotodata.py.
+
+Builds a synthetic AlbumData.xml, loads it with all images created (like an
+export of the whole library does), and reports the size of everything that
+is reachable from the IPhotoData object, and the peak RSS of the process.
+
+Usage: python -m appledata.iphotodata_benchmark [number of images]
+"""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import array
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import appledata.iphotodata as iphotodata
+
+_IMAGES_PER_ROLL = 100
+_KEYWORD_COUNT = 50
+_FACE_COUNT = 20
+
+_IMAGE_ENTRY = '''		<key>%(id)d</key>
+		<dict>
+			<key>MediaType</key><string>Image</string>
+			<key>Caption</key><string>IMG_%(id)06d</string>
+			<key>Comment</key><string></string>
+			<key>GUID</key><string>%(id)032X</string>
+			<key>Roll</key><integer>%(roll)d</integer>
+			<key>Rating</key><integer>%(rating)d</integer>
+			<key>ImagePath</key><string>/Library/Masters/%(roll)d/IMG_%(id)06d.JPG</string>
+			<key>ThumbPath</key><string>/Library/Thumbnails/%(roll)d/IMG_%(id)06d.jpg</string>
+			<key>ImageType</key><string>JPEG</string>
+			<key>ModDateAsTimerInterval</key><real>%(date)d.000000</real>
+			<key>DateAsTimerInterval</key><real>%(date)d.000000</real>
+			<key>DateAddedAsTimerInterval</key><real>%(date)d.000000</real>
+			<key>MetaModDateAsTimerInterval</key><real>%(date)d.000000</real>
+			<key>Keywords</key><array><string>%(keyword1)d</string><string>%(keyword2)d</string></array>
+			<key>Faces</key>
+			<array>
+				<dict>
+					<key>face key</key><integer>%(face)d</integer>
+					<key>face index</key><integer>0</integer>
+					<key>rectangle</key><string>{{0.25, 0.5}, {0.1, 0.2}}</string>
+				</dict>
+			</array>
+		</dict>
+'''
+
+def write_album_data(xml_file, image_count):
+    """Writes an AlbumData.xml file with image_count images."""
+    out = open(xml_file, 'w')
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<plist version="1.0">\n<dict>\n'
+              '\t<key>Application Version</key><string>9.5.1</string>\n'
+              '\t<key>List of Keywords</key>\n\t<dict>\n')
+    for i in xrange(_KEYWORD_COUNT):
+        out.write('\t\t<key>%d</key><string>Keyword %d</string>\n' % (i, i))
+    out.write('\t</dict>\n\t<key>List of Faces</key>\n\t<dict>\n')
+    for i in xrange(_FACE_COUNT):
+        out.write('\t\t<key>%d</key><dict><key>key</key><integer>%d</integer>'
+                  '<key>name</key><string>Person %d</string></dict>\n' % (i, i, i))
+    out.write('\t</dict>\n\t<key>Master Image List</key>\n\t<dict>\n')
+    for i in xrange(image_count):
+        out.write(_IMAGE_ENTRY % {
+            'id': i, 'roll': i // _IMAGES_PER_ROLL, 'rating': i % 6,
+            'date': 300000000 + i * 60, 'keyword1': i % _KEYWORD_COUNT,
+            'keyword2': (i * 7) % _KEYWORD_COUNT, 'face': i % _FACE_COUNT})
+    out.write('\t</dict>\n\t<key>List of Albums</key>\n\t<array>\n'
+              '\t\t<dict><key>AlbumId</key><integer>1</integer>'
+              '<key>AlbumName</key><string>Photos</string><key>Master</key><true/>'
+              '<key>KeyList</key><array>\n')
+    for i in xrange(image_count):
+        out.write('\t\t\t<string>%d</string>\n' % (i))
+    out.write('\t\t</array></dict>\n\t</array>\n\t<key>List of Rolls</key>\n\t<array>\n')
+    for roll in xrange((image_count + _IMAGES_PER_ROLL - 1) // _IMAGES_PER_ROLL):
+        out.write('\t\t<dict><key>RollID</key><integer>%d</integer>'
+                  '<key>RollName</key><string>Event %d</string><key>KeyList</key><array>' % (
+                      roll, roll))
+        for i in xrange(roll * _IMAGES_PER_ROLL,
+                        min(image_count, (roll + 1) * _IMAGES_PER_ROLL)):
+            out.write('<string>%d</string>' % (i))
+        out.write('</array></dict>\n')
+    out.write('\t</array>\n</dict>\n</plist>\n')
+    out.close()
+
+_SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                  types.ClassType)
+
+def deep_size(root):
+    """Returns the total size in bytes of all objects reachable from root,
+    counting shared objects only once."""
+    seen = set()
+    pending = [root]
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.iterkeys())
+            pending.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif isinstance(obj, types.MethodType):
+            pending.append(obj.im_self)
+        elif not isinstance(obj, (basestring, array.array)):
+            if hasattr(obj, '__dict__'):
+                pending.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for name in cls.__dict__.get('__slots__', ()):
+                    if hasattr(obj, name):
+                        pending.append(getattr(obj, name))
+    return total
+
+def _get_max_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, Mac OS X bytes.
+    if sys.platform == 'darwin':
+        max_rss /= 1024
+    return max_rss / 1024.0
+
+def main():
+    image_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        xml_file = os.path.join(tmp_dir, 'AlbumData.xml')
+        write_album_data(xml_file, image_count)
+        print '%d images, %.1f MB AlbumData.xml' % (
+            image_count, os.path.getsize(xml_file) / 1024.0 / 1024.0)
+
+        start = time.time()
+        data = iphotodata.get_iphoto_data(xml_file, None)
+        images = data.images_by_id.values()
+        for roll in data.rolls:
+            roll.images
+        print 'load time:   %6.2fs' % (time.time() - start)
+
+        size = deep_size(data)
+        print 'model size:  %6.1f MB (%d bytes per image)' % (
+            size / 1024.0 / 1024.0, size / max(1, len(images)))
+        print 'peak RSS:    %6.1f MB' % (_get_max_rss_mb())
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -14,10 +14,48 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
+import appledata.applexml as applexml
 import appledata.iphotodata as iphotodata
 
+_ALBUM_DATA = '''<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0">
+<dict>
+	<key>Application Version</key><string>9.5.1</string>
+	<key>Master Image List</key>
+	<dict>
+		<key>7</key>
+		<dict>
+			<key>Caption</key><string>%s</string>
+			<key>ImagePath</key><string>/tmp/IMG_0007.JPG</string>
+			<key>Roll</key><integer>3</integer>
+		</dict>
+	</dict>
+	<key>List of Albums</key>
+	<array>
+		<dict>
+			<key>AlbumId</key><integer>1</integer>
+			<key>AlbumName</key><string>Photos</string>
+			<key>Master</key><true/>
+			<key>KeyList</key><array><string>7</string></array>
+		</dict>
+	</array>
+	<key>List of Rolls</key>
+	<array>
+		<dict>
+			<key>RollID</key><integer>3</integer>
+			<key>RollName</key><string>Beach</string>
+			<key>KeyList</key><array><string>7</string></array>
+		</dict>
+	</array>
+</dict>
+</plist>
+'''
+
 class IPhotoDataTest(unittest.TestCase):
     """Unit tests for iphotodata.py code."""
 
@@ -40,5 +78,70 @@ class IPhotoDataTest(unittest.TestCase):
             '/Volumes/Backup750/Aperture Library.aplibrary/'
             'Masters/2010/11/25/20101125-003412')
 
+    def test_lazy_images(self):
+        """Tests that images are only created for the containers that are used."""
+        def image(caption, roll):
+            return {'Caption': caption, 'ImagePath': '/tmp/%s.jpg' % (caption), 'Roll': roll}
+        xml_data = {
+            'Application Version': '9.5.1',
+            'Master Image List': {'1': image('a', 10), '2': image('b', 10), '3': image('c', 20),
+                                  '4': image('d', 20), '5': image('e', 10)},
+            'List of Albums': [
+                {'AlbumId': 1, 'AlbumName': 'Photos', 'Master': True,
+                 'KeyList': ['1', '2', '3', '4', '5']},
+                {'AlbumId': 2, 'AlbumName': 'Favorites', 'KeyList': ['2']}],
+            # Event 10 is split, like iPhoto 9.1.2 does.
+            'List of Rolls': [
+                {'RollID': 10, 'RollName': 'Ten', 'KeyList': ['1', '2']},
+                {'RollID': 20, 'RollName': 'Twenty', 'KeyList': ['3', '4']},
+                {'RollID': 10, 'RollName': 'Ten', 'KeyList': ['5']}]}
+        data = iphotodata.IPhotoData(xml_data, None, None, False, None)
+        self.assertEquals(5, len(data.images_by_id))
+        self.assertEquals(0, len(data.images_by_id._images))
+
+        albums = dict((album.name, album) for album in data.albums.values())
+        favorite = albums['Favorites'].images[0]
+        # Creating the image also loads its event, to assign the event index.
+        self.assertEquals(3, len(data.images_by_id._images))
+        self.assertEquals('Ten', favorite.event_name)
+        self.assertEquals(2, favorite.event_index)
+        self.assertEquals(['a', 'b', 'e'], [i.caption for i in data.getroll(10).images])
+        self.assertEquals(3, data.images_by_id['5'].event_index)
+        self.assertEquals(3, len(data.images_by_id._images))
+
+        self.assertEquals(5, len(data.images))
+        self.assertEquals('Twenty', data.images_by_id['4'].event_name)
+
+    def test_snapshot(self):
+        """Tests that get_iphoto_data() reuses a snapshot until the library changes."""
+        tmp_dir = tempfile.mkdtemp()
+        read_applexml = applexml.read_applexml
+        try:
+            album_xml_file = os.path.join(tmp_dir, 'AlbumData.xml')
+            snapshot_folder = os.path.join(tmp_dir, 'snapshots')
+            with open(album_xml_file, 'w') as f:
+                f.write(_ALBUM_DATA % ('Sunset'))
+            data = iphotodata.get_iphoto_data(album_xml_file, None,
+                                              snapshot_folder=snapshot_folder)
+            self.assertEquals(u'Sunset', data.images_by_id['7'].caption)
+
+            def fail_read(_file_name, _sql_file_name):
+                self.fail('Library was parsed even though it did not change.')
+            applexml.read_applexml = fail_read
+            data = iphotodata.get_iphoto_data(album_xml_file, None,
+                                              snapshot_folder=snapshot_folder)
+            self.assertEquals(u'Sunset', data.images_by_id['7'].caption)
+            self.assertEquals(u'Beach', data.rolls[0].name)
+
+            applexml.read_applexml = read_applexml
+            with open(album_xml_file, 'w') as f:
+                f.write(_ALBUM_DATA % ('Sunrise at the beach'))
+            data = iphotodata.get_iphoto_data(album_xml_file, None,
+                                              snapshot_folder=snapshot_folder)
+            self.assertEquals(u'Sunrise at the beach', data.images_by_id['7'].caption)
+        finally:
+            applexml.read_applexml = read_applexml
+            shutil.rmtree(tmp_dir)
+
 if __name__ == '__main__':
     unittest.main()
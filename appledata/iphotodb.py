@@ -0,0 +1,223 @@
+'''Reads the iPhoto library directly from the iPhoto database (Library.apdb).
+
+The iPhoto database is indexed, and much cheaper to read than AlbumData.xml
+for large libraries. This module converts the database content into the same
+data structure that applexml.read_applexml() returns for AlbumData.xml, so that
+iphotodata.IPhotoData can be built from either source.
+
+Tables used:
+RKVersion - images (versions), with title, dates, rating, location, event
+RKMaster - the master files for the versions
+RKFolder - events (folderType 2) and album folders (folderType 1)
+RKAlbum, RKAlbumVersion - regular albums and their images
+RKKeyword, RKKeywordForVersion - keywords
+RKVersionFaceContent, RKFaceName - face rectangles and names (optional)
+'''
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+
+import appledata.applexml as applexml
+import tilutil.systemutils as su
+
+# RKFolder.folderType values.
+_FOLDER_TYPE_FOLDER = 1
+_FOLDER_TYPE_EVENT = 2
+
+# RKAlbum.albumType and albumSubclass values for user created regular albums.
+_ALBUM_TYPE_REGULAR = 1
+_ALBUM_SUBCLASS_USER = 3
+
+# RKMaster.type for movies.
+_MASTER_TYPE_MOVIE = 'VIDT'
+
+# Library.apdb only exists in iPhoto 9 libraries.
+_APPLICATION_VERSION = u'9.x'
+
+def _get_columns(conn, table):
+    """Returns the set of column names of a table (empty if the table does
+    not exist)."""
+    return set(row[1] for row in conn.execute('pragma table_info(%s)' % (table)))
+
+def _optional_column(columns, alias, name):
+    """Returns alias.name if name is in columns, or a null placeholder for a select."""
+    return '%s.%s' % (alias, name) if name in columns else 'null'
+
+def _format_rectangle(left, bottom, width, height):
+    """Formats a face rectangle like AlbumData.xml does: '{{x, y}, {width, height}}'."""
+    return '{{%s, %s}, {%s, %s}}' % (left, bottom, width, height)
+
+def _read_images(conn, library_dir):
+    """Reads all visible images. Returns the Master Image List, and a list of
+    (event uuid, image key) in image date order."""
+    version_columns = _get_columns(conn, 'RKVersion')
+    query = '''select v.modelId, v.uuid, v.name, v.imageDate, %s, v.mainRating, %s, %s,
+                      v.projectUuid, %s, %s, m.imagePath, m.type
+                 from RKVersion v join RKMaster m on m.modelId = v.masterId
+                where not v.isInTrash and not v.isHidden
+                order by v.imageDate, v.modelId''' % (
+        _optional_column(version_columns, 'v', 'lastModifiedDate'),
+        _optional_column(version_columns, 'v', 'latitude'),
+        _optional_column(version_columns, 'v', 'longitude'),
+        _optional_column(version_columns, 'v', 'rotation'),
+        _optional_column(version_columns, 'v', 'hasAdjustments'))
+    masters_dir = os.path.join(library_dir, u'Masters')
+    previews_dir = os.path.join(library_dir, u'Previews')
+    thumbnails_dir = os.path.join(library_dir, u'Thumbnails')
+
+    images = {}
+    event_images = []
+    for (model_id, uuid, name, image_date, mod_date, rating, latitude, longitude,
+         event_uuid, rotation, has_adjustments, image_path, master_type) in conn.execute(query):
+        key = unicode(model_id)
+        image_path = su.unicode_string(image_path)
+        master_path = os.path.join(masters_dir, image_path)
+        image = {
+            'GUID': uuid,
+            'Caption': su.unicode_string(name),
+            'DateAsTimerInterval': image_date,
+            'ModDateAsTimerInterval': mod_date if mod_date is not None else image_date,
+            'ThumbPath': os.path.join(thumbnails_dir, image_path),
+            'MediaType': 'Movie' if master_type == _MASTER_TYPE_MOVIE else 'Image',
+            'Keywords': [],
+        }
+        if rating is not None:
+            image['Rating'] = rating
+        if latitude is not None and longitude is not None:
+            image['latitude'] = latitude
+            image['longitude'] = longitude
+        if rotation or has_adjustments:
+            # Edited images are exported from the preview, like iPhoto does.
+            image['ImagePath'] = os.path.join(previews_dir, image_path)
+            image['OriginalPath'] = master_path
+            image['RotationIsOnlyEdit'] = bool(rotation and not has_adjustments)
+        else:
+            image['ImagePath'] = master_path
+        images[key] = image
+        event_images.append((event_uuid, key))
+    return (images, event_images)
+
+def _read_faces(conn, images):
+    """Adds face data to the images, and returns the List of Faces."""
+    if not _get_columns(conn, 'RKVersionFaceContent') or not _get_columns(conn, 'RKFaceName'):
+        return {}
+    faces = {}
+    for (face_key, name) in conn.execute('select faceKey, name from RKFaceName'):
+        faces[unicode(face_key)] = {'key': face_key, 'name': su.unicode_string(name)}
+    for (version_id, face_key, left, bottom, width, height) in conn.execute(
+        '''select versionId, faceKey, faceRectLeft, faceRectTop, faceRectWidth,
+                  faceRectHeight from RKVersionFaceContent order by versionId, modelId'''):
+        image = images.get(unicode(version_id))
+        if image is None:
+            continue
+        image.setdefault('Faces', []).append({
+            'face key': face_key,
+            'rectangle': _format_rectangle(left, bottom, width, height)})
+    return faces
+
+def _read_events(conn, images, event_images):
+    """Returns the List of Rolls, one for each event, and sets the Roll of each image."""
+    rolls = []
+    rolls_by_uuid = {}
+    for (model_id, uuid, name) in conn.execute(
+        '''select modelId, uuid, name from RKFolder
+            where folderType = ? and not isInTrash order by modelId''',
+        (_FOLDER_TYPE_EVENT,)):
+        roll = {'RollID': model_id, 'RollName': su.unicode_string(name), 'uuid': uuid,
+                'KeyList': []}
+        rolls.append(roll)
+        rolls_by_uuid[uuid] = roll
+    for (event_uuid, key) in event_images:
+        roll = rolls_by_uuid.get(event_uuid)
+        if roll:
+            roll['KeyList'].append(key)
+            images[key]['Roll'] = roll['RollID']
+    return [roll for roll in rolls if roll['KeyList']]
+
+def _read_albums(conn, images, image_keys):
+    """Returns the List of Albums: the Photos album, album folders, and regular
+    albums. Parents are always listed before their children."""
+    album_id = 1
+    albums = [{'AlbumId': album_id, 'AlbumName': u'Photos', 'Master': True,
+               'KeyList': image_keys}]
+    album_ids = {}
+
+    # Folders, ordered so that each parent comes before its children.
+    pending = []
+    for (uuid, name, parent_uuid) in conn.execute(
+        '''select uuid, name, parentFolderUuid from RKFolder
+            where folderType = ? and not isInTrash order by modelId''',
+        (_FOLDER_TYPE_FOLDER,)):
+        pending.append((uuid, su.unicode_string(name), parent_uuid))
+    folder_uuids = set(p[0] for p in pending)
+    while pending:
+        remaining = []
+        for (uuid, name, parent_uuid) in pending:
+            if parent_uuid in folder_uuids and parent_uuid not in album_ids:
+                remaining.append((uuid, name, parent_uuid))
+                continue
+            album_id += 1
+            album_ids[uuid] = album_id
+            folder = {'AlbumId': album_id, 'AlbumName': name, 'Album Type': 'Folder',
+                      'uuid': uuid}
+            if parent_uuid in album_ids:
+                folder['Parent'] = album_ids[parent_uuid]
+            albums.append(folder)
+        if len(remaining) == len(pending):
+            # Broken parent links - attach the rest to the top level.
+            folder_uuids.difference_update(p[0] for p in remaining)
+        pending = remaining
+
+    regular_albums = {}
+    for (model_id, uuid, name, folder_uuid) in conn.execute(
+        '''select modelId, uuid, name, folderUuid from RKAlbum
+            where albumType = ? and albumSubclass = ? and not isInTrash
+            order by modelId''', (_ALBUM_TYPE_REGULAR, _ALBUM_SUBCLASS_USER)):
+        album_id += 1
+        album = {'AlbumId': album_id, 'AlbumName': su.unicode_string(name),
+                 'Album Type': 'Regular', 'uuid': uuid, 'KeyList': []}
+        if folder_uuid in album_ids:
+            album['Parent'] = album_ids[folder_uuid]
+        albums.append(album)
+        regular_albums[model_id] = album
+    for (album_model_id, version_id) in conn.execute(
+        'select albumId, versionId from RKAlbumVersion order by modelId'):
+        album = regular_albums.get(album_model_id)
+        key = unicode(version_id)
+        if album is not None and key in images:
+            album['KeyList'].append(key)
+    return albums
+
+def read_library_db(sql_filename, library_dir):
+    """Reads the iPhoto database, and returns the data in the same format as
+    applexml.read_applexml() for AlbumData.xml.
+
+    Args:
+      sql_filename: path to Library.apdb.
+      library_dir: path to the iPhoto library, used to build image paths.
+    """
+    conn = applexml.open_library_db(sql_filename)
+    try:
+        (images, event_images) = _read_images(conn, library_dir)
+        album_xml = {
+            'Application Version': _APPLICATION_VERSION,
+            'Master Image List': images,
+            'List of Faces': _read_faces(conn, images),
+            'List of Rolls': _read_events(conn, images, event_images),
+            'List of Albums': _read_albums(conn, images, [key for (_, key) in event_images]),
+        }
+        applexml.add_sql_keywords(album_xml, conn)
+        return album_xml
+    finally:
+        conn.close()
@@ -0,0 +1,183 @@
+"""This module tests appledata/iphotodb.py."""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import appledata.applexml as applexml
+import appledata.iphotodata as iphotodata
+
+_SCHEMA = '''
+create table RKMaster (modelId integer primary key, uuid varchar, imagePath varchar,
+                       type varchar);
+create table RKVersion (modelId integer primary key, uuid varchar, name varchar,
+                        masterId integer, projectUuid varchar, imageDate timestamp,
+                        mainRating integer, isHidden integer, isInTrash integer,
+                        rotation integer, hasAdjustments integer,
+                        latitude decimal, longitude decimal);
+create table RKFolder (modelId integer primary key, uuid varchar, name varchar,
+                       folderType integer, parentFolderUuid varchar, isInTrash integer);
+create table RKAlbum (modelId integer primary key, uuid varchar, name varchar,
+                      albumType integer, albumSubclass integer, folderUuid varchar,
+                      isInTrash integer);
+create table RKAlbumVersion (modelId integer primary key, versionId integer,
+                             albumId integer);
+create table RKKeyword (modelId integer primary key, name varchar);
+create table RKKeywordForVersion (modelId integer primary key, versionId integer,
+                                  keywordId integer);
+create table RKFaceName (modelId integer primary key, faceKey integer, name varchar);
+create table RKVersionFaceContent (modelId integer primary key, versionId integer,
+                                   faceKey integer, faceRectLeft decimal, faceRectTop decimal,
+                                   faceRectWidth decimal, faceRectHeight decimal);
+
+insert into RKMaster values (1, 'm1', '2013/05/04/20130504-101010/IMG_0001.JPG', 'IMGT');
+insert into RKMaster values (2, 'm2', '2013/05/04/20130504-101010/IMG_0002.JPG', 'IMGT');
+insert into RKMaster values (3, 'm3', '2013/06/01/20130601-090000/MVI_0003.MOV', 'VIDT');
+insert into RKMaster values (4, 'm4', '2013/06/01/20130601-090000/IMG_0004.JPG', 'IMGT');
+insert into RKMaster values (5, 'm5', '2013/06/01/20130601-090000/IMG_0005.JPG', 'IMGT');
+
+insert into RKVersion values (11, 'v11', 'Beach', 1, 'e1', 389000000, 5, 0, 0, 0, 0,
+                              37.5, -122.25);
+insert into RKVersion values (12, 'v12', 'Sunset', 2, 'e1', 389000100, 0, 0, 0, 90, 0,
+                              null, null);
+insert into RKVersion values (13, 'v13', 'Party', 3, 'e2', 391000000, 0, 0, 0, 0, 0,
+                              null, null);
+insert into RKVersion values (14, 'v14', 'Hidden', 4, 'e2', 391000100, 0, 1, 0, 0, 0,
+                              null, null);
+insert into RKVersion values (15, 'v15', 'Trash', 5, 'e2', 391000200, 0, 0, 1, 0, 0,
+                              null, null);
+
+insert into RKFolder values (21, 'e1', 'Vacation', 2, null, 0);
+insert into RKFolder values (22, 'e2', 'Birthday', 2, null, 0);
+insert into RKFolder values (23, 'f1', 'Family', 1, 'TopLevelAlbums', 0);
+insert into RKFolder values (24, 'f2', 'Kids', 1, 'f1', 0);
+
+insert into RKAlbum values (31, 'a1', 'Best of', 1, 3, 'f2', 0);
+insert into RKAlbum values (32, 'a2', 'Smart', 2, 3, null, 0);
+insert into RKAlbum values (33, 'a3', 'Deleted', 1, 3, null, 1);
+insert into RKAlbumVersion values (1, 13, 31);
+insert into RKAlbumVersion values (2, 11, 31);
+insert into RKAlbumVersion values (3, 14, 31);
+
+insert into RKKeyword values (41, 'Ocean');
+insert into RKKeyword values (42, 'Family');
+insert into RKKeywordForVersion values (1, 11, 41);
+insert into RKKeywordForVersion values (2, 11, 42);
+insert into RKKeywordForVersion values (3, 13, 42);
+
+insert into RKFaceName values (1, 51, 'Anna');
+insert into RKVersionFaceContent values (1, 13, 51, 0.25, 0.5, 0.1, 0.2);
+'''
+
+class IPhotoDbTest(unittest.TestCase):
+    """Unit tests for iphotodb.py code."""
+
+    def setUp(self):
+        self.library_dir = tempfile.mkdtemp()
+        self.sql_file = os.path.join(self.library_dir, 'Library.apdb')
+        conn = sqlite3.connect(self.sql_file)
+        conn.executescript(_SCHEMA)
+        conn.close()
+        self.xml_file = os.path.join(self.library_dir, 'AlbumData.xml')
+
+    def tearDown(self):
+        shutil.rmtree(self.library_dir)
+
+    def test_get_iphoto_data(self):
+        """Tests get_iphoto_data() with use_sqlite."""
+        data = iphotodata.get_iphoto_data(self.xml_file, self.sql_file, use_sqlite=True)
+        self.assertEquals(['11', '12', '13'], sorted(data.images_by_id.keys()))
+
+        beach = data.images_by_id['11']
+        self.assertEquals(u'Beach', beach.caption)
+        self.assertEquals(5, beach.rating)
+        self.assertEquals([u'Ocean', u'Family'], beach.keywords)
+        self.assertEquals(37.5, beach.gps.latitude)
+        self.assertEquals(os.path.join(self.library_dir, 'Masters', '2013/05/04/20130504-101010',
+                                       'IMG_0001.JPG'), beach.image_path)
+        self.assertEquals(None, beach.originalpath)
+        self.assertEquals(u'Vacation', beach.event_name)
+        self.assertEquals(1, beach.event_index)
+
+        # Edited images are exported from the preview.
+        sunset = data.images_by_id['12']
+        self.assertEquals(os.path.join(self.library_dir, 'Previews', '2013/05/04/20130504-101010',
+                                       'IMG_0002.JPG'), sunset.image_path)
+        self.assertEquals(os.path.join(self.library_dir, 'Masters', '2013/05/04/20130504-101010',
+                                       'IMG_0002.JPG'), sunset.originalpath)
+        self.assertTrue(sunset.rotation_is_only_edit)
+
+        party = data.images_by_id['13']
+        self.assertTrue(party.ismovie())
+        self.assertEquals([u'Anna'], party.getfaces())
+        self.assertEquals([0.3, 0.4, 0.1, 0.2], [round(c, 6) for c in party.face_rectangles[0]])
+
+        self.assertEquals([u'Birthday', u'Vacation'], sorted(r.name for r in data.rolls))
+
+        albums = dict((album.name, album) for album in data.albums.values())
+        self.assertEquals(['Best of', 'Family', 'Kids', 'Photos'], sorted(albums))
+        self.assertTrue(albums['Photos'].master)
+        self.assertEquals(3, albums['Photos'].size)
+        self.assertEquals([u'Party', u'Beach'], [i.caption for i in albums['Best of'].images])
+        self.assertEquals('Folder', albums['Kids'].albumtype)
+        self.assertEquals(albums['Kids'], albums['Best of'].parent)
+        self.assertEquals(albums['Family'], albums['Kids'].parent)
+        self.assertEquals(data.root_album, albums['Family'].parent)
+
+    def test_without_album_xml(self):
+        """Tests that use_sqlite does not need AlbumData.xml."""
+        sql_file = os.path.join(self.library_dir, 'Database', 'apdb', 'Library.apdb')
+        os.makedirs(os.path.dirname(sql_file))
+        os.rename(self.sql_file, sql_file)
+        self.assertEquals(sql_file, iphotodata.get_album_sqlfile(self.library_dir))
+        self.assertRaises(ValueError, iphotodata.get_album_xmlfile, self.library_dir)
+        data = iphotodata.get_iphoto_data(None, sql_file, use_sqlite=True)
+        self.assertEquals(os.path.join(self.library_dir, 'Masters', '2013/05/04/20130504-101010',
+                                       'IMG_0001.JPG'), data.images_by_id['11'].image_path)
+
+    def test_add_sql_keywords(self):
+        """Tests that add_sql_keywords() gives every image its keywords, in
+        the order of the database rows, which need not be grouped by image."""
+        conn = sqlite3.connect(':memory:')
+        conn.executescript('''
+            create table RKKeyword (modelId integer primary key, name varchar);
+            create table RKKeywordForVersion (modelId integer primary key,
+                                              versionId integer, keywordId integer);
+            insert into RKKeyword values (1, 'Ocean');
+            insert into RKKeyword values (2, 'Family');
+            insert into RKKeyword values (3, 'Dog');
+            insert into RKKeywordForVersion values (1, 10, 1);
+            insert into RKKeywordForVersion values (2, 10, 2);
+            insert into RKKeywordForVersion values (3, 20, 3);
+            insert into RKKeywordForVersion values (4, 10, 3);
+            insert into RKKeywordForVersion values (5, 99, 1);
+            insert into RKKeywordForVersion values (6, 30, null);
+            insert into RKKeywordForVersion values (7, 20, 1);
+            ''')
+        album_xml = {'Master Image List': {u'10': {}, u'20': {'Keywords': []}, u'30': {},
+                                           u'40': {}}}
+        applexml.add_sql_keywords(album_xml, conn)
+        conn.close()
+        photos = album_xml['Master Image List']
+        self.assertEquals([1, 2, 3], photos[u'10']['Keywords'])
+        self.assertEquals([3, 1], photos[u'20']['Keywords'])
+        self.assertEquals([], photos[u'30']['Keywords'])
+        self.assertEquals([], photos[u'40']['Keywords'])
+        self.assertEquals({1: u'Ocean', 2: u'Family', 3: u'Dog'}, album_xml['List of Keywords'])
+
+if __name__ == '__main__':
+    unittest.main()
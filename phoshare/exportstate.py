@@ -0,0 +1,259 @@
+'''Remembers what a previous export run wrote to an export folder.
+
+The state is a manifest, an SQLite database in the root of the export folder.
+For every exported file, it records the iPhoto image it came from (id,
+modification date, paths), how it was exported (copy, link or resize), a
+fingerprint of the meta data written into it, the modification time and size
+the source file had, and when the file was exported. For every album folder,
+it records the modification times of the folder.
+
+With that, an incremental export can skip album folders where nothing
+changed without listing them, and skip files where nothing changed
+without comparing them to the iPhoto library. A source file that was
+modified or replaced behind iPhoto's back (same modification date in the
+library) is noticed by its modification time and size.
+
+If the manifest is missing or can't be read, the export checks every
+folder and file like a full export does, and the manifest is rebuilt from
+the files that check found in sync.
+'''
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import os
+import sqlite3
+import time
+
+import tilutil.statcache as statcache
+import tilutil.systemutils as su
+
+# The name of the manifest in the root of the export folder.
+STATE_NAME = u".phoshare_manifest.db"
+
+# The name of the state file of older versions, which is deleted.
+_OLD_STATE_NAME = u".phoshare_state"
+
+# Bump up the version number every time incompatible changes are made to the
+# manifest. Causes a full export check on the next run.
+STATE_VERSION = "phoshare_manifest_1"
+
+# Sub folders that hold exported originals.
+_ORIGINALS_FOLDERS = (u"Originals", u".picasaoriginals")
+
+_SCHEMA = (
+    '''create table if not exists info (name text primary key, value text)''',
+    '''create table if not exists files (
+           path text primary key, directory text, image_id text, mod_date text,
+           image_path text, original_path text, mode text, fingerprint text,
+           source_mtime real, source_size integer, exported real)''',
+    '''create table if not exists directories (path text primary key, signature blob)''',
+)
+
+_FILE_COLUMNS = ('path, image_id, mod_date, image_path, original_path, mode, fingerprint, '
+                 'source_mtime, source_size, exported')
+
+def _get_mtime(path):
+    """Returns the modification time of path, or None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def get_directory_signature(directory):
+    """Returns the modification times of an album folder and its originals
+    folders. Adding or deleting files in the folders changes them."""
+    return tuple([_get_mtime(directory)] + [
+        _get_mtime(os.path.join(directory, f)) for f in _ORIGINALS_FOLDERS])
+
+def _get_source_signature(record):
+    """Returns (modification time, size) of the source image of a record, or
+    (None, None)."""
+    image_path = record[2]
+    if image_path and statcache.exists(image_path):
+        return (statcache.getmtime(image_path), statcache.getsize(image_path))
+    return (None, None)
+
+
+class ExportState(object):
+    """The state of an export folder, as saved by the previous run, and as
+    built up by the current run.
+
+    File records are tuples of (image id, modification date, image path,
+    original path, mode, meta data fingerprint), as returned by
+    ExportFile.get_state_record().
+    """
+
+    def __init__(self, export_root, directories=None, files=None):
+        self.export_root = export_root
+        # album folder -> (signature, sorted list of export files)
+        self._directories = directories if directories else {}
+        # export file -> (record, source mtime, source size, export time)
+        self._files = files if files else {}
+        self._new_directories = {}
+        self._new_files = {}
+
+    def is_directory_unchanged(self, directory, records):
+        """Tests if an album folder is unchanged since the previous run.
+
+        Args:
+          directory: path of the album folder.
+          records: map of export file -> state record for the files that
+            should be in the folder.
+        """
+        entry = self._directories.get(directory)
+        if entry is None:
+            return False
+        (signature, export_files) = entry
+        if export_files != sorted(records):
+            return False
+        for (export_file, record) in records.iteritems():
+            if not self.has_file(export_file, record):
+                return False
+        return signature == get_directory_signature(directory)
+
+    def keep_directory(self, directory):
+        """Carries the state of an unchanged album folder over into the new
+        state."""
+        entry = self._directories[directory]
+        self._new_directories[directory] = entry
+        for export_file in entry[1]:
+            self._new_files[export_file] = self._files[export_file]
+
+    def has_file(self, export_file, record):
+        """Tests if an export file was synced by the previous run with the
+        same state record, from a source file that has not changed since."""
+        entry = self._files.get(export_file)
+        return (entry is not None and entry[0] == record and
+                entry[1:3] == _get_source_signature(record))
+
+    def get_record(self, export_file):
+        """Returns the state record of the image that the previous run
+        exported into export_file, or None."""
+        entry = self._files.get(export_file)
+        return entry[0] if entry else None
+
+    def set_file(self, export_file, record):
+        """Records an export file that is in sync with the library."""
+        if self.has_file(export_file, record):
+            self._new_files[export_file] = self._files[export_file]
+        else:
+            (source_mtime, source_size) = _get_source_signature(record)
+            self._new_files[export_file] = (record, source_mtime, source_size, time.time())
+
+    def set_directory(self, directory, records):
+        """Records an album folder, after all its files have been synced."""
+        self._new_directories[directory] = (get_directory_signature(directory),
+                                            sorted(records))
+
+    def save(self):
+        """Saves the new state into the export folder. Only the entries that
+        changed since the previous run are written."""
+        save_path = os.path.join(self.export_root, STATE_NAME)
+        try:
+            conn = _connect(save_path)
+            try:
+                with conn:
+                    conn.executemany(
+                        'delete from files where path = ?',
+                        [(f,) for f in self._files if f not in self._new_files])
+                    conn.executemany(
+                        'insert or replace into files values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(f, os.path.dirname(f)) + tuple(record) + (mtime, size, exported)
+                         for (f, (record, mtime, size, exported)) in self._new_files.iteritems()
+                         if self._files.get(f) != self._new_files[f]])
+                    conn.execute('delete from directories')
+                    conn.executemany(
+                        'insert into directories values (?, ?)',
+                        [(d, sqlite3.Binary(cPickle.dumps(signature, cPickle.HIGHEST_PROTOCOL)))
+                         for (d, (signature, _)) in self._new_directories.iteritems()])
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError) as ex:
+            su.perr(u'Could not save export manifest %s: %s' % (save_path, ex))
+            return
+        old_path = os.path.join(self.export_root, _OLD_STATE_NAME)
+        if os.path.exists(old_path):
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+def _connect(state_path):
+    """Opens the manifest, and clears it if it has a different version."""
+    conn = sqlite3.connect(state_path)
+    try:
+        with conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            row = conn.execute('select value from info where name = ?',
+                               ('version',)).fetchone()
+            if not row or row[0] != STATE_VERSION:
+                conn.execute('delete from files')
+                conn.execute('delete from directories')
+                conn.execute('insert or replace into info values (?, ?)',
+                             ('version', STATE_VERSION))
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+def _read_state(state_path):
+    """Returns (directories, files) from a manifest, for ExportState. Does
+    not change the manifest; a manifest of another version reads as empty."""
+    conn = sqlite3.connect(state_path)
+    try:
+        files = {}
+        directories = {}
+        if not conn.execute("select name from sqlite_master where type = 'table' and "
+                            "name = 'info'").fetchone():
+            return (directories, files)
+        row = conn.execute('select value from info where name = ?', ('version',)).fetchone()
+        if not row or row[0] != STATE_VERSION:
+            return (directories, files)
+        directory_files = {}
+        for row in conn.execute('select directory, %s from files' % (_FILE_COLUMNS)):
+            files[row[1]] = (tuple(row[2:8]), row[8], row[9], row[10])
+            directory_files.setdefault(row[0], []).append(row[1])
+        for (directory, signature) in conn.execute('select path, signature from directories'):
+            directories[directory] = (cPickle.loads(str(signature)),
+                                      sorted(directory_files.get(directory, [])))
+    finally:
+        conn.close()
+    return (directories, files)
+
+def load_state(export_root, dryrun=False):
+    """Loads the export state saved by the previous run. Returns an empty
+    state if there is none. A manifest that is corrupt is deleted, unless
+    dryrun is set, and rebuilt by the next save(). A manifest that can't be
+    read for other reasons, e.g., because another export has it locked, is
+    left alone."""
+    state_path = os.path.join(export_root, STATE_NAME)
+    if os.path.exists(state_path):
+        try:
+            (directories, files) = _read_state(state_path)
+            return ExportState(export_root, directories, files)
+        except sqlite3.OperationalError as ex:
+            su.perr(u'Could not read export manifest %s: %s' % (state_path, ex))
+        except (sqlite3.DatabaseError, cPickle.UnpicklingError, EOFError, ValueError) as ex:
+            if dryrun:
+                su.perr(u'Could not read export manifest %s: %s' % (state_path, ex))
+            else:
+                su.perr(u'Could not read export manifest %s, rebuilding it: %s' % (
+                    state_path, ex))
+                try:
+                    os.remove(state_path)
+                except OSError:
+                    pass
+    return ExportState(export_root)
@@ -0,0 +1,182 @@
+"""This module tests phoshare/exportstate.py."""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import phoshare.exportstate as exportstate
+import tilutil.statcache as statcache
+
+class ExportStateTest(unittest.TestCase):
+    """Unit tests for exportstate.py code."""
+
+    def setUp(self):
+        self.export_root = tempfile.mkdtemp()
+        self.album = os.path.join(self.export_root, u'Album')
+        os.mkdir(self.album)
+        self.export_file = os.path.join(self.album, u'IMG_0001.jpg')
+        open(self.export_file, 'w').close()
+        self.source_file = os.path.join(self.export_root, u'IMG_0001.JPG')
+        out = open(self.source_file, 'w')
+        out.write('x' * 100)
+        out.close()
+        self.records = {self.export_file: (u'1', None, self.source_file, None, u'copy',
+                                           u'abc')}
+        statcache.clear()
+
+    def tearDown(self):
+        statcache.clear()
+        shutil.rmtree(self.export_root)
+
+    def test_save_and_load(self):
+        """Tests that a saved state detects unchanged and changed folders."""
+        state = exportstate.load_state(self.export_root)
+        self.assertFalse(state.is_directory_unchanged(self.album, self.records))
+        state.set_file(self.export_file, self.records[self.export_file])
+        state.set_directory(self.album, self.records)
+        state.save()
+
+        state = exportstate.load_state(self.export_root)
+        self.assertTrue(state.is_directory_unchanged(self.album, self.records))
+        self.assertTrue(state.has_file(self.export_file, self.records[self.export_file]))
+
+        # Changed meta data.
+        changed = {self.export_file: (u'1', None, self.source_file, None, u'copy',
+                                      u'xyz')}
+        self.assertFalse(state.is_directory_unchanged(self.album, changed))
+        self.assertFalse(state.has_file(self.export_file, changed[self.export_file]))
+
+        # Deleted file.
+        os.remove(self.export_file)
+        os.utime(self.album, (0, 0))
+        self.assertFalse(state.is_directory_unchanged(self.album, self.records))
+
+    def test_keep_directory(self):
+        """Tests that unchanged folders are carried over into the new state."""
+        state = exportstate.load_state(self.export_root)
+        state.set_file(self.export_file, self.records[self.export_file])
+        state.set_directory(self.album, self.records)
+        state.save()
+
+        state = exportstate.load_state(self.export_root)
+        state.keep_directory(self.album)
+        state.save()
+        self.assertTrue(exportstate.load_state(self.export_root).is_directory_unchanged(
+            self.album, self.records))
+
+        # A state that did not see the folder drops it.
+        state = exportstate.load_state(self.export_root)
+        state.save()
+        self.assertFalse(exportstate.load_state(self.export_root).is_directory_unchanged(
+            self.album, self.records))
+
+    def test_changed_source(self):
+        """Tests that a source file that changed without a new modification
+        date in the library is noticed."""
+        state = exportstate.load_state(self.export_root)
+        state.set_file(self.export_file, self.records[self.export_file])
+        state.set_directory(self.album, self.records)
+        state.save()
+
+        out = open(self.source_file, 'a')
+        out.write('y')
+        out.close()
+        statcache.clear()
+        state = exportstate.load_state(self.export_root)
+        self.assertFalse(state.has_file(self.export_file, self.records[self.export_file]))
+        self.assertFalse(state.is_directory_unchanged(self.album, self.records))
+
+        # A deleted source file.
+        os.remove(self.source_file)
+        statcache.clear()
+        self.assertFalse(state.has_file(self.export_file, self.records[self.export_file]))
+
+    def test_bad_state_file(self):
+        """Tests that a corrupt manifest is deleted, and rebuilt."""
+        state_path = os.path.join(self.export_root, exportstate.STATE_NAME)
+        out = open(state_path, 'w')
+        out.write('garbage' * 1000)
+        out.close()
+        state = exportstate.load_state(self.export_root)
+        self.assertFalse(os.path.exists(state_path))
+        self.assertFalse(state.is_directory_unchanged(self.album, self.records))
+        state.set_file(self.export_file, self.records[self.export_file])
+        state.set_directory(self.album, self.records)
+        state.save()
+        self.assertTrue(os.path.exists(state_path))
+        self.assertTrue(exportstate.load_state(self.export_root).is_directory_unchanged(
+            self.album, self.records))
+
+    def test_dryrun(self):
+        """Tests that a dry run does not change or delete the manifest."""
+        state_path = os.path.join(self.export_root, exportstate.STATE_NAME)
+        state = exportstate.load_state(self.export_root)
+        state.set_file(self.export_file, self.records[self.export_file])
+        state.save()
+        conn = sqlite3.connect(state_path)
+        with conn:
+            conn.execute('update info set value = ? where name = ?', ('old', 'version'))
+        conn.close()
+        data = open(state_path, 'rb').read()
+        # Another version reads as empty, and is only cleared by save().
+        state = exportstate.load_state(self.export_root, dryrun=True)
+        self.assertFalse(state.has_file(self.export_file, self.records[self.export_file]))
+        self.assertEquals(data, open(state_path, 'rb').read())
+
+        out = open(state_path, 'w')
+        out.write('garbage' * 1000)
+        out.close()
+        exportstate.load_state(self.export_root, dryrun=True)
+        self.assertEquals('garbage' * 1000, open(state_path, 'rb').read())
+
+    def test_locked_state_file(self):
+        """Tests that a manifest that can't be read for the moment is kept."""
+        state = exportstate.load_state(self.export_root)
+        state.set_file(self.export_file, self.records[self.export_file])
+        state.save()
+
+        def read_state(state_path):
+            raise sqlite3.OperationalError('database is locked')
+        old_read_state = exportstate._read_state
+        exportstate._read_state = read_state
+        try:
+            state = exportstate.load_state(self.export_root)
+        finally:
+            exportstate._read_state = old_read_state
+        self.assertFalse(state.has_file(self.export_file, self.records[self.export_file]))
+        self.assertTrue(exportstate.load_state(self.export_root).has_file(
+            self.export_file, self.records[self.export_file]))
+
+    def test_manifest(self):
+        """Tests the entries that the manifest keeps for a file."""
+        state = exportstate.load_state(self.export_root)
+        state.set_file(self.export_file, self.records[self.export_file])
+        state.save()
+        exported = state._new_files[self.export_file][3]
+
+        state = exportstate.load_state(self.export_root)
+        self.assertEquals((self.records[self.export_file], os.path.getmtime(self.source_file),
+                           100, exported),
+                          state._files[self.export_file])
+        self.assertEquals(self.records[self.export_file], state.get_record(self.export_file))
+        self.assertEquals(None, state.get_record(self.album))
+        # An unchanged file keeps its export time.
+        state.set_file(self.export_file, self.records[self.export_file])
+        self.assertEquals(exported, state._new_files[self.export_file][3])
+
+if __name__ == '__main__':
+    unittest.main()
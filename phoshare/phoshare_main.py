@@ -22,20 +22,26 @@
 #
 
 import getpass
+import hashlib
 import logging
 import os
 import re
 import sys
+import threading
 import time
 import unicodedata
 
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 import MacOS
 
 import appledata.iphotodata as iphotodata
 import tilutil.exiftool as exiftool
+import tilutil.filecopy as filecopy
 import tilutil.systemutils as su
 import tilutil.imageutils as imageutils
+import tilutil.statcache as statcache
+import phoshare.exportstate as exportstate
 import phoshare.phoshare_version
 
 # Maximum diff in file size to be not considered a change (to allow for
@@ -56,6 +62,9 @@ _EXIF_EXTENSIONS = ('3fr', 'arw', 'ciff', 'cr2', 'crw', 'dcr', 'erf', 'jpg', 'jp
 # create logger
 _logger = logging.getLogger('google')
 _logger.setLevel(logging.DEBUG)
+
+# Guards the creation of folders by export worker threads.
+_folder_lock = threading.Lock()
   
 def region_matches(region1, region2):
     """Tests if two regions (rectangles) match."""
@@ -66,6 +75,16 @@ def region_matches(region1, region2):
             return False
     return True
 
+def get_read_profile(options):
+    """Returns the exiftool read profile with the tags that the IPTC checks
+    need for the options."""
+    profile = exiftool.READ_BASIC
+    if options.gps:
+        profile |= exiftool.READ_GPS
+    if options.faces:
+        profile |= exiftool.READ_FACES
+    return profile
+
 def delete_album_file(album_file, albumdirectory, msg, options):
     """sanity check - only delete from album directory."""
     if not album_file.startswith(albumdirectory):
@@ -82,14 +101,15 @@ def delete_album_file(album_file, albumdirectory, msg, options):
         return True
 
     try:
-        if os.path.isdir(album_file):
-            file_list = os.listdir(album_file)
+        if statcache.isdir(album_file):
+            file_list = statcache.listdir(album_file)
             for subfile in file_list:
                 delete_album_file(os.path.join(album_file, subfile),
                                   albumdirectory, msg, options)
             os.rmdir(album_file)
         else:
             os.remove(album_file)
+        statcache.invalidate(album_file)
         return True
     except OSError, ex:
         print >> sys.stderr, "Could not delete %s: %s" % (su.fsenc(album_file),
@@ -126,6 +146,10 @@ class ExportFile(object):
                 su.getfileextension(photo.originalpath))
         else:
             self.original_export_file = None
+        # Set by generate(): True if the export is known to be in sync.
+        self.in_sync = False
+        # Obsolete export file that was renamed to export_file, if any.
+        self.renamed_from = None
 
     def get_photo(self):
         """Gets the associated iPhotoImage."""
@@ -138,32 +162,32 @@ class ExportFile(object):
           source_file: path to image file, with aliases resolved.
           options: processing options.
         """
-        if not os.path.exists(self.export_file):
+        if not statcache.exists(self.export_file):
             return True
         # In link mode, check the inode.
         if options.link:
-            export_stat = os.stat(self.export_file)
-            source_stat = os.stat(source_file)
-            if export_stat.st_ino != source_stat.st_ino:
+            export_inode = statcache.getinode(self.export_file)
+            source_inode = statcache.getinode(source_file)
+            if export_inode != source_inode:
                 su.pout('Changed:  %s: inodes don\'t match: %d vs. %d' %
-                    (self.export_file, export_stat.st_ino, source_stat.st_ino))
+                    (self.export_file, export_inode, source_inode))
                 return True
         if (not options.reverse
-            and os.path.getmtime(self.export_file) + _MTIME_FUDGE <
-            os.path.getmtime(source_file)):
+            and statcache.getmtime(self.export_file) + _MTIME_FUDGE <
+            statcache.getmtime(source_file)):
             su.pout('Changed:  %s: newer version is available: %s vs. %s' %
                     (self.export_file,
-                     time.ctime(os.path.getmtime(self.export_file)),
-                     time.ctime(os.path.getmtime(source_file))))
+                     time.ctime(statcache.getmtime(self.export_file)),
+                     time.ctime(statcache.getmtime(source_file))))
             return True
 
         if (options.reverse
-            and os.path.getmtime(source_file) + _MTIME_FUDGE <
-            os.path.getmtime(self.export_file)):
+            and statcache.getmtime(source_file) + _MTIME_FUDGE <
+            statcache.getmtime(self.export_file)):
             su.pout('Changed:  %s: newer version is available: %s vs. %s' %
                     (self.export_file,
-                     time.ctime(os.path.getmtime(source_file)),
-                     time.ctime(os.path.getmtime(self.export_file))))
+                     time.ctime(statcache.getmtime(source_file)),
+                     time.ctime(statcache.getmtime(self.export_file))))
             return True
         
         if not self.size and not options.reverse:
@@ -171,8 +195,8 @@ class ExportFile(object):
             # stale files if titles get swapped between images. Double
             # check the size, allowing for some difference for meta data
             # changes made in the exported copy
-            source_size = os.path.getsize(source_file)
-            export_size = os.path.getsize(self.export_file)
+            source_size = statcache.getsize(source_file)
+            export_size = statcache.getsize(self.export_file)
             diff = abs(source_size - export_size)
             if diff > _MAX_FILE_DIFF or (diff > 32 and options.link):
                 su.pout('Changed:  %s: file size: %d vs. %d' %
@@ -194,44 +218,60 @@ class ExportFile(object):
         # In link mode, we don't need to check the modification date in the
         # database because we catch the changes by the size check above.
         #if (not options.link and
-        #    datetime.datetime.fromtimestamp(os.path.getmtime(
+        #    datetime.datetime.fromtimestamp(statcache.getmtime(
         #       self.export_file)) < self.photo.mod_date):
         #    su.pout('Changed:  %s: modified in iPhoto: %s vs. %s ' % (
         #        self.export_file,
-        #        time.ctime(os.path.getmtime(self.export_file)),
+        #        time.ctime(statcache.getmtime(self.export_file)),
         #        self.photo.mod_date))
         #    return True
         return False
 
-    def _generate_original(self, options):
+    def _is_copy_current(self, source_file, export_file, options):
+        """Tests if export_file is a current copy (or link) of source_file.
+        Used to find out if an export was actually done."""
+        if not statcache.exists(export_file):
+            return False
+        if options.link:
+            return statcache.getinode(export_file) == statcache.getinode(source_file)
+        if statcache.getmtime(export_file) + _MTIME_FUDGE < statcache.getmtime(source_file):
+            return False
+        if not self.size:
+            return abs(statcache.getsize(source_file) -
+                       statcache.getsize(export_file)) <= _MAX_FILE_DIFF
+        return True
+
+    def _generate_original(self, options, link_sources=None):
         """Exports the original file."""
         do_original_export = False
         export_dir = os.path.split(self.original_export_file)[0]
-        if not os.path.exists(export_dir):
-            su.pout("Creating folder " + export_dir)
-            if not options.dryrun:
-                os.mkdir(export_dir)
+        with _folder_lock:
+            if not os.path.exists(export_dir):
+                su.pout("Creating folder " + export_dir)
+                if not options.dryrun:
+                    os.mkdir(export_dir)
+                    statcache.invalidate(export_dir)
         original_source_file = su.resolve_alias(self.photo.originalpath)
-        if os.path.exists(self.original_export_file):
+        if statcache.exists(self.original_export_file):
             # In link mode, check the inode.
             if options.link:
-                export_stat = os.stat(self.original_export_file)
-                source_stat = os.stat(original_source_file)
-                if export_stat.st_ino != source_stat.st_ino:
+                export_inode = statcache.getinode(self.original_export_file)
+                source_inode = statcache.getinode(original_source_file)
+                if export_inode != source_inode:
                     su.pout('Changed:  %s: inodes don\'t match: %d vs. %d' %
-                            (self.original_export_file, export_stat.st_ino, source_stat.st_ino))
+                            (self.original_export_file, export_inode, source_inode))
                     do_original_export = True
-            if (os.path.getmtime(self.original_export_file) + _MTIME_FUDGE <
-                os.path.getmtime(original_source_file)):
+            if (statcache.getmtime(self.original_export_file) + _MTIME_FUDGE <
+                statcache.getmtime(original_source_file)):
                 su.pout('Changed:  %s: newer version is available: %s vs. %s' %
                         (self.original_export_file,
-                         time.ctime(os.path.getmtime(
+                         time.ctime(statcache.getmtime(
                              self.original_export_file)),
-                         time.ctime(os.path.getmtime(original_source_file))))
+                         time.ctime(statcache.getmtime(original_source_file))))
                 do_original_export = True
             elif not self.size:
-                source_size = os.path.getsize(original_source_file)
-                export_size = os.path.getsize(self.original_export_file)
+                source_size = statcache.getsize(original_source_file)
+                export_size = statcache.getsize(self.original_export_file)
                 diff = abs(source_size - export_size)
                 if diff > _MAX_FILE_DIFF or (diff > 0 and options.link):
                     su.pout(u'Changed:  %s: file size: %d vs. %d' %
@@ -243,58 +283,168 @@ class ExportFile(object):
 
         do_iptc = (options.iptc == 1 and
                    do_original_export) or options.iptc == 2
-        if do_iptc and (options.link or options.iptc_masters):
+        if do_iptc and (options.link or options.iptc_masters) and not options.sidecar:
             if self.check_iptc_data(original_source_file, options,
                                     is_original=True, file_updated=do_original_export):
                 do_original_export = True
         exists = True  # True if the file exists or was updated.
         if do_original_export:
-            exists = imageutils.copy_or_link_file(original_source_file,
-                                                  self.original_export_file,
-                                                  options.dryrun,
-                                                  options.link,
-                                                  self.size,
-                                                  options)
+            exists = self._copy_file(original_source_file, self.original_export_file,
+                                     self.size,
+                                     link_sources.get(self.get_link_key(options, True))
+                                     if link_sources else None, options)
+            statcache.invalidate(self.original_export_file)
+            if not exists or not self._is_copy_current(original_source_file,
+                                                       self.original_export_file, options):
+                self.in_sync = False
         else:
             _logger.debug(u'%s up to date.', self.original_export_file)
-        if exists and do_iptc and not options.link:
+        if exists and do_iptc and (not options.link or options.sidecar):
             self.check_iptc_data(self.original_export_file, options,
                                  is_original=True, file_updated=do_original_export)
 
-    def generate(self, options):
+    def generate(self, options, link_sources=None):
         """makes sure all files exist in other album, and generates if
-           necessary."""
+           necessary.
+
+        Args:
+          options: processing options.
+          link_sources: with --dedupe, map of link key -> export file in sync
+            with the library, which new export files with the same key are
+            hard linked to (see get_link_key()).
+        """
+        self.in_sync = not options.dryrun
+        if options.dryrun and self.renamed_from:
+            # The dry run did not rename the file, so there is nothing to
+            # compare.
+            return
         try:
             source_file = su.resolve_alias(self.photo.image_path)
             do_export = self._check_need_to_export(source_file, options)
 
-            # if we use links, we update the IPTC data in the original file
+            # if we use links, we update the IPTC data in the original file,
+            # unless it goes into a sidecar file.
             do_iptc = (options.iptc == 1 and do_export) or options.iptc == 2
-            if do_iptc and options.link:
+            if do_iptc and options.link and not options.sidecar:
                 if self.check_iptc_data(source_file, options, file_updated=do_export):
                     do_export = True
 
             exists = True  # True if the file exists or was updated.
             if do_export:
-                exists = imageutils.copy_or_link_file(source_file,
-                                                      self.export_file,
-                                                      options.dryrun,
-                                                      options.link,
-                                                      self.size,
-                                                      options)
+                exists = self._copy_file(source_file, self.export_file, self.size,
+                                         link_sources.get(self.get_link_key(options))
+                                         if link_sources else None, options)
+                statcache.invalidate(self.export_file)
+                if not exists or not self._is_copy_current(source_file, self.export_file,
+                                                           options):
+                    self.in_sync = False
             else:
                 _logger.debug(u'%s up to date.', self.export_file)
 
             # if we copy, we update the IPTC data in the copied file
-            if exists and do_iptc and not options.link:
+            if exists and do_iptc and (not options.link or options.sidecar):
                 self.check_iptc_data(self.export_file, options, file_updated=do_export)
 
             if (options.originals and self.photo.originalpath and
                 not self.photo.rotation_is_only_edit):
-                self._generate_original(options)
+                self._generate_original(options, link_sources)
         except (OSError, MacOS.Error) as ose:
             su.perr(u"Failed to export %s to %s: %s" % (self.photo.image_path, self.export_file,
                                                         ose))
+            self.in_sync = False
+
+    def get_iptc_files(self, options):
+        """Returns the existing files that generate() checks the IPTC data of
+        even if they are up to date, i.e. with --iptcall."""
+        if options.iptc != 2:
+            return []
+        files = []
+        has_original = (options.originals and self.photo.originalpath and
+                        not self.photo.rotation_is_only_edit)
+        if options.sidecar:
+            files.append(self.export_file)
+            if has_original:
+                files.append(self.original_export_file)
+            return [exiftool.get_sidecar_file(f) for f in files
+                    if su.getfileextension(f) in _EXIF_EXTENSIONS and
+                    os.path.exists(exiftool.get_sidecar_file(f))]
+        if options.link:
+            files.append(su.resolve_alias(self.photo.image_path))
+        else:
+            files.append(self.export_file)
+        if has_original:
+            if options.link or options.iptc_masters:
+                files.append(su.resolve_alias(self.photo.originalpath))
+            if not options.link:
+                files.append(self.original_export_file)
+        return [f for f in files
+                if su.getfileextension(f) in _EXIF_EXTENSIONS and os.path.exists(f)]
+
+    def exported_files_exist(self, options):
+        """Tests if the export file, and the exported original if needed, exist."""
+        if not statcache.exists(self.export_file):
+            return False
+        if (options.originals and self.photo.originalpath and
+            not self.photo.rotation_is_only_edit):
+            return statcache.exists(self.original_export_file)
+        return True
+
+    def get_metadata_fingerprint(self, options):
+        """Returns a fingerprint of the meta data that the export writes into
+        the exported file, and of the options that affect the export."""
+        photo = self.photo
+        data = (imageutils.get_photo_caption(photo, self.container, options.captiontemplate),
+                self.get_export_keywords(options.face_keywords), photo.rating,
+                photo.gps.to_string() if photo.gps else None, photo.getfaces(),
+                [list(rectangle) for rectangle in photo.face_rectangles],
+                options.iptc, options.iptc_masters, options.link, options.size,
+                options.originals, options.faces, options.gps, options.face_keywords,
+                options.sidecar)
+        return hashlib.md5(repr(data)).hexdigest()
+
+    def get_export_mode(self, options):
+        """Returns how the image is exported: u'link', u'resize' or u'copy'."""
+        if options.link:
+            return u'link'
+        if options.size:
+            return u'resize'
+        return u'copy'
+
+    def get_state_record(self, options):
+        """Returns the record for this file in the export state."""
+        photo = self.photo
+        return (unicode(photo.id),
+                unicode(photo.mod_date) if photo.mod_date else None,
+                photo.image_path, photo.originalpath, self.get_export_mode(options),
+                self.get_metadata_fingerprint(options))
+
+    def get_link_key(self, options, is_original=False):
+        """Returns a key for the content of the exported image or original.
+        Exports with the same key can share the same file."""
+        image_path = self.photo.originalpath if is_original else self.photo.image_path
+        # Sidecar files hold the meta data, so the images don't differ.
+        fingerprint = None if options.sidecar else self.get_metadata_fingerprint(options)
+        return (image_path, self.size, fingerprint)
+
+    def _copy_file(self, source_file, export_file, size, link_source, options):
+        """Copies, links, or converts source_file into export_file. With
+        --dedupe, hard links export_file to link_source instead, if set.
+
+        Returns: True if the file exists.
+        """
+        if link_source and options.dedupe and not options.link:
+            if imageutils.copy_or_link_file(link_source, export_file, options.dryrun,
+                                            True, None, options):
+                if options.iptc and not options.sidecar:
+                    # The meta data are the same as in link_source.
+                    exiftool.set_metadata_fingerprint(
+                        export_file, self.get_metadata_fingerprint(options))
+                return True
+            if options.dryrun or os.path.exists(export_file):
+                return False
+            # The file system might not support hard links.
+        return imageutils.copy_or_link_file(source_file, export_file, options.dryrun,
+                                            options.link, size, options)
 
     def get_export_keywords(self, do_face_keywords):
         """Returns the list of keywords that should be in the exported image."""
@@ -350,12 +500,25 @@ class ExportFile(object):
     
     def check_iptc_data(self, export_file, options, is_original=False, file_updated=False):
         """Tests if a file has the proper keywords and caption in the meta
-           data."""
+           data. With --sidecar, checks and updates the XMP sidecar file of
+           export_file instead."""
         if not su.getfileextension(export_file) in _EXIF_EXTENSIONS:
             return False
         messages = []
 
-        iptc_data = exiftool.get_iptc_data(export_file)
+        image_file = export_file
+        if options.sidecar:
+            export_file = exiftool.get_sidecar_file(image_file)
+        # Skip files that were in sync with the same meta data, and did not
+        # change since.
+        fingerprint = self.get_metadata_fingerprint(options)
+        if exiftool.get_metadata_fingerprints([export_file]).get(export_file) == fingerprint:
+            return False
+        if options.sidecar and not os.path.exists(export_file):
+            iptc_data = exiftool.IptcData()
+        else:
+            iptc_data = exiftool.get_iptc_data(export_file,
+                                               profile=get_read_profile(options))
          
         new_caption = imageutils.get_photo_caption(self.photo, self.container,
                                                    options.captiontemplate)
@@ -421,16 +584,51 @@ class ExportFile(object):
             new_gps or new_rating != -1 or new_rectangles != None or new_persons != None):
             su.pout(u'Updating IPTC for %s because of\n%s' % (export_file, u'\n'.join(messages)))
             if (file_updated or imageutils.should_update(options)) and not options.dryrun:
-                exiftool.update_iptcdata(export_file, new_caption, new_keywords,
-                                         new_date, new_rating, new_gps,
-                                         new_rectangles, new_persons, iptc_data.image_width,
-                                         iptc_data.image_height, hierarchical_subject=[])
+                (image_width, image_height) = (iptc_data.image_width, iptc_data.image_height)
+                if options.sidecar and new_rectangles:
+                    # The sidecar file does not know the image dimensions.
+                    image_data = exiftool.get_iptc_data(image_file,
+                                                        profile=get_read_profile(options))
+                    (image_width, image_height) = (image_data.image_width,
+                                                   image_data.image_height)
+                def updated(filepath, success):
+                    self._iptc_updated(filepath, success, fingerprint)
+                exiftool.queue_iptc_update(export_file, new_caption, new_keywords,
+                                           new_date, new_rating, new_gps,
+                                           new_rectangles, new_persons, image_width,
+                                           image_height, hierarchical_subject=[],
+                                           callback=updated)
+                if (options.link or options.iptc_masters) and not options.sidecar:
+                    # Files in the library must be updated before they get
+                    # linked or copied.
+                    exiftool.flush_iptc_updates()
+            else:
+                self.in_sync = False
             return True
+        exiftool.set_metadata_fingerprint(export_file, fingerprint)
         return False
 
-    def is_part_of(self, file_name):
+    def _iptc_updated(self, export_file, success, fingerprint):
+        """Called when a queued IPTC update was sent to exiftool."""
+        statcache.invalidate(export_file)
+        if success:
+            exiftool.set_metadata_fingerprint(export_file, fingerprint)
+        else:
+            self.in_sync = False
+
+    def add_link_sources(self, link_sources, options):
+        """Adds the exported image and original, which are in sync with the
+        library, to link_sources (see generate())."""
+        link_sources.setdefault(self.get_link_key(options), self.export_file)
+        if (options.originals and self.photo.originalpath and
+            not self.photo.rotation_is_only_edit):
+            link_sources.setdefault(self.get_link_key(options, True),
+                                    self.original_export_file)
+
+    def is_part_of(self, file_name, options):
         """Checks if <file> is part of this image."""
-        return self.export_file == file_name
+        return self.export_file == file_name or (
+            options.sidecar and exiftool.get_sidecar_file(self.export_file) == file_name)
 
 _YEAR_PATTERN_INDEX = re.compile(r'([0-9][0-9][0-9][0-9]) (.*)')
 
@@ -442,6 +640,12 @@ class ExportDirectory(object):
         self.iphoto_container = iphoto_container
         self.albumdirectory = albumdirectory
         self.files = {} # lower case file names -> ExportFile
+        # Export file -> export state record, for incremental exports.
+        self.state_records = None
+        # True if the folder is unchanged since the last incremental export.
+        self.unchanged = False
+        # Obsolete export files found by load_album().
+        self.obsolete_files = []
 
     def add_iphoto_images(self, images, options):
         """Works through an image folder tree, and builds data for exporting."""
@@ -485,25 +689,24 @@ class ExportDirectory(object):
 
     def load_album(self, options):
         """walks the album directory tree, and scans it for existing files."""
-        if not os.path.exists(self.albumdirectory):
+        if not statcache.exists(self.albumdirectory):
             su.pout("Creating folder " + self.albumdirectory)
             if not options.dryrun:
                 os.makedirs(self.albumdirectory)
+                statcache.invalidate(self.albumdirectory)
             else:
                 return
-        file_list = os.listdir(self.albumdirectory)
+        file_list = statcache.listdir(self.albumdirectory)
         if file_list is None:
             return
 
-        for f in sorted(file_list):
+        for f in file_list:
             # we won't touch some files
             if imageutils.is_ignore(f):
                 continue
 
-            album_file = unicodedata.normalize("NFC",
-                                               os.path.join(self.albumdirectory,
-                                                            f))
-            if os.path.isdir(album_file):
+            album_file = os.path.join(self.albumdirectory, f)
+            if statcache.isdir(album_file):
                 if (options.originals and
                     (f == "Originals" or (options.picasa and
                                           f == ".picasaoriginals"))):
@@ -519,13 +722,14 @@ class ExportDirectory(object):
             master_file = self.files.get(base_name.lower())
 
             # everything else must have a master, or will have to go
-            if master_file is None or not master_file.is_part_of(album_file):
-                delete_album_file(album_file, self.albumdirectory,
-                                  "Obsolete exported file", options)
+            # They might get renamed to a new export file by
+            # ExportLibrary.rename_files().
+            if master_file is None or not master_file.is_part_of(album_file, options):
+                self.obsolete_files.append(album_file)
 
     def scan_originals(self, folder, options):
         """Scan a folder of Original images, and delete obsolete ones."""
-        file_list = os.listdir(folder)
+        file_list = statcache.listdir(folder)
         if not file_list:
             return
 
@@ -534,8 +738,8 @@ class ExportDirectory(object):
             if imageutils.is_ignore(f):
                 continue
 
-            originalfile = unicodedata.normalize("NFC", os.path.join(folder, f))
-            if os.path.isdir(originalfile):
+            originalfile = os.path.join(folder, f)
+            if statcache.isdir(originalfile):
                 delete_album_file(originalfile, self.albumdirectory,
                                   "Obsolete export Originals directory",
                                   options)
@@ -547,17 +751,102 @@ class ExportDirectory(object):
 
             # everything else must have a master, or will have to go
             if (not master_file or
-                originalfile != master_file.original_export_file or
+                (originalfile != master_file.original_export_file and
+                 not (options.sidecar and master_file.original_export_file and
+                      originalfile == exiftool.get_sidecar_file(
+                          master_file.original_export_file))) or
                 master_file.photo.rotation_is_only_edit):
                 delete_album_file(originalfile, originalfile,
                                   "Obsolete Original", options)
 
-    def generate_files(self, options):
-        """Generates the files in the export location."""
+    def get_state_records(self, options):
+        """Returns a map of export file -> export state record for all files
+        in this folder."""
+        records = {}
+        for export_file in self.files.values():
+            records[export_file.export_file] = export_file.get_state_record(options)
+        return records
+
+    def generate_files(self, options, state=None, pool=None, is_aborted=None,
+                       link_sources=None):
+        """Generates the files in the export location.
+
+        Args:
+          options: processing options.
+          state: ExportState for incremental exports. Files that are unchanged
+            since the last export are skipped, and synced files are recorded.
+          pool: ThreadPool for generating the files concurrently. The output
+            for each file is written in one piece when the file is done.
+          is_aborted: function that returns True if the export was aborted.
+          link_sources: for --dedupe, see ExportFile.generate(). Files in
+            sync are added, once their meta data are updated.
+        """
         if not os.path.exists(self.albumdirectory) and not options.dryrun:
             os.makedirs(self.albumdirectory)
+            statcache.invalidate(self.albumdirectory)
+        pending = []
+        synced = []
         for f in sorted(self.files):
-            self.files[f].generate(options)
+            export_file = self.files[f]
+            if state:
+                record = self.state_records[export_file.export_file]
+                if (state.has_file(export_file.export_file, record) and
+                    export_file.exported_files_exist(options)):
+                    state.set_file(export_file.export_file, record)
+                    synced.append(export_file)
+                    continue
+            pending.append(export_file)
+
+        # Read the IPTC data of all files that will get checked with batched
+        # exiftool commands, instead of one exiftool command per file.
+        # Files that are known to hold the current meta data are not read at
+        # all.
+        iptc_files = {}
+        for export_file in pending:
+            fingerprint = export_file.get_metadata_fingerprint(options)
+            for iptc_file in export_file.get_iptc_files(options):
+                iptc_files[iptc_file] = fingerprint
+        fingerprints = exiftool.get_metadata_fingerprints(iptc_files.keys())
+        iptc_files = [f for f in sorted(iptc_files)
+                      if fingerprints.get(f) != iptc_files[f]]
+        if iptc_files:
+            exiftool.prefetch_iptc_data(iptc_files, get_read_profile(options))
+
+        def generate(export_file):
+            """Generates one file, unless the export was aborted."""
+            if is_aborted and is_aborted():
+                export_file.in_sync = False
+                return
+            if pool:
+                su.hold_output()
+            try:
+                export_file.generate(options, link_sources)
+            finally:
+                if pool:
+                    su.release_output()
+
+        if pool:
+            pool.map(generate, pending, chunksize=1)
+        else:
+            for export_file in pending:
+                generate(export_file)
+        exiftool.flush_iptc_updates()
+        exiftool.flush_iptc_cache()
+
+        all_synced = True
+        for export_file in pending:
+            if export_file.in_sync:
+                synced.append(export_file)
+            if state and export_file.in_sync:
+                state.set_file(export_file.export_file,
+                               self.state_records[export_file.export_file])
+            else:
+                all_synced = False
+        if state and all_synced:
+            state.set_directory(self.albumdirectory, self.state_records)
+        if link_sources is not None:
+            for export_file in synced:
+                export_file.add_link_sources(link_sources, options)
 
 
 class IPhotoFace(iphotodata.IPhotoContainer):
@@ -578,6 +867,10 @@ class ExportLibrary(object):
         self.albumdirectory = albumdirectory
         self.named_folders = {}
         self._abort = False
+        # ExportState, for incremental exports.
+        self._state = None
+        # Export files that don't exist yet, for rename_files().
+        self._rename_targets = None
 
     def abort(self):
         """Signals that a currently running export should be aborted as soon
@@ -692,19 +985,136 @@ class ExportLibrary(object):
 
     def load_album(self, options):
         """Loads an existing album (export folder)."""
+        # The export tree is listed once, and the listings are shared by
+        # load_album(), check_directories() and generate_files().
+        statcache.clear()
         if not os.path.exists(self.albumdirectory) and not options.dryrun:
             os.makedirs(self.albumdirectory)
 
+        if options.incremental:
+            self._state = exportstate.load_state(self.albumdirectory, options.dryrun)
         album_directories = {}
+        unchanged = 0
         for folder in sorted(self.named_folders.values()):
             if self._check_abort():
                 return
             album_directories[folder.albumdirectory] = True
+            if self._state:
+                folder.state_records = folder.get_state_records(options)
+                if self._state.is_directory_unchanged(folder.albumdirectory,
+                                                      folder.state_records):
+                    self._state.keep_directory(folder.albumdirectory)
+                    folder.unchanged = True
+                    unchanged += 1
+                    continue
             folder.load_album(options)
+        if self._state:
+            su.pout(u"%d of %d folders unchanged since the last export." % (
+                unchanged, len(self.named_folders)))
+
+        obsolete_files = []
+        for folder in sorted(self.named_folders.values()):
+            obsolete_files.extend(folder.obsolete_files)
+        for album_file in self.rename_files(obsolete_files, options):
+            delete_album_file(album_file, os.path.dirname(album_file),
+                              "Obsolete exported file", options)
 
         self.check_directories(self.albumdirectory, "", album_directories,
                                options)
 
+    def _get_rename_targets(self):
+        """Returns the export files that don't exist yet, as maps of image
+        id, of source inode, and of (source size, extension) -> export files.
+        """
+        if self._rename_targets is None:
+            by_id = {}
+            by_inode = {}
+            by_size = {}
+            for folder in self.named_folders.values():
+                if folder.unchanged:
+                    continue
+                for export_file in folder.files.values():
+                    if statcache.exists(export_file.export_file):
+                        continue
+                    image_path = export_file.photo.image_path
+                    by_id.setdefault(unicode(export_file.photo.id), []).append(export_file)
+                    if not image_path or not statcache.exists(image_path):
+                        continue
+                    by_inode.setdefault(statcache.getinode(image_path), []).append(export_file)
+                    if not export_file.size:
+                        key = (statcache.getsize(image_path),
+                               su.getfileextension(image_path).lower())
+                        by_size.setdefault(key, []).append(export_file)
+            self._rename_targets = (by_id, by_inode, by_size)
+        return self._rename_targets
+
+    def _find_rename_target(self, album_file, options):
+        """Returns the new export file that an obsolete export file should be
+        renamed to, or None.
+
+        The image of the obsolete file is known from the export state, or
+        found by the inode (for links) or the size (for copies) of its source
+        file. Only a single image may match. Copies that got meta data from
+        --iptc usually differ in size from their source, and are only found
+        through the export state. A file from the export state is only
+        renamed to a target with the same extension, exported the same way
+        (copy, link or resize) from the same source file.
+        """
+        (by_id, by_inode, by_size) = self._get_rename_targets()
+        record = self._state.get_record(album_file) if self._state else None
+        if record is not None:
+            extension = su.getfileextension(album_file).lower()
+            candidates = [c for c in by_id.get(record[0], [])
+                          if su.getfileextension(c.export_file).lower() == extension and
+                          c.get_export_mode(options) == record[4] and
+                          c.photo.image_path == record[2]]
+        else:
+            candidates = by_inode.get(statcache.getinode(album_file))
+            if not candidates:
+                candidates = by_size.get((statcache.getsize(album_file),
+                                          su.getfileextension(album_file).lower()), [])
+            if len(set([c.photo.image_path for c in candidates])) != 1:
+                return None
+        # Prefer a target in the same folder.
+        folder = os.path.dirname(album_file)
+        candidates = sorted([c for c in candidates if not c.renamed_from],
+                            key=lambda c: (os.path.dirname(c.export_file) != folder,
+                                           c.export_file))
+        return candidates[0] if candidates else None
+
+    def rename_files(self, obsolete_files, options):
+        """Renames obsolete export files to new export files of the same
+        image, e.g., after a title or an event changed, instead of deleting
+        them and exporting the image again.
+
+        Returns the obsolete files that were not renamed.
+        """
+        if not obsolete_files or not options.delete:
+            return obsolete_files
+        remaining = list(obsolete_files)
+        for album_file in obsolete_files:
+            if exiftool.is_sidecar_file(album_file) or not statcache.exists(album_file):
+                continue
+            target = self._find_rename_target(album_file, options)
+            if not target or not imageutils.should_create(options):
+                continue
+            renames = [(album_file, target.export_file)]
+            old_sidecar = exiftool.get_sidecar_file(album_file)
+            if options.sidecar and old_sidecar in remaining:
+                renames.append((old_sidecar, exiftool.get_sidecar_file(target.export_file)))
+            target.renamed_from = album_file
+            try:
+                for (old_file, new_file) in renames:
+                    su.pout(u"Renamed: %s -> %s" % (old_file, new_file))
+                    if not options.dryrun:
+                        os.rename(old_file, new_file)
+                        statcache.invalidate(old_file)
+                        statcache.invalidate(new_file)
+                    remaining.remove(old_file)
+            except OSError, ex:
+                su.perr(u"Could not rename %s: %s" % (album_file, ex))
+        return remaining
+
     def check_directories(self, directory, rel_path, album_directories,
                           options):
         """Checks an export directory for obsolete files."""
@@ -712,14 +1122,14 @@ class ExportLibrary(object):
             exclude_pattern = re.compile(su.fsdec(options.ignore))
             if exclude_pattern.match(os.path.split(directory)[1]):
                 return True
-        if not os.path.exists(directory):
+        if not statcache.exists(directory):
             return True
         contains_albums = False
-        for f in su.os_listdir_unicode(directory):
+        for f in statcache.listdir(directory):
             if self._check_abort():
                 return
             album_file = os.path.join(directory, f)
-            if os.path.isdir(album_file):
+            if statcache.isdir(album_file):
                 if f == "iPod Photo Cache":
                     su.pout("Skipping " + album_file)
                     continue
@@ -736,8 +1146,9 @@ class ExportLibrary(object):
                 # we won't touch some files
                 if imageutils.is_ignore(f):
                     continue
-                delete_album_file(album_file, directory, "Obsolete",
-                                  options)
+                if self.rename_files([album_file], options):
+                    delete_album_file(album_file, directory, "Obsolete",
+                                      options)
 
         return contains_albums
 
@@ -745,10 +1156,35 @@ class ExportLibrary(object):
         """Walks through the export tree and sync the files."""
         if not os.path.exists(self.albumdirectory) and not options.dryrun:
             os.makedirs(self.albumdirectory)
-        for ndir in sorted(self.named_folders):
-            if self._check_abort():
-                break
-            self.named_folders[ndir].generate_files(options)
+        if options.iptc > 0 and os.path.exists(self.albumdirectory):
+            exiftool.open_cache(os.path.join(self.albumdirectory, exiftool.CACHE_DB_NAME))
+        pool = None
+        if options.jobs > 1:
+            pool = ThreadPool(options.jobs)
+        # Exports that later exports of the same image get hard linked to.
+        link_sources = {} if options.dedupe and not options.link else None
+        filecopy.reset_stats()
+        try:
+            for ndir in sorted(self.named_folders):
+                if self._check_abort():
+                    break
+                folder = self.named_folders[ndir]
+                if not folder.unchanged:
+                    folder.generate_files(options, self._state, pool,
+                                          lambda: self._abort, link_sources)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            exiftool.flush_iptc_updates()
+            exiftool.close_cache()
+            statcache.clear()
+        (copied_files, copied_bytes, throughput) = filecopy.get_throughput()
+        if copied_files:
+            su.pout(u"Copied %d files (%.1f MB) at %.1f MB/s." % (
+                copied_files, copied_bytes / 1048576.0, throughput / 1048576.0))
+        if self._state and not options.dryrun:
+            self._state.save()
 
 
 def export_iphoto(library, data, excludes, options):
@@ -794,6 +1230,10 @@ def get_option_parser():
         "-a", "--albums",
         help="""Export matching regular albums. The argument
         is a regular expression. Use -a . to export all regular albums.""")
+    p.add_option(
+        "--apdb", action="store_true",
+        help="""Read the library directly from the iPhoto database
+        (Database/apdb/Library.apdb) instead of AlbumData.xml.""")
     p.add_option(
         "--aperture",
         help="""Treat library as Aperture library.""")
@@ -806,7 +1246,16 @@ def get_option_parser():
             specified number of images.''')
     p.add_option(
         "-d", "--delete", action="store_true",
-        help="Delete obsolete files that are no longer in your iPhoto library.")
+        help="""Delete obsolete files that are no longer in your iPhoto library.
+             Exported files of images that got a new name (e.g., a new
+             title) are renamed instead. Without --incremental, they are
+             matched by the size of the image, which --iptc usually
+             changes, so they are exported again.""")
+    p.add_option(
+        "--dedupe", action="store_true",
+        help="""Hard link repeated exports of the same image with the same meta
+             data (e.g., in several albums) to the first one, instead of
+             copying the image again. Has no effect with --link.""")
     p.add_option(
         "--dryrun", action="store_true",
         help="""Show what would have been done, but don't change or copy any
@@ -814,6 +1263,9 @@ def get_option_parser():
     p.add_option("-e", "--events",
                  help="""Export matching events. The argument is
                  a regular expression. Use -e . to export all events.""")
+    p.add_option("--exiftool_jobs", type='int',
+                 help="""Number of exiftool processes that read and update
+                 meta data at the same time. Default: the value of --jobs.""")
     p.add_option("--export",
                  help="""Export images and movies to specified folder.
                       Any files found in this folder that are not part of the
@@ -838,6 +1290,11 @@ def get_option_parser():
                  help="""Template for naming folders. Default: "{name}".""")
     p.add_option("--gps", action="store_true",
                  help="Process GPS location information")
+    p.add_option('--incremental', action='store_true',
+                 help="""Only check files for images that changed in iPhoto since
+                      the last export with this option. Unchanged album folders
+                      are not scanned at all. Changes made outside of Phoshare
+                      to files in the export folder may not be noticed.""")
     p.add_option('--ignore',
                  help="""Pattern for folders to ignore in the export folder (use
                       with --delete if you have extra folders folders that you 
@@ -859,6 +1316,10 @@ def get_option_parser():
     p.add_option("--iptc_masters",
                  action="store_true",
                  help="""Check and update IPTC data in the master files in the library.""")
+    p.add_option("-j", "--jobs", type='int', default=1,
+                 help="""Number of files to export at the same time. Values
+                 larger than 1 help with slow export folders, e.g. on a network
+                 drive. Default: 1.""")
     p.add_option(
       "-l", "--link", action="store_true",
       help="""Use links instead of copying files. Use with care, as changes made
@@ -877,6 +1338,9 @@ def get_option_parser():
                       help="Export original files into Originals.")
     p.add_option("--picasa", action="store_true",
                       help="Store originals in .picasaoriginals")
+    p.add_option("--nosnapshot", action="store_true",
+                 help="""Always read the iPhoto library files, instead of using the
+                 snapshot of the library data saved by the previous run.""")
     p.add_option('--picasapassword',
                  help='PicasaWeb password (optional).')
     p.add_option('--picasaweb',
@@ -890,6 +1354,12 @@ def get_option_parser():
     p.add_option("--reverse",
                  help="""Reverse sync mode - check if changes in the export folders need to
                  be sync'ed back to the library. Implies --dryrun.""")
+    p.add_option("--sidecar", action="store_true",
+                 help="""Write the meta data checked by --iptc or --iptcall into
+                 XMP sidecar files next to the exported images (IMG_0001.xmp for
+                 IMG_0001.jpg), instead of into the images. Exported images
+                 (and with --link, the images in the library) are never
+                 modified.""")
     p.add_option(
       "--size", type='int', help="""Resize images so that neither width or
       height exceeds this size. Converts all images to jpeg.""")
@@ -929,6 +1399,15 @@ def run_phoshare(cmd_args):
     if options.size and options.link:
         parser.error("Cannot use --size and --link together.")
 
+    if options.jobs < 1:
+        parser.error("--jobs needs to be at least 1.")
+    if options.exiftool_jobs is None:
+        options.exiftool_jobs = options.jobs
+    if options.exiftool_jobs < 1:
+        parser.error("--exiftool_jobs needs to be at least 1.")
+    if options.sidecar and not options.iptc:
+        parser.error("--sidecar needs --iptc or --iptcall.")
+
     if not options.iphoto:
         parser.error("Need to specify the iPhoto library with the --iphoto "
                      "option.")
@@ -958,16 +1437,26 @@ def run_phoshare(cmd_args):
             su.pout(u"Turning on dryrun mode because of --reverse option.")
         options.dryrun = True
 
+    if options.jobs > 1:
+        su.sync_output()
+    exiftool.set_session_count(options.exiftool_jobs)
     logging_handler = logging.StreamHandler()
     logging_handler.setLevel(logging.DEBUG if options.verbose else logging.INFO)
     _logger.addHandler(logging_handler)
 
-    album_xml_file = iphotodata.get_album_xmlfile(
-        su.expand_home_folder(options.iphoto))
+    if options.apdb:
+        # The library database replaces AlbumData.xml, which need not exist.
+        album_xml_file = None
+    else:
+        album_xml_file = iphotodata.get_album_xmlfile(
+            su.expand_home_folder(options.iphoto))
     album_sql_file = iphotodata.get_album_sqlfile(
         su.expand_home_folder(options.iphoto))
+    snapshot_folder = None if options.nosnapshot else iphotodata.SNAPSHOT_FOLDER
     data = iphotodata.get_iphoto_data(album_xml_file, album_sql_file, ratings=options.ratings,
-                                       verbose=options.verbose, aperture=options.aperture)
+                                       verbose=options.verbose, aperture=options.aperture,
+                                       snapshot_folder=snapshot_folder,
+                                       use_sqlite=options.apdb)
     if options.originals and options.export:
         data.load_aperture_originals()
         
@@ -14,13 +14,368 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import datetime
+import errno
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
 import unittest
 
 import phoshare.phoshare_main as pm
+import tilutil.exiftool as exiftool
+import tilutil.imageutils as imageutils
+import tilutil.statcache as statcache
+
+class _FakeContainer(object):
+    """An album or event, with what ExportDirectory needs."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def getcommentwithouthints(self):
+        return u''
+
+
+class _FakePhoto(object):
+    """An image, with what ExportFile needs."""
+
+    def __init__(self, image_id, image_path, caption):
+        self.id = image_id
+        self.image_path = image_path
+        self.caption = caption
+        self.comment = u''
+        self.date = None
+        self.mod_date = datetime.datetime(2010, 7, 4, 18, 30)
+        self.event_name = u'Event'
+        self.event_index = 1
+        self.event_index0 = u'1'
+        self.keywords = []
+        self.rating = None
+        self.gps = None
+        self.face_rectangles = []
+        self.originalpath = None
+        self.rotation_is_only_edit = False
+
+    def getfaces(self):
+        return []
+
+    def ismovie(self):
+        return False
+
 
 class PhoshareMainTest(unittest.TestCase):
     """Unit tests for phoshare_main.py code."""
 
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.library = os.path.join(self.folder, u'Masters')
+        os.mkdir(self.library)
+        self.export = os.path.join(self.folder, u'Export')
+        os.mkdir(self.export)
+        self.photos = []
+        for i in range(1, 4):
+            image_path = os.path.join(self.library, u'IMG_%04d.JPG' % (i))
+            out = open(image_path, 'wb')
+            out.write('\xff\xd8' + 'x' * (1000 * i))
+            out.close()
+            self.photos.append(_FakePhoto(unicode(i), image_path, u'Pic %d' % (i)))
+        statcache.clear()
+
+    def tearDown(self):
+        statcache.clear()
+        shutil.rmtree(self.folder)
+
+    def _get_options(self, *args):
+        (options, _) = pm.get_option_parser().parse_args(
+            ['--export', self.export, '-u', '-d'] + list(args))
+        options.exiftool_jobs = options.jobs
+        return options
+
+    def _make_library(self, options, albums):
+        """Returns an ExportLibrary for a map of album name -> photos."""
+        library = pm.ExportLibrary(self.export)
+        for (name, photos) in albums.iteritems():
+            folder = pm.ExportDirectory(name, _FakeContainer(name),
+                                        os.path.join(self.export, name))
+            folder.add_iphoto_images(photos, options)
+            library.named_folders[name] = folder
+        return library
+
+    def _export(self, options, albums):
+        """Runs an export, and returns the ExportLibrary."""
+        library = self._make_library(options, albums)
+        library.load_album(options)
+        library.generate_files(options)
+        return library
+
+    def _export_output(self, options, albums):
+        """Runs an export, and returns what it printed."""
+        old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self._export(options, albums)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+
+    def _make_same_size(self, photo, other):
+        """Gives the image of photo a different content of the same size as
+        the image of other."""
+        out = open(photo.image_path, 'wb')
+        out.write('\xff\xd8' + 'y' * (os.path.getsize(other.image_path) - 2))
+        out.close()
+
+    def _get_export_file(self, album, caption):
+        return os.path.join(self.export, album, caption + u'.jpg')
+
+    def test_generate_files(self):
+        """Tests that ExportDirectory.generate_files copies new files, and
+        marks them as in sync."""
+        options = self._get_options()
+        album = os.path.join(self.export, u'Album')
+        os.mkdir(album)
+        folder = pm.ExportDirectory(u'Album', _FakeContainer(u'Album'), album)
+        folder.add_iphoto_images(self.photos, options)
+        folder.generate_files(options)
+        for export_file in folder.files.values():
+            self.assertTrue(export_file.in_sync)
+            self.assertEquals(os.path.getsize(export_file.photo.image_path),
+                              os.path.getsize(export_file.export_file))
+        self.assertEquals([u'Pic 1.jpg', u'Pic 2.jpg', u'Pic 3.jpg'], sorted(os.listdir(album)))
+
+    def test_incremental(self):
+        """Tests that --incremental skips unchanged folders, and checks
+        folders with changed images again."""
+        options = self._get_options('--incremental')
+        self._export(options, {u'Album': self.photos})
+        export_file = self._get_export_file(u'Album', u'Pic 1')
+        os.remove(export_file)
+        os.utime(os.path.dirname(export_file), (0, 0))
+        # A changed folder signature is noticed.
+        library = self._export(options, {u'Album': self.photos})
+        self.assertFalse(library.named_folders[u'Album'].unchanged)
+        self.assertTrue(os.path.exists(export_file))
+
+        # An unchanged folder is not looked at, so a file that was changed
+        # behind phoshare's back stays changed.
+        open(export_file, 'w').close()
+        library = self._export(options, {u'Album': self.photos})
+        self.assertTrue(library.named_folders[u'Album'].unchanged)
+        self.assertEquals(0, os.path.getsize(export_file))
+
+        # A changed image is exported again.
+        self.photos[0].mod_date = datetime.datetime(2011, 1, 1)
+        mtime = os.path.getmtime(export_file) + 60
+        os.utime(self.photos[0].image_path, (mtime, mtime))
+        library = self._export(options, {u'Album': self.photos})
+        self.assertFalse(library.named_folders[u'Album'].unchanged)
+        self.assertEquals(os.path.getsize(self.photos[0].image_path),
+                          os.path.getsize(export_file))
+
+    def test_non_ascii_album(self):
+        """Tests that a byte string export folder, as given on the command
+        line, keeps album folders with non-ASCII names."""
+        album = u'Caf\xe9'
+        try:
+            album.encode(sys.getfilesystemencoding() or 'ascii')
+        except UnicodeError:
+            self.skipTest('file system encoding can\'t encode %r' % (album))
+        self.export = self.export.encode(sys.getfilesystemencoding())
+        # With --incremental, check_directories() is the first to list the
+        # unchanged export folder.
+        options = self._get_options('--incremental')
+        self._export(options, {album: self.photos})
+        output = self._export_output(options, {album: self.photos})
+        self.assertFalse('Obsolete' in output)
+        self.assertEquals([u'Pic 1.jpg', u'Pic 2.jpg', u'Pic 3.jpg'],
+                          sorted(os.listdir(os.path.join(unicode(self.export), album))))
+
+    def test_jobs(self):
+        """Tests exporting several folders with --jobs."""
+        options = self._get_options('--jobs', '3')
+        library = self._export(options, {u'Album': self.photos, u'Other': self.photos[:2]})
+        for folder in library.named_folders.values():
+            for export_file in folder.files.values():
+                self.assertTrue(export_file.in_sync)
+                self.assertTrue(os.path.exists(export_file.export_file))
+        self.assertEquals(2, len(os.listdir(os.path.join(self.export, u'Other'))))
+
+    def test_metadata_fingerprint(self):
+        """Tests that check_iptc_data does not read the meta data of a file
+        that is known to hold the current meta data."""
+        options = self._get_options('--iptc')
+        album = os.path.join(self.export, u'Album')
+        os.mkdir(album)
+        folder = pm.ExportDirectory(u'Album', _FakeContainer(u'Album'), album)
+        folder.add_iphoto_images(self.photos[:1], options)
+        export_file = folder.files.values()[0]
+        shutil.copy2(export_file.photo.image_path, export_file.export_file)
+
+        reads = []
+        def get_iptc_data(image_file, use_cache=True, profile=exiftool.READ_ALL):
+            reads.append(image_file)
+            iptc_data = exiftool.IptcData()
+            iptc_data.image_file = image_file
+            return iptc_data
+        old_get_iptc_data = exiftool.get_iptc_data
+        exiftool.get_iptc_data = get_iptc_data
+        exiftool.open_cache(os.path.join(self.export, exiftool.CACHE_DB_NAME))
+        try:
+            self.assertFalse(export_file.check_iptc_data(export_file.export_file, options))
+            self.assertEquals([export_file.export_file], reads)
+            exiftool.set_metadata_fingerprint(export_file.export_file,
+                                              export_file.get_metadata_fingerprint(options))
+            self.assertFalse(export_file.check_iptc_data(export_file.export_file, options))
+            self.assertEquals(1, len(reads))
+        finally:
+            exiftool.close_cache()
+            exiftool.get_iptc_data = old_get_iptc_data
+
+    def _check_rename(self, output):
+        """Checks that the export of Pic 1 was renamed to New 1 by an export
+        that printed output. Returns the inode of the renamed file."""
+        new_file = self._get_export_file(u'Album', u'New 1')
+        self.assertTrue(u'Renamed: %s -> %s' % (self._get_export_file(u'Album', u'Pic 1'),
+                                                new_file) in output)
+        self.assertEquals([u'New 1.jpg', u'Pic 2.jpg', u'Pic 3.jpg'],
+                          sorted(os.listdir(os.path.join(self.export, u'Album'))))
+        return os.stat(new_file).st_ino
+
+    def test_rename_by_id(self):
+        """Tests renaming an export file to the new name of its image, found
+        through the export state."""
+        options = self._get_options('--incremental')
+        self._export(options, {u'Album': self.photos})
+        # Like a copy that got new meta data: the size does not match.
+        export_file = self._get_export_file(u'Album', u'Pic 1')
+        out = open(export_file, 'ab')
+        out.write('iptc')
+        out.close()
+        inode = os.stat(export_file).st_ino
+
+        self.photos[0].caption = u'New 1'
+        output = self._export_output(options, {u'Album': self.photos})
+        self.assertEquals(inode, self._check_rename(output))
+
+    def test_rename_size_change(self):
+        """Tests that full size copies from the export state are not renamed
+        to resized exports of their images."""
+        raw_file = os.path.join(self.library, u'IMG_0001.CR2')
+        os.rename(self.photos[0].image_path, raw_file)
+        self.photos[0].image_path = raw_file
+        options = self._get_options('--incremental')
+        self._export(options, {u'Album': self.photos})
+
+        def resize_image(source, output, height_width_max):
+            out = open(output, 'wb')
+            out.write('resized')
+            out.close()
+        old_resize_image = imageutils.resize_image
+        imageutils.resize_image = resize_image
+        try:
+            # Pic 1 gets another extension, Pic 2 another name.
+            self.photos[1].caption = u'New 2'
+            output = self._export_output(self._get_options('--incremental', '--size', '100'),
+                                         {u'Album': self.photos})
+        finally:
+            imageutils.resize_image = old_resize_image
+        self.assertFalse(u'Renamed:' in output)
+        self.assertEquals([u'New 2.jpg', u'Pic 1.jpg', u'Pic 3.jpg'],
+                          sorted(os.listdir(os.path.join(self.export, u'Album'))))
+        for caption in (u'New 2', u'Pic 1'):
+            self.assertEquals('resized',
+                              open(self._get_export_file(u'Album', caption), 'rb').read())
+
+    def test_rename_by_inode(self):
+        """Tests renaming a linked export file, found through the inode of
+        its source file."""
+        # Images of the same size don't match by size.
+        self._make_same_size(self.photos[1], self.photos[0])
+        options = self._get_options('--link')
+        self._export(options, {u'Album': self.photos})
+
+        self.photos[0].caption = u'New 1'
+        output = self._export_output(options, {u'Album': self.photos})
+        self.assertEquals(os.stat(self.photos[0].image_path).st_ino,
+                          self._check_rename(output))
+
+    def test_rename_by_size(self):
+        """Tests renaming a copied export file, found through the size of its
+        source file."""
+        options = self._get_options()
+        self._export(options, {u'Album': self.photos})
+        inode = os.stat(self._get_export_file(u'Album', u'Pic 1')).st_ino
+
+        self.photos[0].caption = u'New 1'
+        output = self._export_output(options, {u'Album': self.photos})
+        self.assertEquals(inode, self._check_rename(output))
+
+    def test_rename_ambiguous(self):
+        """Tests that copies of images of the same size are not renamed, but
+        exported again."""
+        self._make_same_size(self.photos[1], self.photos[0])
+        options = self._get_options()
+        self._export(options, {u'Album': self.photos})
+
+        self.photos[0].caption = u'New 1'
+        self.photos[1].caption = u'New 2'
+        output = self._export_output(options, {u'Album': self.photos})
+        self.assertFalse(u'Renamed:' in output)
+        self.assertEquals([u'New 1.jpg', u'New 2.jpg', u'Pic 3.jpg'],
+                          sorted(os.listdir(os.path.join(self.export, u'Album'))))
+        for photo in self.photos[:2]:
+            self.assertEquals(open(photo.image_path, 'rb').read(),
+                              open(self._get_export_file(u'Album', photo.caption), 'rb').read())
+
+    def test_rename_dryrun(self):
+        """Tests that a dry run shows renames, but does not make them."""
+        self._export(self._get_options(), {u'Album': self.photos})
+
+        self.photos[0].caption = u'New 1'
+        output = self._export_output(self._get_options('--dryrun'), {u'Album': self.photos})
+        self.assertTrue(u'Renamed: %s -> %s' % (self._get_export_file(u'Album', u'Pic 1'),
+                                                self._get_export_file(u'Album', u'New 1'))
+                        in output)
+        self.assertFalse(u'Exporting' in output)
+        self.assertEquals([u'Pic 1.jpg', u'Pic 2.jpg', u'Pic 3.jpg'],
+                          sorted(os.listdir(os.path.join(self.export, u'Album'))))
+
+    def test_dedupe(self):
+        """Tests that --dedupe hard links exports of the same image with the
+        same meta data, and copies images with other meta data."""
+        options = self._get_options('--dedupe')
+        other = _FakePhoto(u'1', self.photos[0].image_path, u'Pic 1')
+        other.comment = u'Another description'
+        self._export(options, {u'A': self.photos, u'B': self.photos[:2], u'C': [other]})
+        for caption in (u'Pic 1', u'Pic 2'):
+            self.assertEquals(os.stat(self._get_export_file(u'A', caption)).st_ino,
+                              os.stat(self._get_export_file(u'B', caption)).st_ino)
+        self.assertNotEquals(os.stat(self._get_export_file(u'A', u'Pic 1')).st_ino,
+                             os.stat(self._get_export_file(u'C', u'Pic 1')).st_ino)
+        self.assertEquals(1, os.stat(self._get_export_file(u'C', u'Pic 1')).st_nlink)
+
+    def test_dedupe_link_error(self):
+        """Tests that --dedupe copies the image if it can't hard link it."""
+        links = []
+        def link(source, target):
+            links.append(target)
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        old_link = os.link
+        os.link = link
+        try:
+            library = self._export(self._get_options('--dedupe'),
+                                   {u'A': self.photos, u'B': self.photos})
+        finally:
+            os.link = old_link
+        self.assertEquals(3, len(links))
+        for export_file in library.named_folders[u'B'].files.values():
+            self.assertTrue(export_file.in_sync)
+            self.assertEquals(1, os.stat(export_file.export_file).st_nlink)
+            self.assertEquals(open(export_file.photo.image_path, 'rb').read(),
+                              open(export_file.export_file, 'rb').read())
+
     def test_region_matches(self):
         """Tests phoshare_main.region_matches."""
         max_same = 0.00000049
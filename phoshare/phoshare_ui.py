@@ -732,10 +732,13 @@ Metadata options will be disabled if exiftool is not available.""")
             self.smarts = ''
             self.ignore = []
             self.delete = False
+            self.dedupe = False # TODO
             self.update = False
             self.max_create = -1
             self.max_delete = -1
             self.max_update = -1
+            self.incremental = False
+            self.jobs = 1  # TODO
             self.link = False
             self.dryrun = False
             self.folderhints = False
@@ -751,6 +754,7 @@ Metadata options will be disabled if exiftool is not available.""")
             self.originals = False
             self.iptc = 0
             self.iptc_masters = False # TODO
+            self.sidecar = False # TODO
             self.gps = False
             self.faces = False
             self.facealbums = False
@@ -912,9 +916,10 @@ Metadata options will be disabled if exiftool is not available.""")
                 self.thread_queue.put(("done", (False, mode, str(e))))
                 return
 
-            data = iphotodata.get_iphoto_data(album_xml_file, album_sql_file)
+            data = iphotodata.get_iphoto_data(album_xml_file, album_sql_file,
+                                              snapshot_folder=iphotodata.SNAPSHOT_FOLDER)
             msg = "Version %s library with %d images" % (
-                data.applicationVersion, len(data.images))
+                data.applicationVersion, len(data.images_by_id))
             self.write(msg + '\n')
             if mode == "library":
                 # If we just need to check the library, we are done here.
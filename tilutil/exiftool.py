@@ -18,26 +18,33 @@ Created on May 29, 2009
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import atexit
 import cPickle
 import datetime
+import json
 import os
-import random
+import Queue
+import subprocess
+import sqlite3
 import sys
-import tempfile
+import threading
 import time
 
-from xml.dom import minidom
-from xml import parsers
-
 import tilutil.systemutils as su
+import tilutil.imagemetadata as imagemetadata
 import tilutil.imageutils as imageutils
+import tilutil.metadatacache as metadatacache
 
 EXIFTOOL = u"exiftool"
 _PEOPLE_PREFIX = u"People|"
 
-# The name of the file for storing cached IPTC data in a folder.
+# The name of the files in which older versions stored cached IPTC data for a
+# folder. They are imported into the metadata cache.
 CACHE_NAME = u".phoshare"
 
+# The name of the metadata cache file in the root of the export folder.
+CACHE_DB_NAME = u".phoshare_cache.db"
+
 # Bump up the version number every time incompatible changes are made to the cached data.
 # Causes all cached data to expire.
 CACHE_VERSION = "phoshare_7"
@@ -45,134 +52,212 @@ CACHE_VERSION = "phoshare_7"
 # 60 day cache
 CACHE_MAX_AGE = 60 * 24 * 60 * 60
 
+# Extension of XMP sidecar files.
+SIDECAR_EXTENSION = u"xmp"
+
+# An XMP sidecar file without any tags. exiftool adds tags to it.
+_EMPTY_SIDECAR = """<?xpacket begin='\xef\xbb\xbf' id='W5M0MpCehiHzreSzNTczkc9d'?>
+<x:xmpmeta xmlns:x='adobe:ns:meta/'>
+<rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>
+</rdf:RDF>
+</x:xmpmeta>
+<?xpacket end='w'?>
+"""
+
+# The tags that hold keywords, caption, date and location in image files, and
+# in XMP sidecar files.
+_IMAGE_TAGS = {
+    'keywords': 'IPTC:Keywords',
+    'caption': 'IPTC:Caption-Abstract',
+    'date': 'ExifIFD:DateTimeOriginal',
+    'latitude': 'Composite:GPSLatitude',
+    'longitude': 'Composite:GPSLongitude',
+}
+_SIDECAR_TAGS = {
+    'keywords': 'XMP-dc:Subject',
+    'caption': 'XMP-dc:Description',
+    'date': 'XMP-exif:DateTimeOriginal',
+    'latitude': 'XMP-exif:GPSLatitude',
+    'longitude': 'XMP-exif:GPSLongitude',
+}
+
+# Maximum number of files read by a single exiftool command.
+_PREFETCH_BATCH_SIZE = 500
+
+# Read profiles, for the profile argument of get_iptc_data() and
+# prefetch_iptc_data(). Keywords, caption, date, rating and the names of face
+# regions are always read; the flags add more tags. Combine them with "|".
+READ_BASIC = 0
+READ_GPS = 1
+# The areas of face regions, and the image size needed to write them. Without
+# it, region_names are in file order, and region_rectangles is empty.
+READ_FACES = 2
+READ_CAMERA_RAW = 4
+READ_ALL = READ_GPS | READ_FACES | READ_CAMERA_RAW
+
+# exiftool arguments to read the tags of READ_BASIC, and of each flag.
+_BASIC_READ_ARGS = ["-Keywords", "-Caption-Abstract", "-ImageDescription", "-Description",
+                    "-DateTimeOriginal", "-Rating", "-Subject", "-HierarchicalSubject",
+                    "-RegionName", "-RegionType"]
+_PROFILE_READ_ARGS = (
+    (READ_GPS, ["-GPSLatitude", "-GPSLongitude"]),
+    (READ_FACES, ["-RegionAreaX", "-RegionAreaY", "-RegionAreaW", "-RegionAreaH",
+                  "-ImageWidth", "-ImageHeight"]),
+    (READ_CAMERA_RAW, ["-AlreadyApplied"]),
+)
+
+# Guards the metadata cache, which is shared by the export worker threads.
+_cache_lock = threading.RLock()
+
+# Guards the creation of the shared ExifToolSession.
+_session_lock = threading.Lock()
+
+# Updates queued by queue_iptc_update(), as (file path, exiftool arguments,
+# callback).
+_queued_updates = []
+_update_lock = threading.Lock()
+
+# Number of queued updates that triggers a flush_iptc_updates().
+_MAX_QUEUED_UPDATES = 200
+
 class _IptcCacheEntry(object):
-    """Cached IPTC data for a file."""
-
-    def __init__(self, file_path, iptc_data):
-        self.file_path = file_path
-        self.iptc_data = iptc_data
-        file_stat = os.stat(file_path)
-        self.st_ino = file_stat.st_ino
-        self.st_mtime = file_stat.st_mtime
-        self.st_size = file_stat.st_size
-        self.created = time.time()
-
-    def get_iptc_data(self):
-        """Gets the cached IptcData object."""
-        return self.iptc_data
-
-    def is_expired(self):
-        """Tests if the cached IptcData are expired (too old)."""
-        now = time.time()
-        # Add a 20% jitter to the cache to avoid expiring all entires at the same time.
-        if now - self.created > CACHE_MAX_AGE - CACHE_MAX_AGE * 0.2 * random.random():
-            su.pout("Cached data for %s too old, ignoring" % (self.file_path))
-            return True
-        return False
-    
-    def is_current(self):
-        """Tests if the cached IPTC data are still current."""
-        if self.is_expired():
-            return False
-        try:
-            file_stat = os.stat(self.file_path)
-            if self.st_ino != file_stat.st_ino:
-                # su.pout(u"Inode of cached data for %s changed, ignoring" % (self.file_path))
-                return False
-            if self.st_mtime != file_stat.st_mtime:
-                #su.pout(u"Modification time of cached data for %s changed, ignoring" % (
-                #    self.file_path))
-                return False
-            if self.st_size != file_stat.st_size:
-                #su.pout(u"Size of cached data for %s changed, ignoring" % (self.file_path))
-                return False
-            return True
-        except OSError:
-            return False
-        
+    """Cached IPTC data for a file, as stored in .phoshare files. Attributes:
+    file_path, iptc_data, st_ino, st_mtime, st_size, created."""
+
 
 class _IptcCache(object):
-    """Cached IPTC data for files in a folder."""
-
-    def __init__(self, folder):
-        self.cache = {}
-        self.folder = folder
-        self.cache_version = CACHE_VERSION
-
-    def _save(self):
-        """Saves the cache data into the .phoshare file in the current folder."""
-        save_path = os.path.join(self.folder, CACHE_NAME)
-        out = open(save_path, 'w')
-        cPickle.dump(self, out)
-        out.close()
+    """Cached IPTC data for files in a folder, as stored in .phoshare files.
+    Attributes: folder, cache_version, and cache, a map of file path ->
+    _IptcCacheEntry."""
 
-    def get_iptc_data(self, image_path):
-        """Gets IptcData for an image, either from cache, or by running
-           exiftool. Returns an empty IptcData object if iptc data could
-           not be read from file."""
-        iptc_cache_entry = self.cache.get(image_path)
-        if iptc_cache_entry and not iptc_cache_entry.is_current():
-            iptc_cache_entry = None
-        if not iptc_cache_entry:
-            su.pout(u"Running exiftool for %s" % (image_path))
-            iptc_data = _get_iptc_data_exiftool(image_path)
-            iptc_cache_entry = _IptcCacheEntry(image_path, iptc_data)
-            self.cache[image_path] = iptc_cache_entry
-            self._save()
-        return iptc_cache_entry.get_iptc_data()
-
-    def clear_expired(self):
-        """Walks through the cache content, and removes any expired entries. Persists any changes.
-        """
-        has_changes = False
-        for (image_file, iptc_data) in self.cache.items():
-            if iptc_data.is_expired():
-                del self.cache[image_file]
-                has_changes = True
-        if has_changes:
-            self._save()
-
-
-def _get_iptc_cache(image_file):
-    """Gets the _IptcCache for the folder of image_file."""
-    folder = os.path.split(image_file)[0]
-    if _get_iptc_cache.cache and _get_iptc_cache.cache.folder == folder:
-        return _get_iptc_cache.cache
-    
-    # We have no cached data, or there are for the wrong folder.
-    _get_iptc_cache.cache = None
-    save_path = os.path.join(folder, CACHE_NAME)
-    if os.path.exists(save_path):
-        cache_file = None
-        try:
-            cache_file = open(save_path)
-            _get_iptc_cache.cache = cPickle.load(cache_file)
-        except Exception, ex:
-            su.perr(u"Could not read Phoshare IPTC cache data from %s: %s." % (
-                save_path, unicode(ex)))
 
-        if cache_file:
-            cache_file.close()
+def get_sidecar_file(image_file):
+    """Returns the path of the XMP sidecar file for an image file, e.g.
+    IMG_0001.xmp for IMG_0001.jpg."""
+    return os.path.splitext(image_file)[0] + u'.' + SIDECAR_EXTENSION
 
-        # Make sure the folder matches.
-        if _get_iptc_cache.cache and _get_iptc_cache.cache.folder != folder:
-            _get_iptc_cache.cache = None
+def is_sidecar_file(file_path):
+    """Tests if file_path is an XMP sidecar file."""
+    return su.getfileextension(file_path) == SIDECAR_EXTENSION
 
+def open_cache(cache_file):
+    """Opens the metadata cache that get_iptc_data() and prefetch_iptc_data()
+    use. Without an open cache, they always run exiftool."""
+    close_cache()
+    try:
+        cache = metadatacache.MetadataCache(cache_file, CACHE_VERSION, CACHE_MAX_AGE)
+    except sqlite3.Error, ex:
+        su.perr(u"Could not open Phoshare metadata cache %s: %s." % (
+            cache_file, unicode(ex)))
+        return
+    with _cache_lock:
+        _get_cache.cache = cache
+        _get_cache.checked_folders = set()
+
+def close_cache():
+    """Saves and closes the metadata cache, if one is open."""
+    with _cache_lock:
+        cache = _get_cache.cache
+        _get_cache.cache = None
+    if cache:
+        cache.close()
+
+def flush_iptc_cache():
+    """Saves new entries of the metadata cache. Call when done with a folder."""
+    cache = _get_cache.cache
+    if cache:
+        cache.flush()
+
+def get_metadata_fingerprints(image_files):
+    """Returns a map of image file -> fingerprint, as stored by
+    set_metadata_fingerprint(), for the files that did not change since."""
+    cache = _get_cache()
+    if not cache:
+        return {}
+    return cache.get_fingerprints(image_files)
+
+def set_metadata_fingerprint(image_file, fingerprint):
+    """Records that image_file, as it is now, holds the meta data described by
+    fingerprint. Does nothing without an open metadata cache."""
+    cache = _get_cache()
+    if cache:
+        cache.put_fingerprint(image_file, fingerprint)
+
+def _get_cache(folders=()):
+    """Returns the open metadata cache, or None. Imports the .phoshare files of
+    older versions in folders the first time they are seen."""
+    with _cache_lock:
+        cache = _get_cache.cache
+        if cache:
+            for folder in folders:
+                if folder not in _get_cache.checked_folders:
+                    _get_cache.checked_folders.add(folder)
+                    _import_folder_cache(cache, folder)
+        return cache
+
+# The open MetadataCache.
+_get_cache.cache = None
+# Folders that have been checked for .phoshare files.
+_get_cache.checked_folders = set()
+
+def _import_folder_cache(cache, folder):
+    """Imports the current entries of the .phoshare file in folder into the
+    metadata cache, unless that file has been imported already."""
+    save_path = os.path.join(folder, CACHE_NAME)
+    try:
+        mtime = os.stat(save_path).st_mtime
+    except OSError:
+        return
+    if cache.is_imported(folder, mtime):
+        return
+    folder_cache = None
+    try:
+        cache_file = open(save_path, 'rb')
         try:
-            if _get_iptc_cache.cache and _get_iptc_cache.cache.cache_version != CACHE_VERSION:
-                _get_iptc_cache.cache = None
-        except AttributeError:
-            su.perr(u"Found non-cache data in %s, ignoring" % (folder))
-            _get_iptc_cache.cache = None
-
-        if _get_iptc_cache.cache:
-            _get_iptc_cache.cache.clear_expired()
-    if not _get_iptc_cache.cache:
-        _get_iptc_cache.cache = _IptcCache(folder)
-    return _get_iptc_cache.cache
-
-# Most recently used cache data.
-_get_iptc_cache.cache = None
+            folder_cache = cPickle.load(cache_file)
+        finally:
+            cache_file.close()
+    except Exception, ex:
+        # Not marked as imported, so that a later version can try again.
+        su.perr(u"Could not read Phoshare IPTC cache data from %s: %s." % (
+            save_path, unicode(ex)))
+        return
+    if (isinstance(folder_cache, _IptcCache) and
+        getattr(folder_cache, 'cache_version', None) == CACHE_VERSION):
+        count = 0
+        for entry in folder_cache.cache.itervalues():
+            if metadatacache.get_file_signature(entry.file_path) == (
+                entry.st_ino, entry.st_mtime, entry.st_size):
+                cache.put(entry.file_path, entry.iptc_data, entry.created)
+                count += 1
+        su.pout(u"Imported cached IPTC data for %d files from %s" % (count, save_path))
+    cache.set_imported(folder, mtime)
+
+def prefetch_iptc_data(image_files, profile=READ_ALL):
+    """Reads the IPTC data for a list of image files into the metadata cache,
+    so that later calls to get_iptc_data() don't need to run exiftool for each
+    file. Uses one exiftool command for up to _PREFETCH_BATCH_SIZE files."""
+    cache = _get_cache(set([os.path.split(f)[0] for f in image_files]))
+    if not cache:
+        return
+    cached = cache.get_many(image_files)
+    missing = []
+    for image_file in image_files:
+        if image_file not in cached:
+            missing.append(image_file)
+        elif not _has_profile(cached[image_file], profile):
+            # Read what the cache had as well, so that runs with different
+            # options don't replace each others entries.
+            profile |= _get_profile(cached[image_file])
+            missing.append(image_file)
+    if not missing:
+        return
+    su.pout(u"Reading IPTC data from %d files" % (len(missing)))
+    for i in xrange(0, len(missing), _PREFETCH_BATCH_SIZE):
+        batch = missing[i:i + _PREFETCH_BATCH_SIZE]
+        iptc_data = _read_iptc_data(batch, profile)
+        cache.put_many([(f, iptc_data[su.unicode_string(f)]) for f in batch
+                        if su.unicode_string(f) in iptc_data])
 
 def check_exif_tool(msgstream=sys.stderr):
     """Tests if a compatible version of exiftool is available."""
@@ -184,7 +269,7 @@ def check_exif_tool(msgstream=sys.stderr):
             print >> msgstream, """
 Please upgrade to version 8.61 or newer of exiftool. You can download a copy
 from http://www.sno.phy.queensu.ca/~phil/exiftool/. Phosare wants to use
-the new -X option to read IPTC data in XML format."""
+the -j and -G1 options to read IPTC data in JSON format."""
             return False
         return True
     except StandardError:
@@ -195,20 +280,299 @@ copy from http://www.sno.phy.queensu.ca/~phil/exiftool/.
 """ % (EXIFTOOL)
     return False
 
-def _get_xml_nodevalues(xml_data, tag, data):
-    """Extracts one or more node values from an XML element, and appends
-       it to the data array. Node values can be directly below the element,
-       or a list in <rdf:Bag><rfd:li>...</rfd:li>...</rdf:Bag> format.
+# Maximum number of commands sent to exiftool before reading the output. Keeps
+# the output of a batch small enough to not fill up the pipe.
+_MAX_BATCH_SIZE = 50
+
+class ExifToolSession(object):
+    """A long running exiftool process, started with "-stay_open True -@ -".
+
+    Each command is sent as a list of arguments, one per line, followed by
+    "-executeNNN". exiftool answers with the output of the command, followed
+    by a "{readyNNN}" line. This saves starting a new exiftool (Perl) process
+    for every image. If exiftool dies, it is restarted for the next command.
+    """
+
+    def __init__(self, exiftool=None):
+        self._exiftool = exiftool if exiftool else EXIFTOOL
+        self._process = None
+        self._count = 0
+        # Commands from different threads are sent one at a time.
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """Starts the exiftool process."""
+        self._process = subprocess.Popen(
+            [self._exiftool, '-stay_open', 'True', '-@', '-'], shell=False,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def _stop(self):
+        """Stops the exiftool process, killing it if it does not respond."""
+        process = self._process
+        self._process = None
+        if process is None:
+            return
+        try:
+            if process.poll() is None:
+                process.stdin.write('-stay_open\nFalse\n')
+                process.stdin.flush()
+            process.stdin.close()
+            process.stdout.read()
+            process.wait()
+        except (IOError, OSError):
+            try:
+                process.kill()
+                process.wait()
+            except OSError:
+                pass
+
+    def _write(self, text):
+        """Writes text to exiftool. Errors show up as end of file when reading
+        the output."""
+        try:
+            self._process.stdin.write(text)
+            self._process.stdin.flush()
+        except (IOError, OSError):
+            pass
+
+    def _run(self, commands):
+        """Sends a list of commands, and returns the output lines of each. The
+        list is shorter than commands if exiftool died."""
+        if self._process is None or self._process.poll() is not None:
+            self._stop()
+            self._start()
+        lines = []
+        readies = []
+        for args in commands:
+            self._count += 1
+            for arg in args:
+                if isinstance(arg, unicode):
+                    arg = arg.encode('utf-8')
+                lines.append(arg)
+            lines.append('-execute%d' % (self._count))
+            readies.append('{ready%d}' % (self._count))
+        text = '\n'.join(lines) + '\n'
+        writer = None
+        if len(commands) > 1:
+            # exiftool stops reading commands while its output is not read, so
+            # we write in a separate thread.
+            writer = threading.Thread(target=self._write, args=(text,))
+            writer.daemon = True
+            writer.start()
+        else:
+            self._write(text)
+        results = []
+        try:
+            for ready in readies:
+                data = []
+                while True:
+                    line = self._process.stdout.readline()
+                    if not line:
+                        # exiftool died.
+                        return results
+                    line = line.strip()
+                    if line == ready:
+                        break
+                    data.append(line.replace("\r", "\n"))
+                results.append(data)
+        except (IOError, OSError):
+            pass
+        finally:
+            if len(results) < len(readies):
+                # Stop exiftool, so that the writer can't block forever.
+                self._stop()
+            if writer:
+                writer.join()
+        return results
+
+    def execute_many(self, commands):
+        """Executes a list of exiftool commands, and returns a list with the
+        output of each command as a single string.
+
+        The commands are sent in batches, so that exiftool can work on the
+        next command while we read the output of the previous one. If exiftool
+        dies, it is restarted, and the failed command is tried once more.
+
+        Args:
+          commands: list of lists of exiftool arguments, without the exiftool
+            command itself. None of the arguments can contain a newline.
+        """
+        outputs = []
+        # Index of the command that was already retried.
+        retried = -1
+        with self._lock:
+            while len(outputs) < len(commands):
+                batch = commands[len(outputs):len(outputs) + _MAX_BATCH_SIZE]
+                results = self._run(batch)
+                outputs.extend(["\n".join(data) for data in results])
+                if len(results) == len(batch):
+                    continue
+                self._stop()
+                if retried == len(outputs):
+                    su.perr(u"exiftool failed for: %s" % (u' '.join(
+                        [su.unicode_string(arg) for arg in commands[retried]])))
+                    outputs.append("")
+                else:
+                    su.perr(u"exiftool stopped unexpectedly - restarting it.")
+                    retried = len(outputs)
+        return outputs
+
+    def execute(self, args):
+        """Executes an exiftool command, and returns all output in a single
+        string, like su.execandcombine() does.
+
+        Args:
+          args: exiftool arguments, without the exiftool command itself. None
+            of the arguments can contain a newline.
+        """
+        return self.execute_many([args])[0]
+
+    def close(self):
+        """Stops the exiftool process."""
+        with self._lock:
+            self._stop()
+
+
+class ExifToolPool(object):
+    """A pool of ExifToolSessions, for running several exiftool processes at
+    the same time. Has the same methods as ExifToolSession.
+
+    Each session has its own worker thread and queue of commands. The
+    commands of execute_many() are spread over the workers, and their output
+    is returned in the order of the commands. Commands that end with the same
+    argument (usually the file they work on) go to the same worker, so that
+    they run in order. execute() uses the worker with the fewest queued
+    commands.
     """
-    for xml_element in xml_data.getElementsByTagName(tag):
-        first_child = xml_element.firstChild
-        if (first_child and first_child.nodeValue and first_child.nodeValue != "\n"):
-            data.append(first_child.nodeValue)
-        for xml_bag in xml_element.getElementsByTagName("rdf:Bag"):
-            for xml_li in xml_bag.getElementsByTagName("rdf:li"):
-                first_child = xml_li.firstChild
-                if first_child:
-                    data.append(first_child.nodeValue)
+
+    def __init__(self, size, exiftool=None):
+        self._sessions = [ExifToolSession(exiftool) for _ in range(size)]
+        self._queues = [Queue.Queue() for _ in range(size)]
+        # Number of commands queued for each worker.
+        self._queued = [0] * size
+        self._lock = threading.Lock()
+        self._workers = []
+        for i in range(size):
+            worker = threading.Thread(target=self._work, args=(i,))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self, index):
+        """Runs the jobs from the queue of a worker, until it gets None. An
+        exception from a job is passed back to its caller, and the worker
+        keeps running."""
+        session = self._sessions[index]
+        while True:
+            job = self._queues[index].get()
+            if job is None:
+                break
+            (commands, outputs, errors, done) = job
+            try:
+                outputs.extend(session.execute_many(commands))
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                with self._lock:
+                    self._queued[index] -= len(commands)
+                done.set()
+
+    def _submit(self, index, commands):
+        """Queues a list of commands for a worker. Returns a function that
+        waits for them, and returns their outputs, or raises the exception
+        they failed with."""
+        outputs = []
+        errors = []
+        done = threading.Event()
+        with self._lock:
+            self._queued[index] += len(commands)
+        self._queues[index].put((commands, outputs, errors, done))
+
+        def wait():
+            done.wait()
+            if errors:
+                (error_type, error, traceback) = errors[0]
+                raise error_type, error, traceback
+            return outputs
+        return wait
+
+    def execute_many(self, commands):
+        """Executes a list of exiftool commands on all workers, and returns a
+        list with the output of each command as a single string."""
+        if not commands:
+            return []
+        # Worker index for each command, round robin for each new last
+        # argument.
+        assignments = []
+        workers = {}
+        for args in commands:
+            key = args[-1] if args else None
+            if key not in workers:
+                workers[key] = len(workers) % len(self._sessions)
+            assignments.append(workers[key])
+        jobs = []
+        for index in range(len(self._sessions)):
+            worker_commands = [command for (command, assigned)
+                               in zip(commands, assignments) if assigned == index]
+            if worker_commands:
+                jobs.append((index, self._submit(index, worker_commands)))
+        results = {}
+        for (index, wait) in jobs:
+            results[index] = iter(wait())
+        return [results[index].next() for index in assignments]
+
+    def execute(self, args):
+        """Executes an exiftool command on the least busy worker, and returns
+        all output in a single string."""
+        with self._lock:
+            index = self._queued.index(min(self._queued))
+        return self._submit(index, [args])()[0]
+
+    def close(self):
+        """Stops the workers and their exiftool processes."""
+        for queue in self._queues:
+            queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        for session in self._sessions:
+            session.close()
+
+
+def set_session_count(count):
+    """Sets the number of exiftool processes that run at the same time.
+    Values larger than 1 use an ExifToolPool."""
+    close_session()
+    with _session_lock:
+        _get_session.count = count
+
+def _get_session():
+    """Gets the ExifToolSession or ExifToolPool that is shared by all
+    callers."""
+    with _session_lock:
+        if _get_session.session is None:
+            if _get_session.count > 1:
+                _get_session.session = ExifToolPool(_get_session.count)
+            else:
+                _get_session.session = ExifToolSession()
+        return _get_session.session
+
+# The shared ExifToolSession or ExifToolPool.
+_get_session.session = None
+# The number of exiftool processes, set by set_session_count().
+_get_session.count = 1
+
+def close_session():
+    """Sends any queued updates, saves the metadata cache, and stops the
+    shared exiftool process, if there is one."""
+    flush_iptc_updates()
+    flush_iptc_cache()
+    with _session_lock:
+        session = _get_session.session
+        _get_session.session = None
+    if session:
+        session.close()
+
+atexit.register(close_session)
 
 class IptcData(object):
     """Container for Image IPTC data."""
@@ -227,6 +591,8 @@ class IptcData(object):
         self.image_height = -1
         self.hierarchical_subject = []
         self.already_applied = ""
+        # The tags that were read, see READ_ALL.
+        self.read_profile = READ_ALL
 
     def has_data(self):
         """Tests if there are real IPTC data."""
@@ -262,97 +628,168 @@ class IptcData(object):
         return keywords
 
 
-def get_iptc_data(image_file, use_cache=True):
-    """Get IPTC data for a file as an IptcData object. Can use cached data from .phoshare files."""
-    iptc_data = None
-    if use_cache:
-        iptc_cache = _get_iptc_cache(image_file)
-        iptc_data = iptc_cache.get_iptc_data(image_file)
+def get_iptc_data(image_file, use_cache=True, profile=READ_ALL):
+    """Get IPTC data for a file as an IptcData object. Can use cached data from
+    the metadata cache, if it was read with all tags of profile."""
+    cache = _get_cache([os.path.split(image_file)[0]]) if use_cache else None
+    if cache:
+        cached = cache.get_many([image_file])
+        if image_file in cached and _has_profile(cached[image_file], profile):
+            iptc_data = cached[image_file]
+        else:
+            if image_file in cached:
+                profile |= _get_profile(cached[image_file])
+            su.pout(u"Reading IPTC data from %s" % (image_file))
+            iptc_data = _get_iptc_data_file(image_file, profile)
+            cache.put(image_file, iptc_data)
     else:
-        iptc_data = _get_iptc_data_exiftool(image_file)
+        iptc_data = _get_iptc_data_file(image_file, profile)
     if not iptc_data:
         iptc_data = IptcData()
     return iptc_data
 
-
-def _get_iptc_data_exiftool(image_file):
-    """Returns IptcData for an image file using exiftool."""
-    args = [EXIFTOOL, "-X", "-m", "-q", "-q", '-c', '%.6f', "-Keywords", "-Caption-Abstract",
-            "-ImageDescription", "-DateTimeOriginal", "-Rating", "-GPSLatitude",
-            "-Subject", "-GPSLongitude", "-RegionName", "-RegionType",
-            "-RegionAreaX", "-RegionAreaY", "-RegionAreaW", "-RegionAreaH",
-            "-ImageWidth", "-ImageHeight", "-HierarchicalSubject", "-AlreadyApplied", image_file ]
-    output = su.execandcombine(args)
-    if not output:
-        return None
-
-    iptc_data = None
+def _get_profile(iptc_data):
+    """Returns the read profile of IptcData from the cache. Files that could
+    not be read, and entries of older versions, have all tags."""
+    return getattr(iptc_data, 'read_profile', READ_ALL) if iptc_data else READ_ALL
+
+def _has_profile(iptc_data, profile):
+    """Tests if IptcData from the cache has all tags of profile."""
+    return _get_profile(iptc_data) & profile == profile
+
+def _get_iptc_data_file(image_file, profile=READ_ALL):
+    """Returns IptcData for an image file, or None if it could not be read."""
+    iptc_data = _read_iptc_data([image_file], profile)
+    return iptc_data.values()[0] if iptc_data else None
+
+def _read_iptc_data(image_files, profile=READ_ALL):
+    """Reads IPTC data for a list of image files. Uses the built-in reader in
+    imagemetadata.py for JPEG and TIFF files, and a single exiftool command
+    for all other files, and for files the built-in reader can't handle.
+    exiftool only reads the tags of profile; the built-in reader always reads
+    all. Returns a map of image file -> IptcData, with an entry for each file
+    that could be read."""
+    result = {}
+    exiftool_files = []
+    for image_file in image_files:
+        tags = imagemetadata.read_tags(image_file) if imagemetadata.can_read(image_file) else None
+        if tags is None:
+            exiftool_files.append(image_file)
+        else:
+            image_file = su.unicode_string(image_file)
+            result[image_file] = _make_iptc_data(image_file, tags, READ_ALL)
+    if exiftool_files:
+        result.update(_read_iptc_data_exiftool(exiftool_files, profile))
+    return result
+
+def _read_iptc_data_exiftool(image_files, profile=READ_ALL):
+    """Reads the tags of profile for a list of image files with a single
+    exiftool command, or one command for each exiftool process of an
+    ExifToolPool. Returns a map of image file -> IptcData, with an entry for
+    each file that exiftool could read."""
+    args = ["-j", "-G1", "-m", "-q", "-q", '-c', '%.6f'] + _BASIC_READ_ARGS
+    for (flag, flag_args) in _PROFILE_READ_ARGS:
+        if profile & flag:
+            args.extend(flag_args)
+    batch_size = -(-len(image_files) // _get_session.count)
+    commands = [args + image_files[i:i + batch_size]
+                for i in xrange(0, len(image_files), batch_size)]
+    result = {}
+    for output in _get_session().execute_many(commands):
+        for entry in _parse_json_output(output):
+            image_file = entry.pop('SourceFile', None)
+            if image_file:
+                result[image_file] = _make_iptc_data(image_file, _get_json_tags(entry),
+                                                     profile)
+    return result
+
+def _parse_json_output(output):
+    """Parses the output of exiftool -j, and returns the list of objects in
+    it, one per file. Numbers are kept as strings, so that they don't lose
+    their formatting."""
+    # Errors for single files show up before the JSON data.
+    start = output.find('[')
+    if start == -1:
+        return []
     try:
-        xml_data = minidom.parseString(output)
-        for xml_desc in xml_data.getElementsByTagName('rdf:Description'):
-            iptc_data = IptcData()
-            iptc_data.rating = 0
-            iptc_data.image_file = xml_desc.getAttribute("rdf:about")
-            
-            iptc_data.keywords = []
-            _get_xml_nodevalues(xml_desc, 'IPTC:Keywords', iptc_data.keywords)
-            _get_xml_nodevalues(xml_desc, 'XMP-lr:HierarchicalSubject',
-                                iptc_data.hierarchical_subject)
-            # Keywords can also be stored as Subject in the XMP directory
-            _get_xml_nodevalues(xml_desc, 'XMP:Subject', iptc_data.keywords)
-            for xml_caption in xml_desc.getElementsByTagName('IPTC:Caption-Abstract'):
-                if xml_caption.firstChild:
-                    iptc_data.caption = xml_caption.firstChild.nodeValue
-            if not iptc_data.caption:
-                for xml_caption in xml_desc.getElementsByTagName('IFD0:ImageDescription'):
-                    if xml_caption.firstChild:
-                        iptc_data.caption = xml_caption.firstChild.nodeValue
-            _parse_datetime_original(xml_desc, iptc_data, image_file)
-            for xml_element in xml_desc.getElementsByTagName('XMP-xmp:Rating'):
-                if xml_element.firstChild:
-                    iptc_data.rating = int(xml_element.firstChild.nodeValue)
-            _parse_gps(xml_desc, iptc_data)
-                
-            for xml_element in xml_desc.getElementsByTagName('File:ImageWidth'):
-                if xml_element.firstChild:
-                    iptc_data.image_width = int(xml_element.firstChild.nodeValue)
-            for xml_element in xml_desc.getElementsByTagName('File:ImageHeight'):
-                if xml_element.firstChild:
-                    iptc_data.image_height = int(xml_element.firstChild.nodeValue)
-            for xml_element in xml_desc.getElementsByTagName('XMP-crs:AlreadyApplied'):
-                if xml_element.firstChild:
-                    iptc_data.already_applied = xml_element.firstChild.nodeValue
-
-            #string_rectangles = []
-            #_get_xml_nodevalues(xml_desc, 'XMP-MP:RegionRectangle', string_rectangles)
-            #for string_rectangle in string_rectangles:
-            #    rectangle = []
-            #    for c in string_rectangle.split(','):
-            #        rectangle.append(float(c))
-            #    iptc_data.region_rectangles.append(rectangle)
-            #_get_xml_nodevalues(xml_desc, 'XMP-MP:RegionPersonDisplayName', 
-            #                    iptc_data.region_names)
-
-            # Handle Region tags
-            _parse_regions(xml_desc, iptc_data)
-            break
-
-        xml_data.unlink()
-      
-    except parsers.expat.ExpatError, ex:
+        (entries, _) = _json_decoder.raw_decode(output, start)
+    except ValueError, ex:
         su.perr('Could not parse exiftool output %s: %s' % (output, ex))
-
+        return []
+    return entries if isinstance(entries, list) else []
+
+_json_decoder = json.JSONDecoder(encoding='utf-8', parse_float=unicode,
+                                 parse_int=unicode)
+
+def _get_json_tags(entry):
+    """Returns the tags of an object of exiftool -j -G1 output as a map of tag
+    name (like "IPTC:Keywords") -> list of values."""
+    tags = {}
+    for (name, value) in entry.iteritems():
+        if not isinstance(value, list):
+            value = [value]
+        tags[name] = [_get_json_string(v) for v in value]
+    return tags
+
+def _get_json_string(value):
+    """Converts a value of exiftool -j output to a string."""
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, bool):
+        return u'True' if value else u'False'
+    return su.unicode_string(value)
+
+def _make_iptc_data(image_file, tags, profile=READ_ALL):
+    """Creates IptcData for an image file or XMP sidecar file from a map of
+    exiftool tag name -> list of values. Only looks at the tags of
+    profile."""
+    iptc_data = IptcData()
+    iptc_data.rating = 0
+    iptc_data.image_file = image_file
+    iptc_data.read_profile = profile
+    sidecar = is_sidecar_file(image_file)
+    tag_names = _SIDECAR_TAGS if sidecar else _IMAGE_TAGS
+
+    iptc_data.keywords = list(tags.get(tag_names['keywords'], []))
+    iptc_data.hierarchical_subject = list(tags.get('XMP-lr:HierarchicalSubject', []))
+    captions = tags.get(tag_names['caption'])
+    if not sidecar:
+        # Keywords can also be stored as Subject in the XMP directory
+        iptc_data.keywords.extend(tags.get('XMP:Subject', []))
+        captions = captions or tags.get('IFD0:ImageDescription')
+    if captions:
+        iptc_data.caption = captions[-1]
+    _parse_datetime_original(tags.get(tag_names['date'], []), iptc_data, image_file,
+                             sidecar)
+    for value in tags.get('XMP-xmp:Rating', []):
+        iptc_data.rating = int(value)
+    if profile & READ_GPS:
+        _parse_gps(tags.get(tag_names['latitude']), tags.get(tag_names['longitude']),
+                   iptc_data)
+
+    if profile & READ_FACES:
+        for value in tags.get('File:ImageWidth', []):
+            iptc_data.image_width = int(value)
+        for value in tags.get('File:ImageHeight', []):
+            iptc_data.image_height = int(value)
+        # Handle Region tags
+        _parse_regions(tags, iptc_data)
+    elif tags.get('XMP-mwg-rs:RegionType'):
+        iptc_data.region_names = list(tags.get('XMP-mwg-rs:RegionName', []))
+    if profile & READ_CAMERA_RAW:
+        for value in tags.get('XMP-crs:AlreadyApplied', []):
+            iptc_data.already_applied = value
     return iptc_data
 
 
-def _parse_datetime_original(xml_desc, iptc_data, image_file):
-    """Parses the DateTimeOriginal data from exiftool output."""
-    for xml_element in xml_desc.getElementsByTagName('ExifIFD:DateTimeOriginal'):
-        if not xml_element.firstChild:
-            continue
+def _parse_datetime_original(values, iptc_data, image_file, has_time_zone=False):
+    """Parses the DateTimeOriginal data from exiftool output. XMP dates can
+    have a time zone, which is ignored."""
+    for value in values:
+        if has_time_zone:
+            value = value[:19]
         try:
-            date_time_original = time.strptime(
-                xml_element.firstChild.nodeValue, '%Y:%m:%d %H:%M:%S')
+            date_time_original = time.strptime(value, '%Y:%m:%d %H:%M:%S')
             iptc_data.date_time_original = datetime.datetime(
                 date_time_original.tm_year,
                 date_time_original.tm_mon,
@@ -362,40 +799,26 @@ def _parse_datetime_original(xml_desc, iptc_data, image_file):
                 date_time_original.tm_sec)
         except ValueError, _ve:
             su.perr('Exiftool returned an invalid date %s for %s - ignoring.' % (
-                xml_element.firstChild.nodeValue, image_file))
+                value, image_file))
 
 
-def _parse_gps(xml_desc, iptc_data):
+def _parse_gps(latitudes, longitudes, iptc_data):
     """Parses the GPS data from exiftool output."""
-    gps_latitude = None
-    gps_longitude = None
-    for xml_element in xml_desc.getElementsByTagName('Composite:GPSLatitude'):
-        if xml_element.firstChild:
-            gps_latitude = xml_element.firstChild.nodeValue
-    for xml_element in xml_desc.getElementsByTagName('Composite:GPSLongitude'):
-        if xml_element.firstChild:
-            gps_longitude = xml_element.firstChild.nodeValue
-    if gps_latitude and gps_longitude:
-        iptc_data.gps = imageutils.GpsLocation().from_composite(gps_latitude, 
-                                                                gps_longitude)
+    if latitudes and longitudes:
+        iptc_data.gps = imageutils.GpsLocation().from_composite(latitudes[-1],
+                                                                longitudes[-1])
 
         
-def _parse_regions(xml_desc, iptc_data):
-    """Parses XML region type data into IptcData."""
-    region_types = []
-    _get_xml_nodevalues(xml_desc, 'XMP-mwg-rs:RegionType', region_types)
+def _parse_regions(tags, iptc_data):
+    """Parses region type data into IptcData."""
+    region_types = tags.get('XMP-mwg-rs:RegionType')
     if not region_types:
         return
-    region_names = []
-    region_area_x = []
-    region_area_y = []
-    region_area_w = []
-    region_area_h = []
-    _get_xml_nodevalues(xml_desc, 'XMP-mwg-rs:RegionName', region_names)
-    _get_xml_nodevalues(xml_desc, 'XMP-mwg-rs:RegionAreaX', region_area_x)
-    _get_xml_nodevalues(xml_desc, 'XMP-mwg-rs:RegionAreaY', region_area_y)
-    _get_xml_nodevalues(xml_desc, 'XMP-mwg-rs:RegionAreaW', region_area_w)
-    _get_xml_nodevalues(xml_desc, 'XMP-mwg-rs:RegionAreaH', region_area_h)
+    region_names = tags.get('XMP-mwg-rs:RegionName', [])
+    region_area_x = tags.get('XMP-mwg-rs:RegionAreaX', [])
+    region_area_y = tags.get('XMP-mwg-rs:RegionAreaY', [])
+    region_area_w = tags.get('XMP-mwg-rs:RegionAreaW', [])
+    region_area_h = tags.get('XMP-mwg-rs:RegionAreaH', [])
     # Sort the names as they appear in the image, from left to right
     names = {}
     rectangles = {}
@@ -412,37 +835,61 @@ def _parse_regions(xml_desc, iptc_data):
 
 
 
-def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
-                    new_rating, new_gps, new_rectangles, new_persons,
-                    image_width=-1, image_height=-1, hierarchical_subject=None,
-                    preserve_time=True):
-    """Updates the caption and keywords of an image file."""
-    # Some cameras write into Description, so we wipe it out to not cause
-    # conflicts with Caption-Abstract.
-    command = [EXIFTOOL, '-F', '-m', '-Description=']
+def _escape_value(value):
+    """Escapes a tag value for the exiftool -E option. This allows values with
+    newlines, which could not be passed as a single line to "-@ -"."""
+    return (su.unicode_string(value).replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+            .replace(u'>', u'&gt;').replace(u'\r', u'&#xd;').replace(u'\n', u'&#xa;'))
+
+def _get_update_args(filepath, new_caption, new_keywords, new_datetime,
+                     new_rating, new_gps, new_rectangles, new_persons,
+                     image_width, image_height, hierarchical_subject, preserve_time):
+    """Returns the exiftool arguments for updating the meta data of an image
+    file (see update_iptcdata())."""
+    # -overwrite_original avoids the <file>_original backup copy. XMP sidecar
+    # files only have XMP tags: the caption goes into Description, the
+    # keywords into Subject.
+    sidecar = is_sidecar_file(filepath)
+    command = ['-E', '-F', '-m', '-overwrite_original']
+    if not sidecar:
+        # Some cameras write into Description, so we wipe it out to not cause
+        # conflicts with Caption-Abstract.
+        command.append('-Description=')
     if preserve_time:
         command.append("-P")
-    tmp = _write_caption_file(new_caption, command)
+    if new_caption is not None:
+        caption = _escape_value(new_caption)
+        if sidecar:
+            command.append(u'-XMP-dc:Description=%s' % (caption))
+        else:
+            command.append(u'-Caption-Abstract=%s' % (caption))
+            command.append(u'-ImageDescription=%s' % (caption))
     if new_datetime:
         try:
-            command.append('-DateTimeOriginal="%s"' % (
+            command.append('-%s="%s"' % (
+                'XMP-exif:DateTimeOriginal' if sidecar else 'DateTimeOriginal',
                 new_datetime.strftime("%Y:%m:%d %H:%M:%S")))
         except ValueError, ex:
             su.perr("Cannot update timestamp for %s: %s" % (filepath, str(ex)))
+    keywords_tag = 'XMP-dc:Subject' if sidecar else 'keywords'
     if new_keywords:
         for keyword in new_keywords:
-            command.append(u'-keywords=%s' % (keyword))
+            command.append(u'-%s=%s' % (keywords_tag, _escape_value(keyword)))
     elif new_keywords != None:
-        command.append('-keywords=')
+        command.append('-%s=' % (keywords_tag))
     if hierarchical_subject:
         for keyword in hierarchical_subject:
-            command.append(u'-HierarchicalSubject=%s' % (keyword))
+            command.append(u'-HierarchicalSubject=%s' % (_escape_value(keyword)))
     elif hierarchical_subject != None:
         command.append('-HierarchicalSubject=')
-        command.append('-Subject=')
+        if not sidecar:
+            command.append('-Subject=')
     if new_rating >= 0:
         command.append('-Rating=%d' % (new_rating))
-    if new_gps:
+    if new_gps and sidecar:
+        command.append('-XMP-exif:GPSLatitude=%f' % (new_gps.latitude))
+        command.append('-XMP-exif:GPSLongitude=%f' % (new_gps.longitude))
+    elif new_gps:
         command.append('-c')
         command.append('%.6f')
         command.append('-GPSLatitude="%f"' % (abs(new_gps.latitude)))
@@ -457,7 +904,7 @@ def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
         command.append('-RegionAppliedToDimensionsUnit=pixel')
     if new_persons:
         for person in new_persons:
-            command.append(u'-RegionName=%s' % (person))
+            command.append(u'-RegionName=%s' % (_escape_value(person)))
             command.append(u'-RegionType=Face')
     elif new_persons != None:
         command.append('-RegionName=')
@@ -471,40 +918,79 @@ def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
 
     elif new_rectangles != None:
         command.append('-RegionAreaX=')
-    command.append("-iptc:CodedCharacterSet=ESC % G")
+    if not sidecar:
+        command.append("-iptc:CodedCharacterSet=ESC % G")
     command.append(filepath)
-    result = su.fsdec(su.execandcombine(command))
-    if tmp:
-        os.remove(tmp)
+    return command
+
+def _check_update_result(filepath, result):
+    """Checks the exiftool output for an update of filepath, and reports any
+    problems. Returns True if the file was updated."""
     if result.find("1 image files updated") != -1:
         if result != "1 image files updated":
             su.pout(result)
-           
-        # wipe out the back file created by exiftool
-        backup_file = filepath + "_original"
-        if os.path.exists(backup_file):
-            os.remove(backup_file)
         return True
-    else:
-        su.perr("Failed to update IPTC data in image %s: %s" % (
-            filepath, result))
-        return False
-
-def _write_caption_file(new_caption, command):
-    """If new_caption is set, write it into a tempory file, add a parameter to
-       command, and return the file handle."""
-    if new_caption is None:
-        return None
-    if not new_caption:
-        command.append('-Caption-Abstract=')
-        command.append('-ImageDescription=')
-        return None
-    tmpfd, tmp = tempfile.mkstemp(dir="/var/tmp")
-    os.close(tmpfd)
-    file1 = open(tmp, "w")
-    file1.write(new_caption.encode("utf-8"))
-    file1.close()
-    command.append('-Caption-Abstract<=%s' % (tmp))
-    command.append('-ImageDescription<=%s' % (tmp))
-    return tmp
+    su.perr("Failed to update IPTC data in image %s: %s" % (filepath, result))
+    return False
+
+def _create_sidecar(filepath):
+    """Creates an empty XMP sidecar file, if filepath is a sidecar file that
+    does not exist yet."""
+    if is_sidecar_file(filepath) and not os.path.exists(filepath):
+        out = open(filepath, 'wb')
+        out.write(_EMPTY_SIDECAR)
+        out.close()
+
+def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
+                    new_rating, new_gps, new_rectangles, new_persons,
+                    image_width=-1, image_height=-1, hierarchical_subject=None,
+                    preserve_time=True):
+    """Updates the caption and keywords of an image file, or of an XMP
+    sidecar file (which gets created if it does not exist)."""
+    _create_sidecar(filepath)
+    command = _get_update_args(filepath, new_caption, new_keywords, new_datetime,
+                               new_rating, new_gps, new_rectangles, new_persons,
+                               image_width, image_height, hierarchical_subject,
+                               preserve_time)
+    return _check_update_result(filepath, su.fsdec(_get_session().execute(command)))
+
+def queue_iptc_update(filepath, new_caption, new_keywords, new_datetime,
+                      new_rating, new_gps, new_rectangles, new_persons,
+                      image_width=-1, image_height=-1, hierarchical_subject=None,
+                      preserve_time=True, callback=None):
+    """Like update_iptcdata(), but queues the update, to be sent to exiftool
+    together with other updates by flush_iptc_updates().
+
+    Args:
+      callback: if set, called as callback(filepath, success) once the update
+        was sent.
+    """
+    _create_sidecar(filepath)
+    command = _get_update_args(filepath, new_caption, new_keywords, new_datetime,
+                               new_rating, new_gps, new_rectangles, new_persons,
+                               image_width, image_height, hierarchical_subject,
+                               preserve_time)
+    with _update_lock:
+        _queued_updates.append((filepath, command, callback))
+        full = len(_queued_updates) >= _MAX_QUEUED_UPDATES
+    if full:
+        flush_iptc_updates()
+
+def flush_iptc_updates():
+    """Sends all queued updates to exiftool, and reports the result for each
+    file. Returns the number of failed updates."""
+    with _update_lock:
+        updates = _queued_updates[:]
+        del _queued_updates[:]
+    if not updates:
+        return 0
+    outputs = _get_session().execute_many([command for (_, command, _) in updates])
+    failed = 0
+    for ((filepath, _, callback), output) in zip(updates, outputs):
+        success = _check_update_result(filepath, su.fsdec(output))
+        if not success:
+            failed += 1
+        if callback:
+            callback(filepath, success)
+    return failed
     
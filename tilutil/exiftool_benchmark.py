@@ -0,0 +1,119 @@
+"""Benchmark for running several exiftool processes with ExifToolPool.
+
+Uses a fake exiftool that speaks the -stay_open protocol and takes a fixed
+time per file, like a real exiftool reading files from a slow disk, and
+times reading and updating the meta data of a number of files with 1, 2, 4
+and 8 exiftool processes.
+
+Usage: python -m tilutil.exiftool_benchmark [number of files] [ms per file]
+"""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import tilutil.exiftool as exiftool
+
+_SESSION_COUNTS = (1, 2, 4, 8)
+
+_FAKE_EXIFTOOL = '''#!%(python)s
+import json
+import sys
+import time
+
+args = []
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    line = line.rstrip('\\n')
+    if line.startswith('-execute'):
+        files = [arg for arg in args if arg.startswith('/')]
+        time.sleep(%(latency)f * len(files))
+        if '-j' in args:
+            sys.stdout.write(json.dumps([{'SourceFile': image_file,
+                                          'IPTC:Caption-Abstract': 'Caption'}
+                                         for image_file in files]) + '\\n')
+        else:
+            sys.stdout.write('    1 image files updated\\n')
+        sys.stdout.write('{ready%%s}\\n' %% (line[len('-execute'):]))
+        sys.stdout.flush()
+        args = []
+    else:
+        args.append(line)
+        if args[-2:] == ['-stay_open', 'False']:
+            break
+'''
+
+def make_fake_exiftool(folder, latency):
+    """Writes the fake exiftool into folder, and returns its path."""
+    fake_exiftool = os.path.join(folder, 'exiftool')
+    out = open(fake_exiftool, 'w')
+    out.write(_FAKE_EXIFTOOL % {'python': sys.executable, 'latency': latency})
+    out.close()
+    os.chmod(fake_exiftool, 0755)
+    return fake_exiftool
+
+def read_files(image_files):
+    """Reads the meta data of all files with exiftool, and returns the number
+    of files read."""
+    return len(exiftool._read_iptc_data_exiftool(image_files))
+
+def update_files(image_files):
+    """Queues an update for each file, and sends them to exiftool. Returns the
+    number of failed updates."""
+    for image_file in image_files:
+        exiftool.queue_iptc_update(image_file, u'New caption', None, None, -1,
+                                   None, None, None)
+    return exiftool.flush_iptc_updates()
+
+def _time(function, image_files):
+    start = time.time()
+    result = function(image_files)
+    return (time.time() - start, result)
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 5.0) / 1000
+    tmp_dir = tempfile.mkdtemp()
+    old_exiftool = exiftool.EXIFTOOL
+    exiftool.EXIFTOOL = make_fake_exiftool(tmp_dir, latency)
+    try:
+        image_files = [os.path.join(tmp_dir, u'IMG_%06d.CR2' % (i))
+                       for i in xrange(file_count)]
+        print '%d files, %.1f ms per file' % (file_count, latency * 1000)
+        base_times = None
+        for count in _SESSION_COUNTS:
+            exiftool.set_session_count(count)
+            # Start the processes before timing.
+            exiftool._get_session().execute_many([['-ver']] * count)
+            (read_time, read_count) = _time(read_files, image_files)
+            (update_time, failed) = _time(update_files, image_files)
+            if read_count != file_count or failed:
+                print 'ERROR: %d files read, %d updates failed.' % (read_count, failed)
+            if base_times is None:
+                base_times = (read_time, update_time)
+            print '%d processes: read %6.2fs (%.1fx), update %6.2fs (%.1fx)' % (
+                count, read_time, base_times[0] / read_time,
+                update_time, base_times[1] / update_time)
+    finally:
+        exiftool.set_session_count(1)
+        exiftool.EXIFTOOL = old_exiftool
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
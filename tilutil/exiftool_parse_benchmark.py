@@ -0,0 +1,142 @@
+"""Benchmark for parsing the meta data that exiftool returns.
+
+Builds exiftool output for a number of files in the -X (XML) format that
+older versions of exiftool.py read with minidom, and in the -j -G1 (JSON)
+format that it reads now, and times turning each into IptcData.
+
+Usage: python -m tilutil.exiftool_parse_benchmark [number of files]
+"""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import sys
+import time
+
+from xml.dom import minidom
+
+import tilutil.exiftool as exiftool
+
+# The tags of one file, like exiftool reports them for a photo with keywords,
+# a caption, a location, and two faces.
+_TAGS = [
+    ('File:ImageWidth', [640]),
+    ('File:ImageHeight', [480]),
+    ('ExifIFD:DateTimeOriginal', [u'2010:07:04 18:30:00']),
+    ('Composite:GPSLatitude', [u'37.645333 N']),
+    ('Composite:GPSLongitude', [u'122.416667 W']),
+    ('IPTC:Keywords', [u'Beach', u'Caf\xe9', u'Sunset', u'Family', u'2010']),
+    ('IPTC:Caption-Abstract', [u'Sunset at the beach']),
+    ('XMP-xmp:Rating', [4]),
+    ('XMP-lr:HierarchicalSubject', [u'People|Ann', u'People|Bob']),
+    ('XMP-mwg-rs:RegionName', [u'Ann', u'Bob']),
+    ('XMP-mwg-rs:RegionType', [u'Face', u'Face']),
+    ('XMP-mwg-rs:RegionAreaX', [0.25, 0.75]),
+    ('XMP-mwg-rs:RegionAreaY', [0.5, 0.5]),
+    ('XMP-mwg-rs:RegionAreaW', [0.1, 0.1]),
+    ('XMP-mwg-rs:RegionAreaH', [0.2, 0.2]),
+]
+
+def make_xml_output(image_files):
+    """Returns exiftool -X output for image_files."""
+    namespaces = u''.join([u"\n  xmlns:%s='http://ns.exiftool.ca/%s/1.0/'" % (group, group)
+                           for group in sorted(set([name.split(':')[0]
+                                                    for (name, _) in _TAGS]))])
+    lines = [u"<?xml version='1.0' encoding='UTF-8'?>",
+             u"<rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>"]
+    for image_file in image_files:
+        lines.append(u"<rdf:Description rdf:about='%s'%s>" % (image_file, namespaces))
+        for (name, values) in _TAGS:
+            if len(values) == 1:
+                lines.append(u' <%s>%s</%s>' % (name, values[0], name))
+            else:
+                lines.append(u' <%s><rdf:Bag>%s</rdf:Bag></%s>' % (
+                    name, u''.join([u'<rdf:li>%s</rdf:li>' % (v) for v in values]), name))
+        lines.append(u'</rdf:Description>')
+    lines.append(u'</rdf:RDF>')
+    return u'\n'.join(lines).encode('utf-8')
+
+def make_json_output(image_files):
+    """Returns exiftool -j -G1 output for image_files."""
+    entries = []
+    for image_file in image_files:
+        entry = {'SourceFile': image_file}
+        for (name, values) in _TAGS:
+            entry[name] = values[0] if len(values) == 1 else values
+        entries.append(entry)
+    return json.dumps(entries, indent=2, ensure_ascii=False).encode('utf-8')
+
+def _get_xml_nodevalues(xml_element, data):
+    """The previous implementation: extracts the values of an element."""
+    first_child = xml_element.firstChild
+    if (first_child and first_child.nodeValue and first_child.nodeValue != "\n"):
+        data.append(first_child.nodeValue)
+    for xml_bag in xml_element.getElementsByTagName("rdf:Bag"):
+        for xml_li in xml_bag.getElementsByTagName("rdf:li"):
+            first_child = xml_li.firstChild
+            if first_child:
+                data.append(first_child.nodeValue)
+
+def parse_xml(output):
+    """The previous implementation: parses -X output with minidom."""
+    result = {}
+    xml_data = minidom.parseString(output)
+    for xml_desc in xml_data.getElementsByTagName('rdf:Description'):
+        image_file = xml_desc.getAttribute("rdf:about")
+        tags = {}
+        for xml_element in xml_desc.childNodes:
+            if xml_element.nodeType == xml_element.ELEMENT_NODE:
+                _get_xml_nodevalues(xml_element, tags.setdefault(xml_element.tagName, []))
+        result[image_file] = exiftool._make_iptc_data(image_file, tags)
+    xml_data.unlink()
+    return result
+
+def parse_json(output):
+    """The current implementation: parses -j -G1 output."""
+    result = {}
+    for entry in exiftool._parse_json_output(output):
+        image_file = entry.pop('SourceFile')
+        result[image_file] = exiftool._make_iptc_data(image_file,
+                                                      exiftool._get_json_tags(entry))
+    return result
+
+def _get_fields(iptc_data):
+    """Returns the fields of IptcData, in a form that can be compared."""
+    fields = dict(vars(iptc_data))
+    fields['gps'] = iptc_data.gps.to_string() if iptc_data.gps else None
+    return fields
+
+def _time(function, output):
+    start = time.time()
+    result = function(output)
+    return (time.time() - start, result)
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    image_files = [u'/Volumes/Photos/Album/IMG_%06d.CR2' % (i) for i in xrange(file_count)]
+    xml_output = make_xml_output(image_files)
+    json_output = make_json_output(image_files)
+    print '%d files, %d bytes XML, %d bytes JSON' % (file_count, len(xml_output),
+                                                     len(json_output))
+    (xml_time, xml_result) = _time(parse_xml, xml_output)
+    print 'minidom (-X):   %6.2fs' % (xml_time)
+    (json_time, json_result) = _time(parse_json, json_output)
+    print 'json (-j -G1):  %6.2fs (%.1fx)' % (json_time, xml_time / json_time)
+
+    for image_file in image_files:
+        if _get_fields(xml_result[image_file]) != _get_fields(json_result[image_file]):
+            print 'ERROR: results differ for %s.' % (image_file)
+            break
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+"""This module tests exiftool.py."""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import tilutil.exiftool as exiftool
+import tilutil.imageutils as imageutils
+
+# A fake exiftool that speaks the -stay_open protocol. It logs every start
+# into the file "starts" next to it, and every command into "commands". It
+# answers each command with the list of its arguments, canned -j output for
+# each absolute file path of "-j", or an update result for "-overwrite_original" (failing for files with
+# "bad" in the name). The argument "crash" makes it exit the first time it
+# sees it, "crash_always" every time.
+_FAKE_EXIFTOOL = '''#!%(python)s
+import os
+import sys
+
+json_entry = %(json)r
+folder = os.path.dirname(os.path.abspath(sys.argv[0]))
+open(os.path.join(folder, 'starts'), 'a').write('start\\n')
+args = []
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    line = line.rstrip('\\n')
+    if line.startswith('-execute'):
+        if 'crash_always' in args:
+            sys.exit(1)
+        crash_marker = os.path.join(folder, 'crashed')
+        if 'crash' in args and not os.path.exists(crash_marker):
+            open(crash_marker, 'w').close()
+            sys.exit(1)
+        open(os.path.join(folder, 'commands'), 'a').write('|'.join(args) + '\\n')
+        if '-j' in args:
+            files = [arg for arg in args if arg.startswith('/')]
+            sys.stdout.write('[' + ',\\n'.join([json_entry %% (f) for f in files]) +
+                             ']\\n')
+        elif '-overwrite_original' in args:
+            if 'bad' in args[-1]:
+                sys.stdout.write('Error: bad file - %%s\\n' %% (args[-1]))
+            else:
+                sys.stdout.write('    1 image files updated\\n')
+        else:
+            sys.stdout.write('args: %%s\\n' %% (' '.join(args)))
+        sys.stdout.write('{ready%%s}\\n' %% (line[len('-execute'):]))
+        sys.stdout.flush()
+        args = []
+    else:
+        args.append(line)
+        if args[-2:] == ['-stay_open', 'False']:
+            break
+'''
+
+_JSON_OUTPUT = '''{
+  "SourceFile": "%s",
+  "IPTC:Keywords": ["Beach", "Ocean"],
+  "IPTC:Caption-Abstract": "Sunset",
+  "XMP-xmp:Rating": 4
+}'''
+
+class _OldGpsLocation(object):
+    """GpsLocation as older versions pickled it, without __slots__."""
+
+
+class ExifToolTest(unittest.TestCase):
+    """Unit tests for exiftool.py code, using a fake exiftool."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.fake_exiftool = os.path.join(self.folder, 'exiftool')
+        out = open(self.fake_exiftool, 'w')
+        out.write(_FAKE_EXIFTOOL % {'python': sys.executable, 'json': _JSON_OUTPUT})
+        out.close()
+        os.chmod(self.fake_exiftool, 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _get_starts(self):
+        return len(open(os.path.join(self.folder, 'starts')).readlines())
+
+    def test_session(self):
+        """Tests that commands are sent to a single exiftool process."""
+        session = exiftool.ExifToolSession(self.fake_exiftool)
+        try:
+            self.assertEquals('args: -ver', session.execute(['-ver']))
+            self.assertEquals(u'args: -a b \xe9',
+                              session.execute(['-a', u'b \xe9']).decode('utf-8'))
+            self.assertEquals(1, self._get_starts())
+        finally:
+            session.close()
+
+    def test_session_restart(self):
+        """Tests that the session restarts exiftool if it dies."""
+        session = exiftool.ExifToolSession(self.fake_exiftool)
+        try:
+            self.assertEquals('args: -ver', session.execute(['-ver']))
+            self.assertEquals('args: crash', session.execute(['crash']))
+            self.assertEquals('args: -ver', session.execute(['-ver']))
+            self.assertEquals(2, self._get_starts())
+        finally:
+            session.close()
+
+    def test_pool(self):
+        """Tests that a pool spreads commands over its sessions, and returns
+        the output in order."""
+        pool = exiftool.ExifToolPool(3, self.fake_exiftool)
+        try:
+            commands = [['-n', str(i)] for i in range(10)]
+            self.assertEquals(['args: -n %d' % (i) for i in range(10)],
+                              pool.execute_many(commands))
+            self.assertEquals(3, self._get_starts())
+            self.assertEquals('args: -ver', pool.execute(['-ver']))
+            self.assertEquals([], pool.execute_many([]))
+        finally:
+            pool.close()
+
+    def test_pool_errors(self):
+        """Tests that pool workers survive exiftool crashes and failures to
+        start it."""
+        pool = exiftool.ExifToolPool(2, self.fake_exiftool)
+        try:
+            # The crashing command is tried twice, and gives no output.
+            self.assertEquals(['', 'args: -ver'],
+                              pool.execute_many([['crash_always'], ['-ver']]))
+            self.assertEquals(['args: -n %d' % (i) for i in range(4)],
+                              pool.execute_many([['-n', str(i)] for i in range(4)]))
+        finally:
+            pool.close()
+
+        pool = exiftool.ExifToolPool(2, os.path.join(self.folder, 'missing'))
+        try:
+            for _ in range(2):
+                self.assertRaises(OSError, pool.execute, ['-ver'])
+                self.assertRaises(OSError, pool.execute_many, [['-n', str(i)]
+                                                               for i in range(4)])
+        finally:
+            pool.close()
+
+    def test_parse_json_output(self):
+        """Tests parsing exiftool -j output, with an error message in front
+        of it."""
+        output = ('Error: File not found - /tmp/missing.JPG\n'
+                  '[{"SourceFile": "/tmp/IMG_0001.JPG", "IPTC:Keywords": [1.50, "Caf\xc3\xa9"],'
+                  ' "XMP-mwg-rs:RegionAreaX": 0.25, "XMP-xmp:Rating": 4}]\n')
+        entries = exiftool._parse_json_output(output)
+        self.assertEquals(1, len(entries))
+        self.assertEquals(u'/tmp/IMG_0001.JPG', entries[0].pop('SourceFile'))
+        self.assertEquals({'IPTC:Keywords': [u'1.50', u'Caf\xe9'],
+                           'XMP-mwg-rs:RegionAreaX': [u'0.25'],
+                           'XMP-xmp:Rating': [u'4']},
+                          exiftool._get_json_tags(entries[0]))
+        self.assertEquals([], exiftool._parse_json_output(''))
+        self.assertEquals([], exiftool._parse_json_output('[{"SourceFile": '))
+
+    def test_get_iptc_data(self):
+        """Tests reading IPTC data through the shared session."""
+        old_exiftool = exiftool.EXIFTOOL
+        exiftool.close_session()
+        exiftool.EXIFTOOL = self.fake_exiftool
+        try:
+            iptc_data = exiftool.get_iptc_data('/tmp/IMG_0001.JPG', use_cache=False)
+            self.assertEquals('/tmp/IMG_0001.JPG', iptc_data.image_file)
+            self.assertEquals(['Beach', 'Ocean'], iptc_data.keywords)
+            self.assertEquals('Sunset', iptc_data.caption)
+            self.assertEquals(4, iptc_data.rating)
+            exiftool.get_iptc_data('/tmp/IMG_0002.JPG', use_cache=False)
+            self.assertEquals(1, self._get_starts())
+        finally:
+            exiftool.close_session()
+            exiftool.EXIFTOOL = old_exiftool
+
+    def _get_commands(self):
+        return open(os.path.join(self.folder, 'commands')).read().splitlines()
+
+    def test_prefetch_iptc_data(self):
+        """Tests reading the IPTC data of several files with one command."""
+        old_exiftool = exiftool.EXIFTOOL
+        exiftool.close_session()
+        exiftool.EXIFTOOL = self.fake_exiftool
+        cache_file = os.path.join(self.folder, exiftool.CACHE_DB_NAME)
+        album = os.path.join(self.folder, u'Album')
+        os.mkdir(album)
+        image_files = []
+        for i in range(3):
+            image_file = os.path.join(album, u'IMG_%04d.JPG' % (i))
+            open(image_file, 'w').close()
+            image_files.append(image_file)
+        try:
+            exiftool.open_cache(cache_file)
+            exiftool.prefetch_iptc_data(image_files)
+            self.assertEquals(1, len(self._get_commands()))
+            for image_file in image_files:
+                iptc_data = exiftool.get_iptc_data(image_file)
+                self.assertEquals(image_file, iptc_data.image_file)
+                self.assertEquals(['Beach', 'Ocean'], iptc_data.keywords)
+            # Cached files are not read again.
+            exiftool.prefetch_iptc_data(image_files)
+            self.assertEquals(1, len(self._get_commands()))
+            # A new run reads the saved cache instead of running exiftool.
+            exiftool.close_cache()
+            exiftool.open_cache(cache_file)
+            self.assertEquals(['Beach', 'Ocean'],
+                              exiftool.get_iptc_data(image_files[0]).keywords)
+            self.assertEquals(1, len(self._get_commands()))
+            # A changed file is read again.
+            open(image_files[1], 'w').write('changed')
+            exiftool.get_iptc_data(image_files[1])
+            self.assertEquals(2, len(self._get_commands()))
+        finally:
+            exiftool.close_cache()
+            exiftool.close_session()
+            exiftool.EXIFTOOL = old_exiftool
+
+    def test_prefetch_with_pool(self):
+        """Tests that reads are split over the exiftool processes of a
+        pool."""
+        old_exiftool = exiftool.EXIFTOOL
+        exiftool.EXIFTOOL = self.fake_exiftool
+        exiftool.set_session_count(2)
+        image_files = []
+        for i in range(5):
+            image_file = os.path.join(self.folder, u'IMG_%04d.CR2' % (i))
+            open(image_file, 'w').close()
+            image_files.append(image_file)
+        try:
+            exiftool.open_cache(os.path.join(self.folder, exiftool.CACHE_DB_NAME))
+            exiftool.prefetch_iptc_data(image_files)
+            self.assertEquals(2, len(self._get_commands()))
+            self.assertEquals(2, self._get_starts())
+            for image_file in image_files:
+                self.assertEquals(['Beach', 'Ocean'],
+                                  exiftool.get_iptc_data(image_file).keywords)
+            self.assertEquals(2, len(self._get_commands()))
+        finally:
+            exiftool.close_cache()
+            exiftool.set_session_count(1)
+            exiftool.EXIFTOOL = old_exiftool
+
+    def test_read_profile(self):
+        """Tests that only the tags of the read profile are read, and that
+        cached entries with fewer tags are read again."""
+        old_exiftool = exiftool.EXIFTOOL
+        exiftool.close_session()
+        exiftool.EXIFTOOL = self.fake_exiftool
+        image_file = os.path.join(self.folder, u'IMG_0001.CR2')
+        open(image_file, 'w').close()
+        try:
+            exiftool.open_cache(os.path.join(self.folder, exiftool.CACHE_DB_NAME))
+            exiftool.prefetch_iptc_data([image_file], exiftool.READ_BASIC)
+            args = self._get_commands()[0].split('|')
+            self.assertTrue('-Keywords' in args)
+            self.assertFalse('-GPSLatitude' in args)
+            self.assertFalse('-RegionAreaX' in args)
+            self.assertEquals(exiftool.READ_BASIC, exiftool.get_iptc_data(
+                image_file, profile=exiftool.READ_BASIC).read_profile)
+            self.assertEquals(1, len(self._get_commands()))
+            # GPS needs a new read, which also keeps the tags read before.
+            iptc_data = exiftool.get_iptc_data(image_file, profile=exiftool.READ_GPS)
+            self.assertEquals(exiftool.READ_GPS, iptc_data.read_profile)
+            args = self._get_commands()[1].split('|')
+            self.assertTrue('-GPSLatitude' in args)
+            self.assertFalse('-RegionAreaX' in args)
+            exiftool.get_iptc_data(image_file, profile=exiftool.READ_BASIC)
+            self.assertEquals(2, len(self._get_commands()))
+        finally:
+            exiftool.close_cache()
+            exiftool.close_session()
+            exiftool.EXIFTOOL = old_exiftool
+
+        tags = {'XMP-mwg-rs:RegionType': [u'Face', u'Face'],
+                'XMP-mwg-rs:RegionName': [u'Bob', u'Ann'],
+                'XMP-mwg-rs:RegionAreaX': [u'0.75', u'0.25'],
+                'XMP-mwg-rs:RegionAreaY': [u'0.5', u'0.5'],
+                'XMP-mwg-rs:RegionAreaW': [u'0.1', u'0.1'],
+                'XMP-mwg-rs:RegionAreaH': [u'0.2', u'0.2']}
+        iptc_data = exiftool._make_iptc_data(image_file, tags, exiftool.READ_BASIC)
+        self.assertEquals([u'Bob', u'Ann'], iptc_data.region_names)
+        self.assertEquals([], iptc_data.region_rectangles)
+        iptc_data = exiftool._make_iptc_data(image_file, tags, exiftool.READ_FACES)
+        self.assertEquals([u'Ann', u'Bob'], iptc_data.region_names)
+        self.assertEquals(2, len(iptc_data.region_rectangles))
+
+    def test_pickle_gps(self):
+        """Tests pickling IptcData with a GPS location, and reading the
+        GpsLocation pickles of older versions."""
+        iptc_data = exiftool.IptcData()
+        iptc_data.gps = imageutils.GpsLocation(37.645, -122.416)
+        for protocol in (0, cPickle.HIGHEST_PROTOCOL):
+            loaded = cPickle.loads(cPickle.dumps(iptc_data, protocol))
+            self.assertEquals((37.645, -122.416), (loaded.gps.latitude, loaded.gps.longitude))
+
+        old_gps = _OldGpsLocation()
+        old_gps.latitude = 37.645
+        old_gps.longitude = -122.416
+        data = cPickle.dumps(old_gps, 0).replace(
+            '%s\n_OldGpsLocation\n' % (_OldGpsLocation.__module__),
+            'tilutil.imageutils\nGpsLocation\n')
+        loaded = cPickle.loads(data)
+        self.assertTrue(isinstance(loaded, imageutils.GpsLocation))
+        self.assertEquals((37.645, -122.416), (loaded.latitude, loaded.longitude))
+
+    def test_import_folder_cache(self):
+        """Tests importing the .phoshare files of older versions."""
+        old_exiftool = exiftool.EXIFTOOL
+        exiftool.close_session()
+        exiftool.EXIFTOOL = self.fake_exiftool
+        image_file = os.path.join(self.folder, u'IMG_0001.JPG')
+        open(image_file, 'w').close()
+        file_stat = os.stat(image_file)
+        entry = exiftool._IptcCacheEntry()
+        entry.file_path = image_file
+        entry.iptc_data = exiftool.IptcData()
+        entry.iptc_data.caption = u'Cached'
+        entry.iptc_data.gps = imageutils.GpsLocation(37.645, -122.416)
+        (entry.st_ino, entry.st_mtime, entry.st_size) = (
+            file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+        entry.created = time.time()
+        folder_cache = exiftool._IptcCache()
+        folder_cache.folder = self.folder
+        folder_cache.cache_version = exiftool.CACHE_VERSION
+        folder_cache.cache = {image_file: entry}
+        out = open(os.path.join(self.folder, exiftool.CACHE_NAME), 'wb')
+        cPickle.dump(folder_cache, out)
+        out.close()
+        try:
+            exiftool.open_cache(os.path.join(self.folder, exiftool.CACHE_DB_NAME))
+            iptc_data = exiftool.get_iptc_data(image_file)
+            self.assertEquals(u'Cached', iptc_data.caption)
+            self.assertEquals(37.645, iptc_data.gps.latitude)
+            self.assertFalse(os.path.exists(os.path.join(self.folder, 'commands')))
+        finally:
+            exiftool.close_cache()
+            exiftool.close_session()
+            exiftool.EXIFTOOL = old_exiftool
+
+    def test_import_bad_folder_cache(self):
+        """Tests that a .phoshare file that can't be read is not marked as
+        imported."""
+        save_path = os.path.join(self.folder, exiftool.CACHE_NAME)
+        out = open(save_path, 'wb')
+        out.write('garbage')
+        out.close()
+        mtime = os.stat(save_path).st_mtime
+        exiftool.open_cache(os.path.join(self.folder, exiftool.CACHE_DB_NAME))
+        try:
+            cache = exiftool._get_cache([self.folder])
+            self.assertFalse(cache.is_imported(self.folder, mtime))
+        finally:
+            exiftool.close_cache()
+
+    def test_queue_iptc_update(self):
+        """Tests sending queued updates to exiftool in one batch."""
+        old_exiftool = exiftool.EXIFTOOL
+        exiftool.close_session()
+        exiftool.EXIFTOOL = self.fake_exiftool
+        results = []
+        def callback(filepath, success):
+            results.append((filepath, success))
+        try:
+            exiftool.queue_iptc_update('/tmp/IMG_0001.JPG', u'Line 1\nA & B', [u'Beach'],
+                                       None, -1, None, None, None, callback=callback)
+            exiftool.queue_iptc_update('/tmp/bad.JPG', None, None, None, 3, None, None,
+                                       None, callback=callback)
+            self.assertEquals([], results)
+            self.assertEquals(1, exiftool.flush_iptc_updates())
+            self.assertEquals([('/tmp/IMG_0001.JPG', True), ('/tmp/bad.JPG', False)],
+                              results)
+            self.assertEquals(0, exiftool.flush_iptc_updates())
+            commands = open(os.path.join(self.folder, 'commands')).read().splitlines()
+            self.assertEquals(2, len(commands))
+            args = commands[0].split('|')
+            self.assertTrue('-E' in args)
+            self.assertTrue('-Caption-Abstract=Line 1&#xa;A &amp; B' in args)
+            self.assertTrue('-keywords=Beach' in args)
+            self.assertEquals('/tmp/IMG_0001.JPG', args[-1])
+            self.assertEquals(1, self._get_starts())
+        finally:
+            exiftool.close_session()
+            exiftool.EXIFTOOL = old_exiftool
+
+    def test_sidecar_update(self):
+        """Tests that updates of a sidecar file create it, and write XMP
+        tags only."""
+        old_exiftool = exiftool.EXIFTOOL
+        exiftool.close_session()
+        exiftool.EXIFTOOL = self.fake_exiftool
+        sidecar = exiftool.get_sidecar_file(os.path.join(self.folder, u'IMG_0001.JPG'))
+        self.assertEquals(os.path.join(self.folder, u'IMG_0001.xmp'), sidecar)
+        try:
+            exiftool.queue_iptc_update(sidecar, u'Sunset', [u'Beach'], None, -1,
+                                       None, None, None)
+            self.assertTrue(os.path.exists(sidecar))
+            self.assertEquals(0, exiftool.flush_iptc_updates())
+            args = self._get_commands()[0].split('|')
+            self.assertTrue('-XMP-dc:Description=Sunset' in args)
+            self.assertTrue('-XMP-dc:Subject=Beach' in args)
+            self.assertFalse([arg for arg in args if arg.lower().startswith('-keywords')])
+            self.assertFalse('-Description=' in args)
+        finally:
+            exiftool.close_session()
+            exiftool.EXIFTOOL = old_exiftool
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+'''Copies files with the fastest method the operating system offers.
+
+copy_file() tries, in order:
+
+  clone: a copy-on-write clone that shares the data blocks of the source
+      (FICLONE on Linux btrfs and XFS, clonefile() on Mac OS X APFS).
+  copy_file_range: an in-kernel copy (Linux 4.5 and later), which some file
+      systems and network file systems turn into a server side copy.
+  sendfile: an in-kernel copy (Linux).
+  buffer: reads and writes with a large buffer.
+
+A method that fails moves on to the next one, which continues where the
+previous one stopped. Like shutil.copy2(), copy_file() copies the
+permissions and modification time of the source.
+
+The number of files and bytes copied and the time spent are counted for
+each method, see get_stats().
+'''
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+import sys
+import threading
+import time
+
+CLONE = 'clone'
+COPY_FILE_RANGE = 'copy_file_range'
+SENDFILE = 'sendfile'
+BUFFER = 'buffer'
+
+# All methods, in the order they are tried.
+METHODS = (CLONE, COPY_FILE_RANGE, SENDFILE, BUFFER)
+
+# Buffer size for BUFFER copies. shutil uses 16 KB.
+_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Maximum number of bytes per copy_file_range() or sendfile() call.
+_CHUNK_SIZE = 1024 * 1024 * 1024
+
+# ioctl request for cloning a file on Linux: _IOW(0x94, 9, int).
+_FICLONE = 0x40049409
+
+_IS_LINUX = sys.platform.startswith('linux')
+
+def _load_libc():
+    """Returns the C library, or None."""
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+    if hasattr(libc, 'copy_file_range'):
+        libc.copy_file_range.restype = ctypes.c_ssize_t
+        libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                         ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    if hasattr(libc, 'sendfile'):
+        libc.sendfile.restype = ctypes.c_ssize_t
+        libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_size_t]
+    if hasattr(libc, 'clonefile'):
+        libc.clonefile.restype = ctypes.c_int
+        libc.clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+_libc = _load_libc()
+
+# Methods that the system does not support.
+_unsupported = set()
+
+# Errors that mean a method does not work for a pair of files, and the next
+# one should be tried.
+_FALLBACK_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                    errno.ENOTTY, errno.EBADF, errno.EPERM, errno.ETXTBSY,
+                    getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP))
+
+_stats_lock = threading.Lock()
+# method -> [files, bytes, seconds]
+_stats = {}
+
+def _check_result(result, method):
+    """Raises OSError for a failed C library call."""
+    if result < 0:
+        error = ctypes.get_errno()
+        if error == errno.ENOSYS:
+            _unsupported.add(method)
+        raise OSError(error, os.strerror(error))
+    return result
+
+def _fsencode(path):
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+def _clonefile(source, target):
+    """Clones source into target with clonefile() (Mac OS X 10.12 and
+    later). Returns True on success."""
+    if not _libc or not hasattr(_libc, 'clonefile') or CLONE in _unsupported:
+        return False
+    try:
+        _check_result(_libc.clonefile(_fsencode(source), _fsencode(target), 0), CLONE)
+    except OSError, ex:
+        if ex.errno in _FALLBACK_ERRORS or ex.errno == errno.EEXIST:
+            return False
+        raise
+    return True
+
+def _ficlone(src_fd, dst_fd, size):
+    """Clones the whole source file into the (empty) target file."""
+    if not _IS_LINUX or CLONE in _unsupported:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+    os.lseek(src_fd, size, os.SEEK_SET)
+    os.lseek(dst_fd, size, os.SEEK_SET)
+    return size
+
+def _copy_file_range(src_fd, dst_fd, size):
+    """Copies the rest of the source file with copy_file_range()."""
+    if not _libc or not hasattr(_libc, 'copy_file_range') or COPY_FILE_RANGE in _unsupported:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    copied = 0
+    while True:
+        count = _check_result(_libc.copy_file_range(src_fd, None, dst_fd, None,
+                                                    _CHUNK_SIZE, 0), COPY_FILE_RANGE)
+        if count == 0:
+            return copied
+        copied += count
+
+def _sendfile(src_fd, dst_fd, size):
+    """Copies the rest of the source file with sendfile(). Only Linux
+    supports files as the target."""
+    if not _IS_LINUX or not _libc or not hasattr(_libc, 'sendfile'):
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    copied = 0
+    while True:
+        count = _check_result(_libc.sendfile(dst_fd, src_fd, None, _CHUNK_SIZE), SENDFILE)
+        if count == 0:
+            return copied
+        copied += count
+
+def _copy_buffer(src_fd, dst_fd, size):
+    """Copies the rest of the source file with read() and write()."""
+    copied = 0
+    while True:
+        data = os.read(src_fd, _BUFFER_SIZE)
+        if not data:
+            return copied
+        while data:
+            count = os.write(dst_fd, data)
+            data = data[count:]
+            copied += count
+
+_COPY_FUNCTIONS = {
+    CLONE: _ficlone,
+    COPY_FILE_RANGE: _copy_file_range,
+    SENDFILE: _sendfile,
+    BUFFER: _copy_buffer,
+}
+
+def _add_stats(method, size, seconds):
+    with _stats_lock:
+        entry = _stats.setdefault(method, [0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += size
+        entry[2] += seconds
+
+def copy_file(source, target, methods=METHODS):
+    """Copies source to target, with the permissions and modification time
+    of source, like shutil.copy2(). Returns the method that copied the data.
+
+    Args:
+      source: path of the file to copy.
+      target: path of the copy. Replaced if it exists.
+      methods: the methods to try, in order. BUFFER always works.
+    """
+    start = time.time()
+    method = None
+    size = os.path.getsize(source)
+    if CLONE in methods and _clonefile(source, target):
+        method = CLONE
+    else:
+        src_fd = os.open(source, os.O_RDONLY)
+        try:
+            dst_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+            try:
+                for method in list(methods) + [BUFFER]:
+                    try:
+                        _COPY_FUNCTIONS[method](src_fd, dst_fd, size)
+                        break
+                    except (IOError, OSError), ex:
+                        if method == BUFFER or ex.errno not in _FALLBACK_ERRORS:
+                            raise
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    shutil.copystat(source, target)
+    _add_stats(method, size, time.time() - start)
+    return method
+
+def get_stats():
+    """Returns a map of method -> (number of files, number of bytes,
+    seconds) for the files copied since the last reset_stats()."""
+    with _stats_lock:
+        return dict([(method, tuple(entry)) for (method, entry) in _stats.iteritems()])
+
+def get_throughput():
+    """Returns (number of files, number of bytes, bytes per second) for all
+    files copied since the last reset_stats()."""
+    files = 0
+    size = 0
+    seconds = 0.0
+    for (method_files, method_size, method_seconds) in get_stats().values():
+        files += method_files
+        size += method_size
+        seconds += method_seconds
+    return (files, size, size / seconds if seconds > 0 else 0.0)
+
+def reset_stats():
+    """Resets the counters of get_stats()."""
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,97 @@
+"""Benchmark for copying large files with filecopy.py.
+
+Writes a test file of the given size, like a movie file, into a folder, and
+times copying it in the same folder with shutil.copy2() and with each
+filecopy method. A method that the file system does not support falls back
+to the next one; the method that did the copy is shown.
+
+To compare file systems, run it once per file system, e.g., on tmpfs
+(/dev/shm), and on ext4 and btrfs loop images:
+
+  truncate -s 12G /tmp/btrfs.img && mkfs.btrfs /tmp/btrfs.img
+  sudo mkdir /mnt/btrfs && sudo mount -o loop /tmp/btrfs.img /mnt/btrfs
+  sudo chmod 777 /mnt/btrfs
+
+(and the same with mkfs.ext4). The source file is in the page cache, so
+the numbers show the cost of the copy itself, not of reading the disk.
+
+Usage: python -m tilutil.filecopy_benchmark [folder] [MB] [repeats]
+"""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import tilutil.filecopy as filecopy
+
+def make_file(path, size):
+    """Writes size bytes of random data into path."""
+    block = os.urandom(1024 * 1024)
+    out = open(path, 'wb')
+    try:
+        for _ in xrange(size // len(block)):
+            out.write(block)
+        out.write(block[:size % len(block)])
+    finally:
+        out.close()
+
+def _time(function, repeats):
+    """Returns the fastest time of repeats calls of function, and its
+    result."""
+    best = None
+    result = None
+    for _ in xrange(repeats):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else tempfile.gettempdir()
+    size = int(sys.argv[2] if len(sys.argv) > 2 else 2048) * 1024 * 1024
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    tmp_dir = tempfile.mkdtemp(dir=folder)
+    try:
+        source = os.path.join(tmp_dir, 'MVI_0001.MOV')
+        target = os.path.join(tmp_dir, 'copy.MOV')
+        make_file(source, size)
+        print '%s: %d MB, best of %d' % (folder, size // (1024 * 1024), repeats)
+
+        def copy2():
+            if os.path.exists(target):
+                os.remove(target)
+            shutil.copy2(source, target)
+            return 'shutil.copy2'
+        (base_time, _) = _time(copy2, repeats)
+        print '%-16s %8.1f MB/s' % ('shutil.copy2', size / base_time / 1048576)
+
+        for method in filecopy.METHODS:
+            def copy():
+                if os.path.exists(target):
+                    os.remove(target)
+                return filecopy.copy_file(source, target, (method,))
+            (elapsed, used) = _time(copy, repeats)
+            print '%-16s %8.1f MB/s (%.1fx)%s' % (
+                method, size / elapsed / 1048576, base_time / elapsed,
+                '' if used == method else ', fell back to ' + used)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""This module tests filecopy.py."""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tilutil.filecopy as filecopy
+
+class FileCopyTest(unittest.TestCase):
+    """Unit tests for filecopy.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, u'MVI_0001.MOV')
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        out = open(self.source, 'wb')
+        out.write(self.data)
+        out.close()
+        os.chmod(self.source, 0640)
+        os.utime(self.source, (1000000000, 1000000000))
+        self.target = os.path.join(self.folder, u'copy.MOV')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _check_copy(self):
+        copy = open(self.target, 'rb')
+        try:
+            self.assertEquals(self.data, copy.read())
+        finally:
+            copy.close()
+        self.assertEquals(1000000000, os.path.getmtime(self.target))
+        self.assertEquals(0640, os.stat(self.target).st_mode & 0777)
+
+    def test_methods(self):
+        """Tests that every method, or its fallback, copies the data and the
+        file attributes, and replaces an existing target."""
+        for method in filecopy.METHODS:
+            open(self.target, 'w').write('old data' * 1000000)
+            used = filecopy.copy_file(self.source, self.target, (method,))
+            self.assertTrue(used in (method, filecopy.BUFFER))
+            self._check_copy()
+            os.remove(self.target)
+
+    def test_stats(self):
+        """Tests the throughput counters."""
+        filecopy.reset_stats()
+        method = filecopy.copy_file(self.source, self.target)
+        self._check_copy()
+        self.assertEquals([method], filecopy.get_stats().keys())
+        (files, size, _) = filecopy.get_throughput()
+        self.assertEquals((1, len(self.data)), (files, size))
+        filecopy.reset_stats()
+        self.assertEquals((0, 0, 0.0), filecopy.get_throughput())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,491 @@
+'''Reads image meta data directly from JPEG and TIFF files.
+
+Running exiftool is expensive compared to parsing the few meta data that
+Phoshare compares, and most exported images are JPEG files. This module
+reads the EXIF, IPTC-IIM and XMP data of JPEG and TIFF files, looking only at
+the file header (everything up to the start of the JPEG image data, or the
+TIFF directories and the values they point to).
+
+It also reads XMP sidecar files.
+
+read_tags() returns the meta data as a map of group and tag name -> list of
+values, like the tag maps that exiftool.py builds from "exiftool -j -G1 -c
+%.6f" output (e.g., "IPTC:Keywords" -> [u'a', u'b']), so that exiftool.py
+can handle them the same way. It returns None for other file formats, and
+for anything it can't parse completely, so that the caller can fall back to
+exiftool.
+'''
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import struct
+from xml.etree import cElementTree
+
+import tilutil.systemutils as su
+
+_JPEG_EXTENSIONS = ('jpg', 'jpeg')
+_TIFF_EXTENSIONS = ('tif', 'tiff')
+_XMP_EXTENSIONS = ('xmp',)
+
+# Largest TIFF value that is read (larger values are not meta data we need).
+_MAX_VALUE_SIZE = 4 * 1024 * 1024
+
+_EXIF_HEADER = 'Exif\0\0'
+_XMP_HEADER = 'http://ns.adobe.com/xap/1.0/\0'
+_XMP_EXTENSION_HEADER = 'http://ns.adobe.com/xmp/extension/\0'
+_PHOTOSHOP_HEADER = 'Photoshop 3.0\0'
+
+# JPEG markers.
+_SOI = 0xD8
+_EOI = 0xD9
+_SOS = 0xDA
+_APP1 = 0xE1
+_APP13 = 0xED
+# Start of frame markers, which hold the image dimensions.
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - frozenset((0xC4, 0xC8, 0xCC))
+
+# TIFF tags.
+_TAG_IMAGE_DESCRIPTION = 0x010E
+_TAG_XMP = 0x02BC
+_TAG_IPTC = 0x83BB
+_TAG_PHOTOSHOP = 0x8649
+_TAG_EXIF_IFD = 0x8769
+_TAG_GPS_IFD = 0x8825
+_TAG_DATE_TIME_ORIGINAL = 0x9003
+_TAG_GPS_LATITUDE_REF = 1
+_TAG_GPS_LATITUDE = 2
+_TAG_GPS_LONGITUDE_REF = 3
+_TAG_GPS_LONGITUDE = 4
+
+# TIFF field type -> (size, struct format).
+_TIFF_TYPES = {
+    1: (1, 'B'), 2: (1, 'c'), 3: (2, 'H'), 4: (4, 'I'), 5: (8, 'II'),
+    6: (1, 'b'), 7: (1, 'c'), 8: (2, 'h'), 9: (4, 'i'), 10: (8, 'ii'),
+    11: (4, 'f'), 12: (8, 'd'), 13: (4, 'I'),
+}
+
+# Photoshop image resource with the IPTC-IIM data.
+_PHOTOSHOP_IPTC = 0x0404
+
+# IPTC-IIM datasets, as (record, dataset).
+_IPTC_CODED_CHARACTER_SET = (1, 90)
+_IPTC_KEYWORDS = (2, 25)
+_IPTC_CAPTION = (2, 120)
+_IPTC_UTF8 = '\x1b%G'
+
+_RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+_XML = '{http://www.w3.org/XML/1998/namespace}'
+_NS_XMP = '{http://ns.adobe.com/xap/1.0/}'
+_NS_DC = '{http://purl.org/dc/elements/1.1/}'
+_NS_EXIF = '{http://ns.adobe.com/exif/1.0/}'
+_NS_LR = '{http://ns.adobe.com/lightroom/1.0/}'
+_NS_CRS = '{http://ns.adobe.com/camera-raw-settings/1.0/}'
+_NS_MWG_RS = '{http://www.metadataworkinggroup.com/schemas/regions/}'
+_NS_ST_AREA = '{http://ns.adobe.com/xmp/sType/Area#}'
+
+
+class _FormatError(Exception):
+    """Raised for files that can't be read without exiftool."""
+
+
+def _decode_ascii(value):
+    """Decodes an EXIF ASCII value."""
+    value = value.split('\0', 1)[0]
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+def _add_tag(tags, name, value):
+    """Adds a value to the list of values of a tag, as a string. Empty values
+    are dropped."""
+    if value:
+        tags.setdefault(name, []).append(unicode(value))
+
+
+class _TiffReader(object):
+    """Reads the directories of TIFF data.
+
+    Args:
+      read_at: function(offset, size) that returns size bytes of the TIFF
+        data at offset.
+    """
+
+    def __init__(self, read_at):
+        self._read_at = read_at
+        header = read_at(0, 8)
+        if header[:2] == 'II':
+            self._byte_order = '<'
+        elif header[:2] == 'MM':
+            self._byte_order = '>'
+        else:
+            raise _FormatError('Bad TIFF byte order')
+        (magic, self.ifd0) = struct.unpack(self._byte_order + 'HI', header[2:])
+        if magic != 42:
+            raise _FormatError('Bad TIFF header')
+
+    def read_ifd(self, offset):
+        """Returns the entries of the directory at offset, as a map of tag ->
+        (type, count, value or value offset bytes)."""
+        (count,) = struct.unpack(self._byte_order + 'H', self._read_at(offset, 2))
+        data = self._read_at(offset + 2, count * 12)
+        entries = {}
+        for i in xrange(count):
+            (tag, field_type, value_count) = struct.unpack(
+                self._byte_order + 'HHI', data[i * 12:i * 12 + 8])
+            entries[tag] = (field_type, value_count, data[i * 12 + 8:i * 12 + 12])
+        return entries
+
+    def get_bytes(self, entries, tag):
+        """Returns the raw value of a tag, or None."""
+        entry = entries.get(tag)
+        if not entry or entry[0] not in _TIFF_TYPES:
+            return None
+        (field_type, count, value) = entry
+        size = _TIFF_TYPES[field_type][0] * count
+        if size <= 4:
+            return value[:size]
+        if size > _MAX_VALUE_SIZE:
+            return None
+        (offset,) = struct.unpack(self._byte_order + 'I', value)
+        return self._read_at(offset, size)
+
+    def get_values(self, entries, tag):
+        """Returns the values of a numeric tag as a list (rationals as
+        (numerator, denominator) tuples), or None."""
+        data = self.get_bytes(entries, tag)
+        if data is None:
+            return None
+        (field_type, count, _) = entries[tag]
+        value_format = _TIFF_TYPES[field_type][1]
+        values = struct.unpack(self._byte_order + value_format * count, data)
+        if len(value_format) == 2:
+            values = zip(values[::2], values[1::2])
+        return list(values)
+
+    def get_ascii(self, entries, tag):
+        """Returns the value of an ASCII tag as a string, or None."""
+        data = self.get_bytes(entries, tag)
+        return None if data is None else _decode_ascii(data)
+
+    def get_offset(self, entries, tag):
+        """Returns the offset stored in a pointer tag, or None."""
+        values = self.get_values(entries, tag)
+        return values[0] if values else None
+
+
+def _get_gps_coordinate(reader, entries, ref_tag, value_tag, positive, negative):
+    """Returns a GPS coordinate like "37.645267 N", or None."""
+    ref = reader.get_ascii(entries, ref_tag)
+    values = reader.get_values(entries, value_tag)
+    if not ref or not values or len(values) != 3:
+        return None
+    coordinate = 0.0
+    for (i, (numerator, denominator)) in enumerate(values):
+        if not denominator:
+            return None
+        coordinate += float(numerator) / denominator / (60 ** i)
+    return u'%.6f %s' % (coordinate, negative if ref.upper() == negative else positive)
+
+def _read_tiff_tags(reader, tags, is_tiff_file):
+    """Adds the tags from TIFF data to tags. For a TIFF file, also adds the
+    XMP and IPTC data stored in IFD0."""
+    ifd0 = reader.read_ifd(reader.ifd0)
+    _add_tag(tags, 'IFD0:ImageDescription',
+             reader.get_ascii(ifd0, _TAG_IMAGE_DESCRIPTION))
+    exif_offset = reader.get_offset(ifd0, _TAG_EXIF_IFD)
+    if exif_offset:
+        exif_ifd = reader.read_ifd(exif_offset)
+        _add_tag(tags, 'ExifIFD:DateTimeOriginal',
+                 reader.get_ascii(exif_ifd, _TAG_DATE_TIME_ORIGINAL))
+    gps_offset = reader.get_offset(ifd0, _TAG_GPS_IFD)
+    if gps_offset:
+        gps_ifd = reader.read_ifd(gps_offset)
+        latitude = _get_gps_coordinate(reader, gps_ifd, _TAG_GPS_LATITUDE_REF,
+                                       _TAG_GPS_LATITUDE, u'N', u'S')
+        longitude = _get_gps_coordinate(reader, gps_ifd, _TAG_GPS_LONGITUDE_REF,
+                                        _TAG_GPS_LONGITUDE, u'E', u'W')
+        if latitude and longitude:
+            _add_tag(tags, 'Composite:GPSLatitude', latitude)
+            _add_tag(tags, 'Composite:GPSLongitude', longitude)
+    if is_tiff_file:
+        xmp = reader.get_bytes(ifd0, _TAG_XMP)
+        if xmp:
+            _read_xmp_tags(xmp, tags)
+        iptc = reader.get_bytes(ifd0, _TAG_IPTC)
+        if iptc is None:
+            iptc = _get_photoshop_iptc(reader.get_bytes(ifd0, _TAG_PHOTOSHOP) or '')
+        if iptc:
+            _read_iptc_tags(iptc, tags)
+
+
+def _get_photoshop_iptc(data):
+    """Returns the IPTC-IIM data from Photoshop image resources, or None."""
+    pos = 0
+    while pos + 12 <= len(data) and data[pos:pos + 4] == '8BIM':
+        (resource_id, name_length) = struct.unpack('>HB', data[pos + 4:pos + 7])
+        # The name is a Pascal string, padded to an even size.
+        pos += 6 + ((name_length + 2) & ~1)
+        (size,) = struct.unpack('>I', data[pos:pos + 4])
+        pos += 4
+        if resource_id == _PHOTOSHOP_IPTC:
+            return data[pos:pos + size]
+        pos += (size + 1) & ~1
+    return None
+
+def _read_iptc_tags(data, tags):
+    """Adds the keywords and caption from IPTC-IIM data to tags."""
+    datasets = []
+    pos = 0
+    while pos + 5 <= len(data) and data[pos] == '\x1c':
+        (record, dataset, size) = struct.unpack('>BBH', data[pos + 1:pos + 5])
+        pos += 5
+        if size & 0x8000:
+            # Extended dataset: the size is stored in the next bytes.
+            length = size & 0x7FFF
+            size = 0
+            for byte in data[pos:pos + length]:
+                size = (size << 8) + ord(byte)
+            pos += length
+        datasets.append(((record, dataset), data[pos:pos + size]))
+        pos += size
+    # Like exiftool, assume Latin-1 (cp1252) unless the data say UTF-8.
+    encoding = 'cp1252'
+    for (key, value) in datasets:
+        if key == _IPTC_CODED_CHARACTER_SET and value == _IPTC_UTF8:
+            encoding = 'utf-8'
+    for (key, value) in datasets:
+        if key == _IPTC_KEYWORDS:
+            _add_tag(tags, 'IPTC:Keywords', value.decode(encoding, 'replace'))
+        elif key == _IPTC_CAPTION:
+            _add_tag(tags, 'IPTC:Caption-Abstract', value.decode(encoding, 'replace'))
+
+
+def _is_rdf_or_xml(name):
+    return name.startswith(_RDF) or name.startswith(_XML)
+
+def _get_xmp_properties(node):
+    """Returns the properties of an rdf:Description or structure element, as a
+    map of "{namespace}name" -> value."""
+    properties = {}
+    for (name, value) in node.attrib.iteritems():
+        if not _is_rdf_or_xml(name):
+            properties[name] = value
+    for child in node:
+        properties[child.tag] = _get_xmp_value(child)
+    return properties
+
+def _get_xmp_value(node):
+    """Returns the value of an XMP property element: a string, a list for
+    rdf:Bag, rdf:Seq and rdf:Alt, or a map for structures."""
+    if node.get(_RDF + 'parseType') == 'Resource':
+        return _get_xmp_properties(node)
+    if node.get(_RDF + 'resource') is not None:
+        return node.get(_RDF + 'resource')
+    for child in node:
+        if child.tag in (_RDF + 'Bag', _RDF + 'Seq', _RDF + 'Alt'):
+            return [_get_xmp_value(item) for item in child if item.tag == _RDF + 'li']
+        if child.tag == _RDF + 'Description':
+            return _get_xmp_properties(child)
+    if len(node) or [name for name in node.attrib if not _is_rdf_or_xml(name)]:
+        return _get_xmp_properties(node)
+    return node.text or u''
+
+def _get_xmp_date(value):
+    """Converts an XMP date like "2010-07-04T18:30:00+02:00" into the exiftool
+    format "2010:07:04 18:30:00+02:00"."""
+    (date, _, date_time) = value.partition('T')
+    return date.replace('-', ':') + (' ' + date_time if date_time else '')
+
+def _get_xmp_gps_coordinate(value):
+    """Converts an XMP GPS coordinate like "37,38.72N" or "37,38,43.2N" into
+    the exiftool format "37.645333 N", or returns None."""
+    if not value or value[-1].upper() not in 'NSEW':
+        return None
+    coordinate = 0.0
+    try:
+        for (i, part) in enumerate(value[:-1].split(',')):
+            coordinate += float(part) / (60 ** i)
+    except ValueError:
+        return None
+    return u'%.6f %s' % (coordinate, value[-1].upper())
+
+def _read_xmp_tags(data, tags):
+    """Adds the keywords, description, date, location, rating, hierarchical
+    keywords, camera raw state and face regions from an XMP packet to tags."""
+    try:
+        root = cElementTree.fromstring(data.strip('\0 \t\r\n'))
+    except SyntaxError, ex:
+        raise _FormatError('Bad XMP data: %s' % (ex))
+    rdf = root if root.tag == _RDF + 'RDF' else root.find('.//' + _RDF + 'RDF')
+    if rdf is None:
+        return
+    properties = {}
+    for description in rdf.findall(_RDF + 'Description'):
+        properties.update(_get_xmp_properties(description))
+
+    def add_values(name, value):
+        for item in value if isinstance(value, list) else [value]:
+            if not isinstance(item, dict):
+                _add_tag(tags, name, item)
+
+    add_values('XMP-dc:Subject', properties.get(_NS_DC + 'subject'))
+    descriptions = properties.get(_NS_DC + 'description')
+    if descriptions:
+        # Only the default language of the rdf:Alt.
+        add_values('XMP-dc:Description', descriptions[0]
+                   if isinstance(descriptions, list) else descriptions)
+    date_time_original = properties.get(_NS_EXIF + 'DateTimeOriginal')
+    if isinstance(date_time_original, basestring):
+        add_values('XMP-exif:DateTimeOriginal', _get_xmp_date(date_time_original))
+    for name in ('GPSLatitude', 'GPSLongitude'):
+        coordinate = properties.get(_NS_EXIF + name)
+        if isinstance(coordinate, basestring):
+            add_values('XMP-exif:' + name, _get_xmp_gps_coordinate(coordinate))
+    add_values('XMP-xmp:Rating', properties.get(_NS_XMP + 'Rating'))
+    add_values('XMP-lr:HierarchicalSubject', properties.get(_NS_LR + 'hierarchicalSubject'))
+    add_values('XMP-crs:AlreadyApplied', properties.get(_NS_CRS + 'AlreadyApplied'))
+    regions = properties.get(_NS_MWG_RS + 'Regions')
+    region_list = regions.get(_NS_MWG_RS + 'RegionList') if isinstance(regions, dict) else None
+    if not isinstance(region_list, list):
+        return
+    # Flattened like exiftool does it: one list per field, with missing
+    # values skipped.
+    for region in region_list:
+        if not isinstance(region, dict):
+            continue
+        add_values('XMP-mwg-rs:RegionName', region.get(_NS_MWG_RS + 'Name'))
+        add_values('XMP-mwg-rs:RegionType', region.get(_NS_MWG_RS + 'Type'))
+        area = region.get(_NS_MWG_RS + 'Area')
+        if isinstance(area, dict):
+            for field in ('X', 'Y', 'W', 'H'):
+                add_values('XMP-mwg-rs:RegionArea' + field,
+                           area.get(_NS_ST_AREA + field.lower()))
+
+
+def _read_jpeg_tags(image_file, tags):
+    """Adds the tags of a JPEG file to tags, reading only the segments before
+    the image data."""
+    jpeg = open(image_file, 'rb')
+    try:
+        if jpeg.read(2) != '\xff' + chr(_SOI):
+            raise _FormatError('Not a JPEG file')
+        exif = None
+        xmp = None
+        photoshop = []
+        while True:
+            marker = jpeg.read(2)
+            if len(marker) != 2 or marker[0] != '\xff':
+                raise _FormatError('Bad JPEG marker')
+            code = ord(marker[1])
+            while code == 0xFF:
+                # Fill bytes.
+                code = ord(jpeg.read(1) or '\0')
+            if code in (_SOS, _EOI):
+                break
+            if 0xD0 <= code <= 0xD7 or code == 0x01:
+                continue
+            (length,) = struct.unpack('>H', jpeg.read(2))
+            if code not in _SOF_MARKERS and code != _APP1 and code != _APP13:
+                jpeg.seek(length - 2, 1)
+                continue
+            segment = jpeg.read(length - 2)
+            if len(segment) != length - 2:
+                raise _FormatError('Truncated JPEG segment')
+            if code in _SOF_MARKERS:
+                if 'File:ImageWidth' not in tags:
+                    (height, width) = struct.unpack('>HH', segment[1:5])
+                    _add_tag(tags, 'File:ImageWidth', str(width))
+                    _add_tag(tags, 'File:ImageHeight', str(height))
+            elif code == _APP1:
+                if segment.startswith(_EXIF_HEADER) and exif is None:
+                    exif = segment[len(_EXIF_HEADER):]
+                elif segment.startswith(_XMP_HEADER) and xmp is None:
+                    xmp = segment[len(_XMP_HEADER):]
+                elif segment.startswith(_XMP_EXTENSION_HEADER):
+                    raise _FormatError('Extended XMP')
+            elif segment.startswith(_PHOTOSHOP_HEADER):
+                photoshop.append(segment[len(_PHOTOSHOP_HEADER):])
+    finally:
+        jpeg.close()
+
+    if exif:
+        def read_at(offset, size):
+            data = exif[offset:offset + size]
+            if len(data) != size:
+                raise _FormatError('Truncated EXIF data')
+            return data
+        _read_tiff_tags(_TiffReader(read_at), tags, False)
+    if xmp:
+        _read_xmp_tags(xmp, tags)
+    iptc = _get_photoshop_iptc(''.join(photoshop))
+    if iptc:
+        _read_iptc_tags(iptc, tags)
+
+def _read_tiff_file_tags(image_file, tags):
+    """Adds the tags of a TIFF file to tags."""
+    tiff = open(image_file, 'rb')
+    try:
+        def read_at(offset, size):
+            tiff.seek(offset)
+            data = tiff.read(size)
+            if len(data) != size:
+                raise _FormatError('Truncated TIFF file')
+            return data
+        # exiftool reports the dimensions of TIFF files as IFD0 tags, not
+        # File:ImageWidth and File:ImageHeight, so they are not read here.
+        _read_tiff_tags(_TiffReader(read_at), tags, True)
+    finally:
+        tiff.close()
+
+
+def _read_xmp_file_tags(xmp_file, tags):
+    """Adds the tags of an XMP sidecar file to tags."""
+    xmp = open(xmp_file, 'rb')
+    try:
+        data = xmp.read(_MAX_VALUE_SIZE + 1)
+    finally:
+        xmp.close()
+    if len(data) > _MAX_VALUE_SIZE:
+        raise _FormatError('XMP file too large')
+    _read_xmp_tags(data, tags)
+
+
+def can_read(image_file):
+    """Tests if read_tags() supports the format of image_file, based on its
+    extension."""
+    return su.getfileextension(image_file) in (
+        _JPEG_EXTENSIONS + _TIFF_EXTENSIONS + _XMP_EXTENSIONS)
+
+def read_tags(image_file):
+    """Reads the meta data of a JPEG, TIFF or XMP sidecar file.
+
+    Returns:
+      a map of exiftool tag name (like "IPTC:Keywords") -> list of values,
+      or None if the file has another format, or could not be read
+      completely.
+    """
+    extension = su.getfileextension(image_file)
+    tags = {}
+    try:
+        if extension in _JPEG_EXTENSIONS:
+            _read_jpeg_tags(image_file, tags)
+        elif extension in _TIFF_EXTENSIONS:
+            _read_tiff_file_tags(image_file, tags)
+        elif extension in _XMP_EXTENSIONS:
+            _read_xmp_file_tags(image_file, tags)
+        else:
+            return None
+    except (_FormatError, IOError, OSError, struct.error, UnicodeError):
+        return None
+    return tags
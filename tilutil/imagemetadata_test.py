@@ -0,0 +1,248 @@
+"""This module tests imagemetadata.py."""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import tilutil.exiftool as exiftool
+import tilutil.imagemetadata as imagemetadata
+
+_XMP = '''<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmlns:lr="http://ns.adobe.com/lightroom/1.0/"
+    xmlns:crs="http://ns.adobe.com/camera-raw-settings/1.0/"
+    xmlns:mwg-rs="http://www.metadataworkinggroup.com/schemas/regions/"
+    xmlns:stArea="http://ns.adobe.com/xmp/sType/Area#"
+    xmp:Rating="4" crs:AlreadyApplied="True">
+   <lr:hierarchicalSubject>
+    <rdf:Bag>
+     <rdf:li>People|Ann</rdf:li>
+     <rdf:li>Places|Beach</rdf:li>
+    </rdf:Bag>
+   </lr:hierarchicalSubject>
+   <mwg-rs:Regions rdf:parseType="Resource">
+    <mwg-rs:RegionList>
+     <rdf:Bag>
+      <rdf:li rdf:parseType="Resource">
+       <mwg-rs:Name>Bob</mwg-rs:Name>
+       <mwg-rs:Type>Face</mwg-rs:Type>
+       <mwg-rs:Area stArea:x="0.75" stArea:y="0.5" stArea:w="0.1" stArea:h="0.2"/>
+      </rdf:li>
+      <rdf:li>
+       <rdf:Description mwg-rs:Name="Ann" mwg-rs:Type="Face">
+        <mwg-rs:Area>
+         <rdf:Description stArea:x="0.25" stArea:y="0.5" stArea:w="0.1" stArea:h="0.2"/>
+        </mwg-rs:Area>
+       </rdf:Description>
+      </rdf:li>
+     </rdf:Bag>
+    </mwg-rs:RegionList>
+   </mwg-rs:Regions>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>'''
+
+def _make_iim():
+    """Returns IPTC-IIM data with a UTF-8 character set, two keywords and a
+    caption."""
+    datasets = [(1, 90, '\x1b%G'), (2, 25, 'Beach'), (2, 25, 'Caf\xc3\xa9'),
+                (2, 120, 'Sunset')]
+    return ''.join([struct.pack('>BBBH', 0x1c, record, dataset, len(value)) + value
+                    for (record, dataset, value) in datasets])
+
+def _make_photoshop(iim):
+    """Wraps IPTC-IIM data into a Photoshop image resource."""
+    return '8BIM' + struct.pack('>HBBI', 0x0404, 0, 0, len(iim)) + iim + (
+        '\0' if len(iim) % 2 else '')
+
+def _make_ifd(byte_order, offset, entries):
+    """Returns a TIFF directory at offset, followed by the values that don't
+    fit into the entries. entries are (tag, type, count, value bytes)."""
+    values_offset = offset + 2 + len(entries) * 12 + 4
+    ifd = struct.pack(byte_order + 'H', len(entries))
+    values = ''
+    for (tag, field_type, count, value) in sorted(entries):
+        if len(value) <= 4:
+            ifd += struct.pack(byte_order + 'HHI', tag, field_type, count) + value.ljust(4, '\0')
+        else:
+            ifd += struct.pack(byte_order + 'HHII', tag, field_type, count,
+                               values_offset + len(values))
+            values += value + ('\0' if len(value) % 2 else '')
+    return ifd + struct.pack(byte_order + 'I', 0) + values
+
+def _make_tiff(byte_order, extra_entries=()):
+    """Returns TIFF data with a description, date, GPS location, and
+    extra_entries in IFD0."""
+    def ascii(value):
+        return (2, len(value) + 1, value + '\0')
+    def rationals(*values):
+        return (5, len(values), ''.join([struct.pack(byte_order + 'II', n, d)
+                                         for (n, d) in values]))
+    def make_ifd0(exif_offset, gps_offset):
+        entries = [(0x010E,) + ascii('Description'),
+                   (0x8769, 4, 1, struct.pack(byte_order + 'I', exif_offset)),
+                   (0x8825, 4, 1, struct.pack(byte_order + 'I', gps_offset))]
+        return _make_ifd(byte_order, 8, entries + list(extra_entries))
+    exif_offset = 8 + len(make_ifd0(0, 0))
+    exif_ifd = _make_ifd(byte_order, exif_offset, [(0x9003,) + ascii('2010:07:04 18:30:00')])
+    gps_offset = exif_offset + len(exif_ifd)
+    gps_ifd = _make_ifd(byte_order, gps_offset, [
+        (1,) + ascii('N'), (2,) + rationals((37, 1), (38, 1), (4320, 100)),
+        (3,) + ascii('W'), (4,) + rationals((122, 1), (25, 1), (0, 1))])
+    header = ('II' if byte_order == '<' else 'MM') + struct.pack(byte_order + 'HI', 42, 8)
+    return header + make_ifd0(exif_offset, gps_offset) + exif_ifd + gps_ifd
+
+def _make_segment(marker, data):
+    return struct.pack('>BBH', 0xFF, marker, len(data) + 2) + data
+
+def _make_jpeg(segments=None):
+    """Returns a JPEG file with EXIF, XMP and IPTC data."""
+    if segments is None:
+        segments = [
+            _make_segment(0xE0, 'JFIF\0\1\1\0\0\1\0\1\0\0'),
+            _make_segment(0xE1, 'Exif\0\0' + _make_tiff('<')),
+            _make_segment(0xE1, 'http://ns.adobe.com/xap/1.0/\0' + _XMP),
+            _make_segment(0xED, 'Photoshop 3.0\0' + _make_photoshop(_make_iim())),
+            _make_segment(0xC0, struct.pack('>BHHB', 8, 480, 640, 0)),
+            _make_segment(0xDA, '\0' * 10)]
+    return '\xff\xd8' + ''.join(segments) + '\xff\x00\x12\x34\xff\xd9'
+
+
+class ImageMetadataTest(unittest.TestCase):
+    """Unit tests for imagemetadata.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, data):
+        file_path = os.path.join(self.folder, name)
+        out = open(file_path, 'wb')
+        out.write(data)
+        out.close()
+        return file_path
+
+    def test_read_jpeg(self):
+        """Tests reading the tags of a JPEG file."""
+        tags = imagemetadata.read_tags(self._write('IMG_0001.JPG', _make_jpeg()))
+        self.assertEquals({
+            'File:ImageWidth': [u'640'],
+            'File:ImageHeight': [u'480'],
+            'IFD0:ImageDescription': [u'Description'],
+            'ExifIFD:DateTimeOriginal': [u'2010:07:04 18:30:00'],
+            'Composite:GPSLatitude': [u'37.645333 N'],
+            'Composite:GPSLongitude': [u'122.416667 W'],
+            'IPTC:Keywords': [u'Beach', u'Caf\xe9'],
+            'IPTC:Caption-Abstract': [u'Sunset'],
+            'XMP-xmp:Rating': [u'4'],
+            'XMP-crs:AlreadyApplied': [u'True'],
+            'XMP-lr:HierarchicalSubject': [u'People|Ann', u'Places|Beach'],
+            'XMP-mwg-rs:RegionName': [u'Bob', u'Ann'],
+            'XMP-mwg-rs:RegionType': [u'Face', u'Face'],
+            'XMP-mwg-rs:RegionAreaX': [u'0.75', u'0.25'],
+            'XMP-mwg-rs:RegionAreaY': [u'0.5', u'0.5'],
+            'XMP-mwg-rs:RegionAreaW': [u'0.1', u'0.1'],
+            'XMP-mwg-rs:RegionAreaH': [u'0.2', u'0.2'],
+            }, tags)
+
+    def test_read_tiff(self):
+        """Tests reading the tags of a TIFF file, with XMP and IPTC data in
+        IFD0."""
+        xmp = _XMP.replace('xmp:Rating="4"', 'xmp:Rating="2"')
+        tiff = _make_tiff('>', [(0x02BC, 1, len(xmp), xmp),
+                                (0x83BB, 7, len(_make_iim()), _make_iim())])
+        tags = imagemetadata.read_tags(self._write('IMG_0001.tif', tiff))
+        self.assertEquals([u'Description'], tags['IFD0:ImageDescription'])
+        self.assertEquals([u'37.645333 N'], tags['Composite:GPSLatitude'])
+        self.assertEquals([u'Beach', u'Caf\xe9'], tags['IPTC:Keywords'])
+        self.assertEquals([u'2'], tags['XMP-xmp:Rating'])
+        self.assertFalse('File:ImageWidth' in tags)
+
+    def test_read_sidecar(self):
+        """Tests reading the tags of an XMP sidecar file."""
+        xmp = _XMP.replace(
+            'xmp:Rating="4"',
+            'xmp:Rating="4" exif:DateTimeOriginal="2010-07-04T18:30:00"'
+            ' exif:GPSLatitude="37,38.72N" exif:GPSLongitude="122,25.0W"'
+            ' xmlns:exif="http://ns.adobe.com/exif/1.0/"'
+            ' xmlns:dc="http://purl.org/dc/elements/1.1/"').replace(
+            '   <lr:hierarchicalSubject>',
+            '   <dc:subject><rdf:Bag><rdf:li>Beach</rdf:li></rdf:Bag></dc:subject>\n'
+            '   <dc:description><rdf:Alt><rdf:li xml:lang="x-default">Sunset</rdf:li>'
+            '</rdf:Alt></dc:description>\n'
+            '   <lr:hierarchicalSubject>')
+        self.assertTrue(imagemetadata.can_read('IMG_0001.xmp'))
+        tags = imagemetadata.read_tags(self._write('IMG_0001.xmp', xmp))
+        self.assertEquals([u'Beach'], tags['XMP-dc:Subject'])
+        self.assertEquals([u'Sunset'], tags['XMP-dc:Description'])
+        self.assertEquals([u'2010:07:04 18:30:00'], tags['XMP-exif:DateTimeOriginal'])
+        self.assertEquals([u'37.645333 N'], tags['XMP-exif:GPSLatitude'])
+        self.assertEquals([u'122.416667 W'], tags['XMP-exif:GPSLongitude'])
+        self.assertEquals([u'4'], tags['XMP-xmp:Rating'])
+
+        iptc_data = exiftool.get_iptc_data(os.path.join(self.folder, 'IMG_0001.xmp'),
+                                           use_cache=False)
+        self.assertEquals([u'Beach'], iptc_data.keywords)
+        self.assertEquals(u'Sunset', iptc_data.caption)
+        self.assertEquals(2010, iptc_data.date_time_original.year)
+        self.assertAlmostEquals(-122.416667, iptc_data.gps.longitude)
+
+    def test_unsupported(self):
+        """Tests that files that need exiftool are rejected."""
+        jpeg = _make_jpeg()
+        self.assertEquals(None, imagemetadata.read_tags(self._write('IMG_0001.CR2', jpeg)))
+        self.assertFalse(imagemetadata.can_read('IMG_0001.CR2'))
+        self.assertEquals(None, imagemetadata.read_tags(self._write('empty.jpg', '')))
+        self.assertEquals(None, imagemetadata.read_tags(
+            self._write('truncated.jpg', jpeg[:200])))
+        extended = _make_jpeg([_make_segment(
+            0xE1, 'http://ns.adobe.com/xmp/extension/\0' + '0' * 40)])
+        self.assertEquals(None, imagemetadata.read_tags(self._write('extended.jpg', extended)))
+        self.assertEquals(None, imagemetadata.read_tags(
+            os.path.join(self.folder, 'missing.jpg')))
+
+    def test_get_iptc_data(self):
+        """Tests that exiftool.get_iptc_data() reads JPEG files without
+        exiftool."""
+        old_exiftool = exiftool.EXIFTOOL
+        exiftool.close_session()
+        exiftool.EXIFTOOL = os.path.join(self.folder, 'no-exiftool')
+        try:
+            image_file = self._write('IMG_0001.JPG', _make_jpeg())
+            iptc_data = exiftool.get_iptc_data(image_file, use_cache=False)
+            self.assertEquals(image_file, iptc_data.image_file)
+            self.assertEquals([u'Beach', u'Caf\xe9'], iptc_data.keywords)
+            self.assertEquals(u'Sunset', iptc_data.caption)
+            self.assertEquals(4, iptc_data.rating)
+            self.assertEquals((640, 480), (iptc_data.image_width, iptc_data.image_height))
+            self.assertEquals(2010, iptc_data.date_time_original.year)
+            self.assertAlmostEquals(-122.416667, iptc_data.gps.longitude)
+            # Regions are sorted from left to right.
+            self.assertEquals([u'Ann', u'Bob'], iptc_data.region_names)
+            self.assertEquals([u'Ann'], iptc_data.get_category_keywords(u'People'))
+        finally:
+            exiftool.close_session()
+            exiftool.EXIFTOOL = old_exiftool
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,8 +20,9 @@
 import logging
 import os
 import re
-import shutil
 import sys
+import threading
+import tilutil.filecopy as filecopy
 import tilutil.systemutils as su
 import unicodedata
 
@@ -47,6 +48,10 @@ class _NullHandler(logging.Handler):
 _logger = logging.getLogger("google.imageutils")
 _logger.addHandler(_NullHandler())
 
+# Guards the max_create, max_delete, and max_update counters in options, which
+# are shared by the export worker threads.
+_limit_lock = threading.Lock()
+
 def check_convert():
     """Tests if ImageMagick convert tool is available. Prints error message
        to sys.stderr if there is a problem."""
@@ -70,11 +75,12 @@ from http://www.imagemagick.org/script/index.php
 def should_create(options):
     """Returns True if a create should be performed, based on options. Does not
        check options.dryrun."""
-    if not options.max_create:
-        print 'Item not created because create limit has been reached.'
-        return False
-    if options.max_create != -1:
-        options.max_create -= 1
+    with _limit_lock:
+        if not options.max_create:
+            print 'Item not created because create limit has been reached.'
+            return False
+        if options.max_create != -1:
+            options.max_create -= 1
     return True
 
 def should_delete(options):
@@ -84,11 +90,12 @@ def should_delete(options):
         if not options.dryrun:
             print 'Invoke phoshare with the -d option to delete this item.'
         return False
-    if not options.max_delete:
-        print 'Item not deleted because delete limit has been reached.'
-        return False
-    if options.max_delete != -1:
-        options.max_delete -= 1
+    with _limit_lock:
+        if not options.max_delete:
+            print 'Item not deleted because delete limit has been reached.'
+            return False
+        if options.max_delete != -1:
+            options.max_delete -= 1
     return True
 
 def should_update(options):
@@ -98,11 +105,12 @@ def should_update(options):
         if not options.dryrun:
             print 'Invoke phoshare with the -u option to update this item.'
         return False
-    if not options.max_update:
-        print 'Item not updated because update limit has been reached.'
-        return False
-    if options.max_update != -1:
-        options.max_update -= 1
+    with _limit_lock:
+        if not options.max_update:
+            print 'Item not updated because update limit has been reached.'
+            return False
+        if options.max_update != -1:
+            options.max_update -= 1
     return True
 
 def is_ignore(file_name):
@@ -257,10 +265,22 @@ class GpsLocation(object):
     # to be considered identical.
     _MIN_GPS_DIFF = 0.0001
 
+    __slots__ = ('latitude', 'longitude')
+
     def __init__(self, latitude=0.0, longitude=0.0):
         """Constructs a GpsLocation object."""
         self.latitude = latitude
         self.longitude = longitude
+
+    def __getstate__(self):
+        # Classes with __slots__ need this for pickle protocols 0 and 1.
+        return (self.latitude, self.longitude)
+
+    def __setstate__(self, state):
+        # The .phoshare files of older versions have the __dict__ as state.
+        if isinstance(state, dict):
+            state = (state.get('latitude', 0.0), state.get('longitude', 0.0))
+        (self.latitude, self.longitude) = state
         
     def from_gdata_point(self, point):
         """Sets location from a Point.
@@ -566,8 +586,8 @@ def copy_or_link_file(source, target, dryrun=False, link=False, size=None,
                 _logger.error(u'%s: %s' % (source, result))
                 return False
         else:
-            _logger.debug(u'shutil.copy2(%s, %s)', source, target)
-            shutil.copy2(source, target)
+            method = filecopy.copy_file(source, target)
+            _logger.debug(u'filecopy.copy_file(%s, %s): %s', source, target, method)
         return True
     except (OSError, IOError) as ex:
         _logger.error(u'%s: %s' % (source, str(ex)))
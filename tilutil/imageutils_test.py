@@ -15,6 +15,7 @@
 #   limitations under the License.'''
 
 import datetime
+import threading
 import unittest
 import tilutil.imageutils as iu
             
@@ -165,6 +166,24 @@ class ImageUtilsTest(unittest.TestCase):
         # Bad template
         self.assertEqual(' badfield ', iu.format_photo_name(image, 'aaaa', 5, '05', '{badfield}'))
 
+    def test_should_create_threads(self):
+        """Tests that the create limit holds with concurrent callers."""
+        class Options(object):
+            max_create = 250
+        options = Options()
+        created = []
+        def create():
+            for _ in xrange(100):
+                if iu.should_create(options):
+                    created.append(1)
+        threads = [threading.Thread(target=create) for _ in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(250, len(created))
+        self.assertEqual(0, options.max_create)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,240 @@
+'''A persistent cache for meta data read from files.
+
+The cache is a single SQLite database. Each entry is keyed by the path of a
+file, and remembers the inode, modification time and size the file had when
+its meta data were read. An entry is only returned while the file still has
+the same inode, modification time and size, so that changed files are read
+again.
+
+The cache also keeps a fingerprint for each file, which callers use to
+remember that a file is known to hold some meta data, with the same
+inode, modification time and size rules.
+
+Writes are collected in memory, and written in a single transaction by
+flush(), which happens automatically after _FLUSH_INTERVAL seconds or
+_MAX_PENDING entries. A crash loses the unflushed entries, but never
+corrupts the cache.
+'''
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import tilutil.systemutils as su
+
+# Maximum number of seconds that new entries stay unsaved.
+_FLUSH_INTERVAL = 30
+
+# Maximum number of new entries that are kept unsaved.
+_MAX_PENDING = 1000
+
+# Maximum number of paths in one select statement (SQLite allows 999
+# parameters).
+_MAX_LOOKUP = 500
+
+_SCHEMA = (
+    '''create table if not exists info (name text primary key, value text)''',
+    '''create table if not exists files (
+           path text primary key, inode integer, mtime real, size integer,
+           created real, data blob)''',
+    '''create table if not exists imports (folder text primary key, mtime real)''',
+    '''create table if not exists fingerprints (
+           path text primary key, inode integer, mtime real, size integer,
+           created real, fingerprint text)''',
+)
+
+def get_file_signature(file_path):
+    """Returns (inode, modification time, size) of a file, or None if it does
+    not exist."""
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+
+
+class MetadataCache(object):
+    """A cache of meta data for files, stored in an SQLite database.
+
+    Args:
+      cache_file: path of the database file. Created if it does not exist.
+      version: version of the cached data. A cache with a different
+        version is cleared.
+      max_age: maximum age of entries in seconds. Entries expire at a random
+        time during the last 20% of their life, so that they don't all expire
+        at the same time.
+
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, cache_file, version, max_age):
+        self.cache_file = cache_file
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # path -> (inode, mtime, size, created, pickled value)
+        self._pending = {}
+        # path -> (inode, mtime, size, created, fingerprint)
+        self._pending_fingerprints = {}
+        self._last_flush = time.time()
+        self._conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self._conn.execute('pragma journal_mode=wal')
+        self._conn.execute('pragma synchronous=normal')
+        with self._conn:
+            for statement in _SCHEMA:
+                self._conn.execute(statement)
+            row = self._conn.execute(
+                'select value from info where name = ?', ('version',)).fetchone()
+            if not row or row[0] != version:
+                self._conn.execute('delete from files')
+                self._conn.execute('delete from imports')
+                self._conn.execute('delete from fingerprints')
+                self._conn.execute('insert or replace into info values (?, ?)',
+                                   ('version', version))
+            for table in ('files', 'fingerprints'):
+                self._conn.execute('delete from %s where created < ?' % (table),
+                                   (time.time() - max_age,))
+
+    def _is_expired(self, created):
+        return time.time() - created > self.max_age - self.max_age * 0.2 * random.random()
+
+    def _lookup(self, table, column, pending, file_paths):
+        """Returns a map of file path -> column value for all files in
+        file_paths that have a current entry in table or pending."""
+        keys = {}
+        for file_path in file_paths:
+            keys[su.unicode_string(file_path)] = file_path
+        rows = {}
+        with self._lock:
+            for key in keys:
+                if key in pending:
+                    rows[key] = pending[key]
+            lookups = [key for key in keys if key not in rows]
+            for i in xrange(0, len(lookups), _MAX_LOOKUP):
+                batch = lookups[i:i + _MAX_LOOKUP]
+                for (path, inode, mtime, size, created, value) in self._conn.execute(
+                    'select path, inode, mtime, size, created, %s from %s '
+                    'where path in (%s)' % (column, table, ','.join('?' * len(batch))),
+                    batch):
+                    rows[path] = (inode, mtime, size, created, value)
+        result = {}
+        for (key, (inode, mtime, size, created, value)) in rows.iteritems():
+            if self._is_expired(created):
+                continue
+            if get_file_signature(key) != (inode, mtime, size):
+                continue
+            result[keys[key]] = value
+        return result
+
+    def get_many(self, file_paths):
+        """Returns a map of file path -> value for all files in file_paths
+        that have a current entry."""
+        result = self._lookup('files', 'data', self._pending, file_paths)
+        for (file_path, data) in result.iteritems():
+            result[file_path] = cPickle.loads(str(data))
+        return result
+
+    def get(self, file_path, default=None):
+        """Returns the value for file_path, or default if there is no current
+        entry."""
+        return self.get_many([file_path]).get(file_path, default)
+
+    def put_many(self, items, created=None):
+        """Stores a list of (file path, value) pairs. Files that don't exist
+        are skipped."""
+        if created is None:
+            created = time.time()
+        entries = []
+        for (file_path, value) in items:
+            signature = get_file_signature(file_path)
+            if signature:
+                data = buffer(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+                entries.append((su.unicode_string(file_path), signature + (created, data)))
+        with self._lock:
+            self._pending.update(entries)
+            if (len(self._pending) >= _MAX_PENDING or
+                time.time() - self._last_flush > _FLUSH_INTERVAL):
+                self._flush()
+
+    def put(self, file_path, value, created=None):
+        """Stores the value for file_path."""
+        self.put_many([(file_path, value)], created)
+
+    def get_fingerprints(self, file_paths):
+        """Returns a map of file path -> fingerprint for all files in
+        file_paths that have a current fingerprint."""
+        return self._lookup('fingerprints', 'fingerprint', self._pending_fingerprints,
+                            file_paths)
+
+    def put_fingerprint(self, file_path, fingerprint):
+        """Stores the fingerprint for file_path, as of its current inode,
+        modification time and size. Skipped if the file does not exist."""
+        signature = get_file_signature(file_path)
+        if not signature:
+            return
+        with self._lock:
+            self._pending_fingerprints[su.unicode_string(file_path)] = signature + (
+                time.time(), fingerprint)
+            if (len(self._pending_fingerprints) >= _MAX_PENDING or
+                time.time() - self._last_flush > _FLUSH_INTERVAL):
+                self._flush()
+
+    def _flush(self):
+        rows = [(path,) + entry for (path, entry) in self._pending.iteritems()]
+        fingerprint_rows = [(path,) + entry for (path, entry)
+                            in self._pending_fingerprints.iteritems()]
+        if rows or fingerprint_rows:
+            try:
+                with self._conn:
+                    self._conn.executemany(
+                        'insert or replace into files values (?, ?, ?, ?, ?, ?)', rows)
+                    self._conn.executemany(
+                        'insert or replace into fingerprints values (?, ?, ?, ?, ?, ?)',
+                        fingerprint_rows)
+            except sqlite3.Error, ex:
+                su.perr(u'Could not save meta data cache %s: %s' % (
+                    self.cache_file, unicode(ex)))
+        self._pending.clear()
+        self._pending_fingerprints.clear()
+        self._last_flush = time.time()
+
+    def flush(self):
+        """Saves all new entries."""
+        with self._lock:
+            self._flush()
+
+    def is_imported(self, folder, mtime):
+        """Tests if set_imported() was called for folder and mtime."""
+        with self._lock:
+            row = self._conn.execute('select mtime from imports where folder = ?',
+                                     (su.unicode_string(folder),)).fetchone()
+        return row is not None and row[0] == mtime
+
+    def set_imported(self, folder, mtime):
+        """Records that the data of some other cache in folder, last modified
+        at mtime, has been imported."""
+        with self._lock:
+            self._flush()
+            with self._conn:
+                self._conn.execute('insert or replace into imports values (?, ?)',
+                                   (su.unicode_string(folder), mtime))
+
+    def close(self):
+        """Saves all new entries, and closes the database."""
+        with self._lock:
+            self._flush()
+            self._conn.close()
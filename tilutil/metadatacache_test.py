@@ -0,0 +1,95 @@
+"""This module tests metadatacache.py."""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tilutil.metadatacache as metadatacache
+
+class MetadataCacheTest(unittest.TestCase):
+    """Unit tests for metadatacache.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.folder, 'cache.db')
+        self.files = []
+        for i in range(3):
+            file_path = os.path.join(self.folder, u'IMG_%04d.JPG' % (i))
+            open(file_path, 'w').close()
+            self.files.append(file_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_get_and_put(self):
+        """Tests storing and looking up entries."""
+        cache = metadatacache.MetadataCache(self.cache_file, 'v1', 3600)
+        cache.put_many([(self.files[0], {'caption': u'A'}), (self.files[1], None)])
+        self.assertEquals({self.files[0]: {'caption': u'A'}, self.files[1]: None},
+                          cache.get_many(self.files))
+        cache.close()
+
+        cache = metadatacache.MetadataCache(self.cache_file, 'v1', 3600)
+        self.assertEquals({'caption': u'A'}, cache.get(self.files[0]))
+        # Changed files have no entry.
+        open(self.files[0], 'w').write('changed')
+        self.assertEquals(None, cache.get(self.files[0], None))
+        self.assertEquals({self.files[1]: None}, cache.get_many(self.files))
+        cache.close()
+
+        # A new version clears the cache.
+        cache = metadatacache.MetadataCache(self.cache_file, 'v2', 3600)
+        self.assertEquals({}, cache.get_many(self.files))
+        cache.close()
+
+    def test_unflushed_entries(self):
+        """Tests that entries are only saved by flush()."""
+        cache = metadatacache.MetadataCache(self.cache_file, 'v1', 3600)
+        cache.put(self.files[0], 1)
+        other = metadatacache.MetadataCache(self.cache_file, 'v1', 3600)
+        self.assertEquals({}, other.get_many(self.files))
+        cache.flush()
+        self.assertEquals({self.files[0]: 1}, other.get_many(self.files))
+        cache.close()
+        other.close()
+
+    def test_imported(self):
+        """Tests recording imported folders."""
+        cache = metadatacache.MetadataCache(self.cache_file, 'v1', 3600)
+        self.assertFalse(cache.is_imported(self.folder, 1.0))
+        cache.set_imported(self.folder, 1.0)
+        self.assertTrue(cache.is_imported(self.folder, 1.0))
+        self.assertFalse(cache.is_imported(self.folder, 2.0))
+        cache.close()
+
+    def test_fingerprints(self):
+        """Tests that fingerprints are kept apart from values, and dropped
+        when a file changes."""
+        cache = metadatacache.MetadataCache(self.cache_file, 'v1', 3600)
+        cache.put(self.files[0], u'value')
+        cache.put_fingerprint(self.files[0], 'abc')
+        cache.put_fingerprint(os.path.join(self.folder, u'missing.JPG'), 'abc')
+        cache.close()
+
+        cache = metadatacache.MetadataCache(self.cache_file, 'v1', 3600)
+        self.assertEquals({self.files[0]: 'abc'}, cache.get_fingerprints(self.files))
+        self.assertEquals(u'value', cache.get(self.files[0]))
+        open(self.files[0], 'w').write('changed')
+        self.assertEquals({}, cache.get_fingerprints(self.files))
+        cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
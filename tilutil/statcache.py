@@ -0,0 +1,260 @@
+'''Caches the results of os.stat() and folder listings for the duration of an
+export run.
+
+Checking if an exported file is current looks at the existence, the
+modification time, the size and the inode of the same source and target
+files several times. On a network drive, each of these is a round trip to
+the server. The cache answers them from a single stat of each file.
+
+When a file is looked up in a folder that has not been seen yet, the folder
+is listed, with scandir if it is installed. The stat of a listed file is
+read when it is first needed; on platforms where scandir returns the stat
+data with the listing (Windows), that is free. Files that are not in the
+listing are looked up with os.stat(), so that file systems that ignore case
+or normalize Unicode names still find them.
+
+The listings also answer listdir() and isdir(), so that a folder tree is
+listed only once per run. isdir() uses the file type from the listing where
+scandir has it, without a stat.
+
+Whoever changes a file must call invalidate() for it. Changes made by other
+programs during a run are not noticed.
+'''
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import errno
+import os
+import stat
+import sys
+import threading
+import unicodedata
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+
+class _ListEntry(object):
+    """A file from os.listdir(), or a file that was changed after its folder
+    was listed, with the stat() and is_dir() methods of a scandir entry."""
+
+    def __init__(self, path, listed=True):
+        self.path = path
+        # False if the file might not exist anymore.
+        self.listed = listed
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+def _decode(path):
+    """Returns path as a unicode string. Listing a unicode folder name gives
+    back unicode file names."""
+    if isinstance(path, unicode):
+        return path
+    return path.decode(sys.getfilesystemencoding() or 'utf-8')
+
+def _normalize(name):
+    """Returns a file name as a unicode string in Unicode normalization form
+    C, like phoshare uses them. Mac OS X returns form D."""
+    return unicodedata.normalize("NFC", _decode(name))
+
+
+class StatCache(object):
+    """A cache of os.stat() results, filled from folder listings.
+
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # path -> stat result, or None if the file does not exist.
+        self._stats = {}
+        # folder -> map of file name in normalization form C -> entry with
+        # stat() and is_dir() methods, or None if the folder can't be listed.
+        self._listings = {}
+
+    def _list(self, folder):
+        """Returns the entries of folder, listing it if needed."""
+        if folder in self._listings:
+            return self._listings[folder]
+        entries = None
+        try:
+            unicode_folder = _decode(folder)
+            if scandir:
+                entries = dict((_normalize(entry.name), entry)
+                               for entry in scandir(unicode_folder))
+            else:
+                entries = dict((_normalize(name), _ListEntry(os.path.join(unicode_folder, name)))
+                               for name in os.listdir(unicode_folder))
+        except (OSError, UnicodeError):
+            pass
+        self._listings[folder] = entries
+        return entries
+
+    def _get_entry(self, path):
+        """Returns the listing entry for path, or None."""
+        (folder, name) = os.path.split(path)
+        entries = self._list(folder)
+        return entries.get(_normalize(name)) if entries else None
+
+    def listdir(self, folder):
+        """Returns the sorted names of the files in folder, in Unicode
+        normalization form C, like su.os_listdir_unicode(). Raises OSError if
+        folder can't be listed."""
+        with self._lock:
+            entries = self._list(folder)
+            if entries is None:
+                del self._listings[folder]
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), folder)
+            changed = [(name, entry) for (name, entry) in entries.iteritems()
+                       if isinstance(entry, _ListEntry) and not entry.listed]
+        for (name, entry) in changed:
+            if os.path.lexists(entry.path):
+                entry.listed = True
+            else:
+                with self._lock:
+                    if entries.get(name) is entry:
+                        del entries[name]
+        with self._lock:
+            return sorted(entries)
+
+    def isdir(self, path):
+        """Cached version of os.path.isdir()."""
+        with self._lock:
+            entry = self._get_entry(path)
+        if entry is None:
+            return os.path.isdir(path)
+        try:
+            return entry.is_dir()
+        except OSError:
+            return False
+
+    def stat(self, path):
+        """Returns the os.stat() result for path, or None if it does not
+        exist."""
+        with self._lock:
+            if path in self._stats:
+                return self._stats[path]
+            entry = self._get_entry(path)
+        try:
+            result = entry.stat() if entry else os.stat(path)
+        except OSError, ex:
+            if ex.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            result = None
+        with self._lock:
+            self._stats[path] = result
+        return result
+
+    def _get_stat(self, path):
+        """Like stat(), but raises OSError if path does not exist, like the
+        os.path functions do."""
+        result = self.stat(path)
+        if result is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return result
+
+    def exists(self, path):
+        """Cached version of os.path.exists()."""
+        return self.stat(path) is not None
+
+    def getmtime(self, path):
+        """Cached version of os.path.getmtime()."""
+        return self._get_stat(path).st_mtime
+
+    def getsize(self, path):
+        """Cached version of os.path.getsize()."""
+        return self._get_stat(path).st_size
+
+    def getinode(self, path):
+        """Returns the inode number of path."""
+        return self._get_stat(path).st_ino
+
+    def invalidate(self, path):
+        """Forgets what is known about path. Call after changing, creating or
+        deleting it."""
+        with self._lock:
+            self._stats.pop(path, None)
+            # path might have been a folder.
+            self._listings.pop(path, None)
+            prefix = os.path.join(path, '')
+            for folder in [f for f in self._listings if f.startswith(prefix)]:
+                del self._listings[folder]
+            (folder, name) = os.path.split(path)
+            entries = self._listings.get(folder)
+            if entries is not None:
+                entries[_normalize(name)] = _ListEntry(path, listed=False)
+            # os.makedirs() might have created the folders that were missing.
+            while folder in self._listings and self._listings[folder] is None:
+                del self._listings[folder]
+                self._stats.pop(folder, None)
+                (folder, name) = os.path.split(folder)
+                entries = self._listings.get(folder)
+                if entries is not None:
+                    entries[_normalize(name)] = _ListEntry(os.path.join(folder, name),
+                                                           listed=False)
+
+    def clear(self):
+        """Forgets everything."""
+        with self._lock:
+            self._stats.clear()
+            self._listings.clear()
+
+
+# The cache shared by the module functions.
+_cache = StatCache()
+
+def exists(path):
+    """Cached version of os.path.exists()."""
+    return _cache.exists(path)
+
+def isdir(path):
+    """Cached version of os.path.isdir()."""
+    return _cache.isdir(path)
+
+def listdir(folder):
+    """Returns the sorted names of the files in folder, in Unicode
+    normalization form C."""
+    return _cache.listdir(folder)
+
+def getmtime(path):
+    """Cached version of os.path.getmtime()."""
+    return _cache.getmtime(path)
+
+def getsize(path):
+    """Cached version of os.path.getsize()."""
+    return _cache.getsize(path)
+
+def getinode(path):
+    """Returns the inode number of path."""
+    return _cache.getinode(path)
+
+def invalidate(path):
+    """Forgets what is known about path. Call after changing, creating or
+    deleting it."""
+    _cache.invalidate(path)
+
+def clear():
+    """Forgets everything. Call at the start and the end of a run."""
+    _cache.clear()
@@ -0,0 +1,100 @@
+"""This module tests statcache.py."""
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unicodedata
+import unittest
+
+import tilutil.statcache as statcache
+
+class StatCacheTest(unittest.TestCase):
+    """Unit tests for statcache.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.folder, u'IMG_0001.JPG')
+        out = open(self.image_file, 'w')
+        out.write('data')
+        out.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_stat(self):
+        """Tests that results are cached until they are invalidated."""
+        cache = statcache.StatCache()
+        self.assertTrue(cache.exists(self.image_file))
+        self.assertEquals(4, cache.getsize(self.image_file))
+        self.assertEquals(os.stat(self.image_file).st_ino, cache.getinode(self.image_file))
+        os.utime(self.image_file, (1000, 1000))
+        self.assertNotEquals(1000, cache.getmtime(self.image_file))
+        cache.invalidate(self.image_file)
+        self.assertEquals(1000, cache.getmtime(self.image_file))
+
+    def test_missing(self):
+        """Tests files that don't exist, or are created after their folder
+        was listed."""
+        cache = statcache.StatCache()
+        new_file = os.path.join(self.folder, u'IMG_0002.JPG')
+        self.assertFalse(cache.exists(new_file))
+        self.assertRaises(OSError, cache.getmtime, new_file)
+        self.assertFalse(cache.exists(os.path.join(self.folder, u'missing', u'IMG.JPG')))
+        self.assertFalse(cache.exists(os.path.join(self.image_file, u'IMG.JPG')))
+        open(new_file, 'w').close()
+        cache.invalidate(new_file)
+        self.assertEquals(0, cache.getsize(new_file))
+        os.remove(self.image_file)
+        cache.invalidate(self.image_file)
+        self.assertFalse(cache.exists(self.image_file))
+
+    def test_listdir(self):
+        """Tests listdir() and isdir(), and that new folders show up in the
+        listings."""
+        cache = statcache.StatCache()
+        self.assertEquals([u'IMG_0001.JPG'], cache.listdir(self.folder))
+        self.assertFalse(cache.isdir(self.image_file))
+        self.assertTrue(cache.isdir(self.folder))
+        album = os.path.join(self.folder, u'Album', u'Summer')
+        self.assertFalse(cache.exists(album))
+        self.assertRaises(OSError, cache.listdir, album)
+        os.makedirs(album)
+        cache.invalidate(album)
+        self.assertEquals([u'Album', u'IMG_0001.JPG'], cache.listdir(self.folder))
+        self.assertTrue(cache.isdir(os.path.join(self.folder, u'Album')))
+        self.assertEquals([u'Summer'], cache.listdir(os.path.dirname(album)))
+        self.assertEquals([], cache.listdir(album))
+        shutil.rmtree(os.path.dirname(album))
+        cache.invalidate(os.path.dirname(album))
+        self.assertEquals([u'IMG_0001.JPG'], cache.listdir(self.folder))
+
+    def test_listdir_str(self):
+        """Tests that a byte string folder name gives unicode file names in
+        normalization form C."""
+        album = u'Caf\xe9'
+        try:
+            os.mkdir(os.path.join(self.folder, unicodedata.normalize('NFD', album)))
+        except UnicodeError:
+            self.skipTest('file system encoding can\'t encode %r' % (album))
+        cache = statcache.StatCache()
+        folder = self.folder.encode(sys.getfilesystemencoding())
+        self.assertEquals([album, u'IMG_0001.JPG'], cache.listdir(folder))
+        self.assertTrue(cache.isdir(os.path.join(folder, album)))
+        self.assertTrue(cache.isdir(os.path.join(folder, album).encode(
+            sys.getfilesystemencoding())))
+
+if __name__ == '__main__':
+    unittest.main()
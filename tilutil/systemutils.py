@@ -23,6 +23,7 @@ import logging
 import os
 import subprocess
 import sys
+import threading
 import unicodedata
 import MacOS
 
@@ -124,6 +125,51 @@ def fsdec(value):
         return ""
     return value.decode(_sysenc)
 
+# Output written by worker threads goes through these.
+_output_lock = threading.RLock()
+_thread_output = threading.local()
+
+class _SyncStream(object):
+    """Wraps sys.stdout or sys.stderr for use by several threads. Output of a
+    thread between hold_output() and release_output() is held back, and then
+    written in one piece, so that it does not get mixed up with the output of
+    other threads."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        held = getattr(_thread_output, 'held', None)
+        if held is not None:
+            held.append((self._stream, text))
+            return
+        with _output_lock:
+            self._stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+def sync_output():
+    """Makes sys.stdout and sys.stderr safe for use by several threads. Call
+    this before creating any logging handlers that write to them."""
+    if not isinstance(sys.stdout, _SyncStream):
+        sys.stdout = _SyncStream(sys.stdout)
+    if not isinstance(sys.stderr, _SyncStream):
+        sys.stderr = _SyncStream(sys.stderr)
+
+def hold_output():
+    """Holds back the output of the current thread until release_output()."""
+    _thread_output.held = []
+
+def release_output():
+    """Writes the output held back for the current thread."""
+    held = getattr(_thread_output, 'held', None)
+    _thread_output.held = None
+    if held:
+        with _output_lock:
+            for (stream, text) in held:
+                stream.write(text)
+
 def pout(msg):
     '''Prints a message to sys.stdout, taking care of character encodings.'''
     try:
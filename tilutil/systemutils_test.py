@@ -14,6 +14,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import threading
 import unittest
 
 import tilutil.systemutils as su
@@ -26,5 +27,26 @@ class SystemUtilsTest(unittest.TestCase):
         self.assertEquals("/usr", su.resolve_alias("/usr"))
         self.assertEquals("/private/tmp", su.resolve_alias("/tmp"))
 
+    def test_hold_output(self):
+        """Tests that held output of a thread is written in one piece."""
+        class Stream(object):
+            def __init__(self):
+                self.text = []
+            def write(self, text):
+                self.text.append(text)
+        stream = Stream()
+        sync_stream = su._SyncStream(stream)
+        su.hold_output()
+        sync_stream.write('a')
+        thread = threading.Thread(target=sync_stream.write, args=('b',))
+        thread.start()
+        thread.join()
+        sync_stream.write('c')
+        self.assertEquals(['b'], stream.text)
+        su.release_output()
+        self.assertEquals(['b', 'a', 'c'], stream.text)
+        sync_stream.write('d')
+        self.assertEquals(['b', 'a', 'c', 'd'], stream.text)
+
 if __name__ == '__main__':
     unittest.main()